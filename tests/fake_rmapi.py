@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+A stand-in for the rmapi command line tool, backed by a local directory.
+
+Folders on the "tablet" are directories below FAKE_RMAPI_ROOT and documents
+are files named after their visible name (without the `.pdf` suffix), holding
+whatever bytes were uploaded. The output of each command mimics rmapi closely
+enough for `zrm.rmapi_shim` to parse it.
+
+Behaviour is configured through environment variables:
+
+- FAKE_RMAPI_ROOT: the directory holding the tablet's contents (required)
+- FAKE_RMAPI_LATENCY: seconds to sleep per command, and per file for mput/mget
+- FAKE_RMAPI_FAIL: comma separated commands that fail, e.g. `put,mget`.
+  `put:2` only fails the first two `put` calls.
+- FAKE_RMAPI_ERROR: the message injected failures print, e.g. a network error
+- FAKE_RMAPI_HANG: commands that never finish, in the same format. A hung
+  command starts a child process that hangs as well, and writes its pid to
+  the log file with a `.pids` suffix, to check the whole group is killed.
+- FAKE_RMAPI_LOG: a file every invocation is appended to, one line each
+- RMAPI_CONFIG: as with rmapi, selects another tablet. For the fake it is a
+  file holding the root directory to use instead of FAKE_RMAPI_ROOT.
+
+`install_fake_rmapi` puts an `rmapi` executable running this script on PATH.
+"""
+
+import functools
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+ALREADY_EXISTS = (
+    "Error: entry already exists (use --force to recreate, "
+    "--content-only to replace content)"
+)
+
+
+def install_fake_rmapi(
+    tmp_path: Path,
+    monkeypatch,
+    latency: float = 0.0,
+    fail: str = "",
+    hang: str = "",
+    error: str = "",
+) -> Path:
+    """Put a fake `rmapi` on PATH for the rest of a test and return the tablet's root."""
+    from zrm import rmapi_shim
+
+    root = tmp_path / "tablet"
+    root.mkdir()
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    executable = bin_dir / "rmapi"
+    executable.write_text(
+        f'#!/bin/sh\nexec "{sys.executable}" "{Path(__file__).resolve()}" "$@"\n'
+    )
+    executable.chmod(executable.stat().st_mode | stat.S_IXUSR)
+
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_RMAPI_ROOT", str(root))
+    monkeypatch.setenv("FAKE_RMAPI_LATENCY", str(latency))
+    monkeypatch.setenv("FAKE_RMAPI_FAIL", fail)
+    monkeypatch.setenv("FAKE_RMAPI_HANG", hang)
+    monkeypatch.setenv("FAKE_RMAPI_ERROR", error)
+    monkeypatch.setenv("FAKE_RMAPI_LOG", str(tmp_path / "rmapi.log"))
+    # get_rmapi_location caches the first rmapi it finds, so give the test a
+    # fresh cache that finds the fake and is dropped again afterwards
+    monkeypatch.setattr(
+        rmapi_shim,
+        "get_rmapi_location",
+        functools.cache(rmapi_shim.get_rmapi_location.__wrapped__),
+    )
+    return root
+
+
+def read_log(tmp_path: Path) -> List[List[str]]:
+    """The commands the fake rmapi was called with, in order."""
+    log = tmp_path / "rmapi.log"
+    if not log.exists():
+        return []
+    return [line.split("\t") for line in log.read_text().splitlines()]
+
+
+class FakeRmapi:
+    def __init__(self):
+        if os.environ.get("RMAPI_CONFIG"):
+            self.root = Path(Path(os.environ["RMAPI_CONFIG"]).read_text().strip())
+        else:
+            self.root = Path(os.environ["FAKE_RMAPI_ROOT"])
+        self.latency = float(os.environ.get("FAKE_RMAPI_LATENCY") or 0)
+        self.log = os.environ.get("FAKE_RMAPI_LOG")
+        self.failures = self.parse_spec(os.environ.get("FAKE_RMAPI_FAIL", ""))
+        self.hangs = self.parse_spec(os.environ.get("FAKE_RMAPI_HANG", ""))
+        self.error = os.environ.get("FAKE_RMAPI_ERROR") or "injected failure for {}"
+
+    @staticmethod
+    def parse_spec(spec: str) -> dict:
+        """Parse `put,mget:2` into how many calls of each command are affected."""
+        limits = {}
+        for part in filter(None, spec.split(",")):
+            command, _, count = part.partition(":")
+            limits[command] = int(count) if count else None
+        return limits
+
+    def resolve(self, path: str) -> Path:
+        return self.root.joinpath(*[part for part in path.split("/") if part])
+
+    def relative(self, path: Path) -> str:
+        return path.relative_to(self.root).as_posix()
+
+    def affects(self, limits: dict, command: str) -> bool:
+        if command not in limits:
+            return False
+        limit = limits[command]
+        if limit is None:
+            return True
+        previous_calls = 0
+        if self.log and Path(self.log).exists():
+            with open(self.log) as f:
+                previous_calls = sum(1 for line in f if line.split("\t")[0] == command)
+        # This invocation is already logged, so it is call number `previous_calls`
+        return previous_calls <= limit
+
+    def run(self, args: List[str]) -> int:
+        if self.log:
+            with open(self.log, "a") as f:
+                f.write("\t".join(args) + "\n")
+        if self.latency:
+            time.sleep(self.latency)
+
+        command, rest = (args[0], args[1:]) if args else ("ls", [])
+        if self.affects(self.hangs, command):
+            self.hang()
+        if self.affects(self.failures, command):
+            print(f"Error: {self.error.format(command)}", file=sys.stderr)
+            return 1
+        handler = getattr(self, f"cmd_{command}", None)
+        if handler is None:
+            print(f"Error: unknown command {command}", file=sys.stderr)
+            return 1
+        return handler(*rest)
+
+    def hang(self):
+        child = subprocess.Popen(
+            [sys.executable, "-c", "import time; time.sleep(3600)"]
+        )
+        if self.log:
+            with open(Path(self.log).with_suffix(".pids"), "a") as f:
+                f.write(f"{child.pid}\n")
+        time.sleep(3600)
+
+    def cmd_ls(self, folder: str = "") -> int:
+        path = self.resolve(folder)
+        if not path.is_dir():
+            print(f"Error: directory doesn't exist: {folder}", file=sys.stderr)
+            return 1
+        for child in sorted(path.iterdir()):
+            kind = "[d]" if child.is_dir() else "[f]"
+            print(f"{kind}\t{child.name}")
+        return 0
+
+    def cmd_find(self, folder: str = "") -> int:
+        path = self.resolve(folder)
+        if not path.is_dir():
+            print(f"Error: directory doesn't exist: {folder}", file=sys.stderr)
+            return 1
+        if path != self.root:
+            print(f"[d] {self.relative(path)}")
+        for child in sorted(path.rglob("*")):
+            kind = "[d]" if child.is_dir() else "[f]"
+            print(f"{kind} {self.relative(child)}")
+        return 0
+
+    def cmd_get(self, remote: str) -> int:
+        path = self.resolve(remote)
+        if not path.is_file():
+            print(f"Error: file doesn't exist: {remote}", file=sys.stderr)
+            return 1
+        shutil.copyfile(path, Path.cwd() / f"{path.name}.rmdoc")
+        return 0
+
+    def cmd_mget(self, folder: str) -> int:
+        path = self.resolve(folder)
+        if not path.is_dir():
+            print(f"Error: directory doesn't exist: {folder}", file=sys.stderr)
+            return 1
+        for document in sorted(p for p in path.rglob("*") if p.is_file()):
+            target = Path.cwd() / document.relative_to(path).parent
+            target.mkdir(parents=True, exist_ok=True)
+            print(f"downloading: [{document.name}]...", flush=True)
+            shutil.copyfile(document, target / f"{document.name}.rmdoc")
+            if self.latency:
+                time.sleep(self.latency)
+        return 0
+
+    def _put(self, local: Path, folder: str) -> str | None:
+        """Upload one file, returning an error message if it failed."""
+        target_folder = self.resolve(folder)
+        if not target_folder.is_dir():
+            return f"Error: directory doesn't exist: {folder}"
+        target = target_folder / local.stem
+        if target.exists():
+            return ALREADY_EXISTS
+        shutil.copyfile(local, target)
+        return None
+
+    def cmd_put(self, local: str, folder: str = "") -> int:
+        error = self._put(Path(local), folder)
+        if error:
+            print(error, file=sys.stderr)
+            return 1
+        print(f"uploading: [{Path(local).name}]... complete")
+        return 0
+
+    def cmd_mput(self, folder: str = "") -> int:
+        if not self.resolve(folder).is_dir():
+            print(f"Error: directory doesn't exist: {folder}", file=sys.stderr)
+            return 1
+        for local in sorted(p for p in Path.cwd().iterdir() if p.is_file()):
+            error = self._put(local, folder)
+            if error == ALREADY_EXISTS:
+                print(f" {local.name}: document already exists, skipping")
+            elif error:
+                print(f" {local.name}: {error}")
+            else:
+                print(f" uploading: [{local.name}]... complete", flush=True)
+            if self.latency:
+                time.sleep(self.latency)
+        return 0
+
+    def cmd_rm(self, remote: str) -> int:
+        path = self.resolve(remote)
+        if path.is_file():
+            path.unlink()
+        elif path.is_dir() and path != self.root:
+            if any(path.iterdir()):
+                print(f"Error: directory is not empty: {remote}", file=sys.stderr)
+                return 1
+            path.rmdir()
+        else:
+            print(f"Error: entry doesn't exist: {remote}", file=sys.stderr)
+            return 1
+        return 0
+
+
+def main():
+    sys.exit(FakeRmapi().run(sys.argv[1:]))
+
+
+if __name__ == "__main__":
+    main()
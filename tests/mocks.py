@@ -2,9 +2,13 @@
 Mock implementations that inherit from the real API classes for cleaner testing.
 """
 
-from typing import List, Dict, Any, Optional
+from collections import Counter
+import hashlib
+from typing import BinaryIO, List, Dict, Any, Optional, Iterable, Iterator, Tuple
 from pathlib import Path
 import uuid
+import tempfile
+import time
 import logging
 
 from zrm.adapters.TreeNode import TreeNode
@@ -14,93 +18,161 @@ from zrm.adapters.ReMarkableAPI import ReMarkableAPI
 logger = logging.getLogger(__name__)
 
 
-class MockZoteroAPI(ZoteroAPI):
-    """Mock implementation that overrides ZoteroAPI methods."""
+class InstrumentedMock:
+    """Counts calls per method and optionally sleeps on each one to simulate API latency."""
 
-    def __init__(self):
+    latency: float = 0.0
+    calls: Counter
+
+    def _record_call(self, method: str):
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class MockZoteroAPI(InstrumentedMock, ZoteroAPI):
+    """Mock implementation that overrides ZoteroAPI methods.
+
+    Items are indexed by parent and by tag, so lookups stay cheap on large
+    synthetic libraries.
+    """
+
+    def __init__(self, latency: float = 0.0):
         # Don't call super().__init__ to avoid needing real Zotero client
         self._items: Dict[str, Dict] = {}
         self._attachments: Dict[str, bytes] = {}  # handle -> content
+        # Insertion-ordered sets, so results come back in creation order
+        self._children: Dict[str, Dict[str, None]] = {}  # parent -> children
+        self._tagged: Dict[str, Dict[str, None]] = {}  # tag -> items
+        self.latency = latency
+        self.calls = Counter()
+
+    def _add_item(self, handle: str, item: Dict):
+        self._items[handle] = item
+        parent = item["data"].get("parentItem")
+        if parent:
+            self._children.setdefault(parent, {})[handle] = None
 
     def create_item(self, path: List[str]) -> str:
         """Create a mock collection (item)."""
+        self._record_call("create_item")
         handle = str(uuid.uuid4())
-        self._items[handle] = {
-            "key": handle,
-            "data": {"title": path[0], "itemType": "document", "tags": []},
-        }
+        self._add_item(
+            handle,
+            {
+                "key": handle,
+                "data": {"title": path[0], "itemType": "document", "tags": []},
+            },
+        )
         return handle
 
     def create_file(self, handle: str, filename: str, content: bytes) -> str:
         """Create a mock file attachment."""
+        self._record_call("create_file")
         attachment_handle = str(uuid.uuid4())
-        self._items[attachment_handle] = {
-            "key": attachment_handle,
-            "data": {
-                "title": filename,
-                "itemType": "attachment",
-                "parentItem": handle,
-                "tags": [],
+        self._add_item(
+            attachment_handle,
+            {
+                "key": attachment_handle,
+                "data": {
+                    "title": filename,
+                    "itemType": "attachment",
+                    "parentItem": handle,
+                    "tags": [],
+                    "md5": hashlib.md5(content).hexdigest(),
+                },
             },
-        }
+        )
         self._attachments[attachment_handle] = content
         return attachment_handle
 
+    def _item_data(self, handle: str) -> Dict:
+        return self._items[handle]["data"]
+
     def item_exists(self, handle: str) -> bool:
         """Check if item exists."""
+        self._record_call("item_exists")
         return handle in self._items
 
+    def get_items(self, keys: Iterable[str]) -> Dict[str, Dict]:
+        """Get several items at once."""
+        self._record_call("get_items")
+        return {key: self._items[key] for key in keys if key in self._items}
+
+    def prefetch(self, keys: Iterable[str]):
+        """Nothing to load, the mock holds every item in memory."""
+        self._record_call("prefetch")
+
     def get_file_content(self, handle: str) -> Optional[bytes]:
         """Get file content."""
+        self._record_call("get_file_content")
         return self._attachments.get(handle)
 
+    def attachment_size(self, handle: str) -> Optional[int]:
+        """Get the size of an attachment's file."""
+        self._record_call("attachment_size")
+        content = self._attachments.get(handle)
+        return None if content is None else len(content)
+
     def update_file_content(
         self, parent_handle: str, attachment_handle: str, content: bytes
     ) -> str:
         """Update file content."""
+        self._record_call("update_file_content")
         if attachment_handle in self._items:
             self._attachments[attachment_handle] = content
+            self._items[attachment_handle]["data"]["md5"] = hashlib.md5(
+                content
+            ).hexdigest()
             return attachment_handle
         return ""
 
     def list_children(self, handle: str) -> List[TreeNode]:
         """List children of an item."""
+        self._record_call("list_children")
         children = []
-        for item_handle, item in self._items.items():
-            if item["data"].get("parentItem") == handle:
-                children.append(
-                    TreeNode(
-                        handle=item_handle,
-                        name=item["data"]["title"],
-                        type=item["data"]["itemType"],
-                        path=item["data"].get("path", ""),
-                        tags=item["data"]["tags"],
-                    )
+        for item_handle in self._children.get(handle, {}):
+            item = self._items[item_handle]
+            children.append(
+                TreeNode(
+                    handle=item_handle,
+                    name=item["data"]["title"],
+                    type=item["data"]["itemType"],
+                    path=item["data"].get("path", ""),
+                    tags=[tag["tag"] for tag in item["data"]["tags"]],
+                    _load_metadata=self._item_data,
                 )
+            )
         return children
 
     def add_tags(self, handle: str, tags: List[str]) -> bool:
         """Add tags to item."""
+        self._record_call("add_tags")
         if handle in self._items:
             current_tags = self._items[handle]["data"].get("tags", [])
             for tag in tags:
                 if not any(t.get("tag") == tag for t in current_tags):
                     current_tags.append({"tag": tag})
+                self._tagged.setdefault(tag, {})[handle] = None
             self._items[handle]["data"]["tags"] = current_tags
             return True
         return False
 
     def remove_tags(self, handle: str, tags: List[str]) -> bool:
         """Remove tags from item."""
+        self._record_call("remove_tags")
         if handle in self._items:
             current_tags = self._items[handle]["data"].get("tags", [])
             new_tags = [t for t in current_tags if t.get("tag") not in tags]
             self._items[handle]["data"]["tags"] = new_tags
+            for tag in tags:
+                self._tagged.get(tag, {}).pop(handle, None)
             return True
         return False
 
     def get_tags(self, handle: str) -> List[str]:
         """Get tags for item."""
+        self._record_call("get_tags")
         if handle in self._items:
             tags = self._items[handle]["data"].get("tags", [])
             return [tag.get("tag", "") for tag in tags if tag.get("tag")]
@@ -108,36 +180,66 @@ class MockZoteroAPI(ZoteroAPI):
 
     def has_tags(self, handle: str, tags: List[str]) -> bool:
         """Check if item has all specified tags."""
-        current_tags = self.get_tags(handle)
-        return all(tag in current_tags for tag in tags)
+        self._record_call("has_tags")
+        if handle not in self._items:
+            return False
+        return all(handle in self._tagged.get(tag, {}) for tag in tags)
 
     def find_nodes_with_tag(self, tag: str) -> List[TreeNode]:
         """Find all items with specified tag."""
+        self._record_call("find_nodes_with_tag")
         results = []
-        for handle, item in self._items.items():
-            tags = [t.get("tag", "") for t in item["data"].get("tags", [])]
-            if tag in tags:
-                results.append(
-                    TreeNode(
-                        handle=handle,
-                        name=item["data"]["title"],
-                        type=item["data"]["itemType"],
-                        tags=item["data"]["tags"],
-                        path=item["data"].get("path", ""),
-                        metadata=item,
-                    )
+        for handle in self._tagged.get(tag, {}):
+            item = self._items[handle]
+            results.append(
+                TreeNode(
+                    handle=handle,
+                    name=item["data"]["title"],
+                    type=item["data"]["itemType"],
+                    tags=[tag["tag"] for tag in item["data"]["tags"]],
+                    path=item["data"].get("path", ""),
+                    _load_metadata=self._item_data,
                 )
+            )
         return results
 
 
-class MockReMarkableAPI(ReMarkableAPI):
-    """Mock implementation that overrides ReMarkableAPI methods."""
+def _parent_folder(path: str) -> str:
+    return path.rpartition("/")[0]
+
 
-    def __init__(self, files: Dict[str, bytes], folders: set):
+class MockReMarkableAPI(InstrumentedMock, ReMarkableAPI):
+    """Mock implementation that overrides ReMarkableAPI methods.
+
+    Files are indexed by their folder, so listing a folder does not scan
+    every file on the device.
+    """
+
+    def __init__(self, files: Dict[str, bytes], folders: set, latency: float = 0.0):
         # Don't call super().__init__ to avoid rmapi check
         self._files: Dict[str, bytes] = files
         self._folders: set = folders
+        self._entries: Dict[str, Dict[str, None]] = {}  # folder -> file names
+        for file_path in files:
+            self._index_file(file_path)
         self._api_unavailable: bool = False
+        self.latency = latency
+        self.calls = Counter()
+
+    def unchanged_since_last_pull(self) -> bool:
+        """The mock cannot tell, so every pull runs."""
+        return False
+
+    def remember_pull(self):
+        pass
+
+    def _index_file(self, path: str):
+        folder, _, name = path.rpartition("/")
+        self._entries.setdefault(folder, {})[name] = None
+
+    def _unindex_file(self, path: str):
+        folder, _, name = path.rpartition("/")
+        self._entries.get(folder, {}).pop(name, None)
 
     def api_unavailable(self):
         """Configure mock to simulate API unavailability."""
@@ -146,12 +248,13 @@ class MockReMarkableAPI(ReMarkableAPI):
 
     def upload_file(self, path: str, content: bytes) -> bool:
         """Upload a file."""
+        self._record_call("upload_file")
         if self._api_unavailable:
             logger.error("reMarkable API is unavailable")
             return False
 
         # Ensure parent directory exists
-        parent = str(Path(path).parent)
+        parent = _parent_folder(path)
         if parent not in self._folders:
             return False
 
@@ -167,53 +270,83 @@ class MockReMarkableAPI(ReMarkableAPI):
                 return False
 
         self._files[path] = content
+        self._index_file(path)
         return True
 
+    def upload_files(
+        self, folder: str, files: Iterable[Tuple[str, bytes | BinaryIO]]
+    ) -> Dict[str, bool]:
+        """Upload several files to one folder."""
+        self._record_call("upload_files")
+        return {
+            filename: self.upload_file(
+                f"{folder}/{filename}",
+                content if isinstance(content, bytes) else content.read(),
+            )
+            for filename, content in files
+        }
+
     def file_or_folder_exists(self, path: str) -> bool:
         """Check if file or folder exists."""
+        self._record_call("file_or_folder_exists")
         return path in self._files or path in self._folders
 
     def is_folder(self, path: str) -> bool:
         """Check if path is a folder."""
+        self._record_call("is_folder")
         return path in self._folders
 
     def is_file(self, path: str) -> bool:
         """Check if path is a file."""
+        self._record_call("is_file")
         return path in self._files
 
     def get_file_content(self, path: str) -> bytes:
         """Get file content."""
+        self._record_call("get_file_content")
         if path not in self._files:
             raise FileNotFoundError(f"File not found: {path}")
         return self._files[path]
 
+    def download_files(
+        self, folder: str, names: List[str], poll_interval: float = 0.2
+    ) -> Iterator[Tuple[str, Path]]:
+        """Download several files, yielding each as a local file."""
+        self._record_call("download_files")
+        with tempfile.TemporaryDirectory() as staging:
+            for name in names:
+                path = f"{folder}/{name}"
+                if path not in self._files:
+                    logger.error(f"File not found: {path}")
+                    continue
+                local_path = Path(staging) / f"{name}.rmn"
+                local_path.write_bytes(self._files[path])
+                yield name, local_path
+
     def list_children(self, path: str) -> List[str]:
         """List children in folder."""
+        self._record_call("list_children")
         if path not in self._folders:
             return []
-
-        children = []
-        path_prefix = path + "/" if path else ""
-
-        # Find files in this directory
-        for file_path in self._files:
-            if file_path.startswith(path_prefix):
-                relative_path = file_path[len(path_prefix) :]
-                if "/" not in relative_path:  # Direct child, not nested
-                    children.append(relative_path)
-
-        return children
+        return list(self._entries.get(path, {}))
 
     def delete_file_or_folder(self, path: str) -> bool:
         """Delete file or folder."""
+        self._record_call("delete_file_or_folder")
         if path in self._files:
             del self._files[path]
+            self._unindex_file(path)
             return True
         elif path in self._folders:
             # Remove folder and all its contents
             self._folders.discard(path)
-            files_to_remove = [f for f in self._files if f.startswith(path + "/")]
-            for file_path in files_to_remove:
-                del self._files[file_path]
+            nested = [
+                folder
+                for folder in self._entries
+                if folder == path or folder.startswith(path + "/")
+            ]
+            for folder in nested:
+                for name in self._entries.pop(folder):
+                    del self._files[f"{folder}/{name}"]
             return True
         return False
@@ -0,0 +1,77 @@
+"""
+A local stand-in for the root endpoint of the reMarkable cloud's sync API.
+
+It serves `GET /sync/v4/root` for a tablet kept by the fake rmapi (see
+`fake_rmapi.py`): the hash is derived from the documents in the tablet's
+directory, and the generation goes up every time that hash changes, as it
+does in the cloud whenever a document is added, changed, moved or deleted.
+Point rmapi_shim at it by setting RMAPI_HOST to `url`.
+"""
+
+import hashlib
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+class RemarkableCloudStandIn:
+    """Answers root requests authorised with `token` for the tablet at `root`."""
+
+    def __init__(self, root: Path, token: str = "test-user-token"):
+        self.root = Path(root)
+        self.token = token
+        self.generation = 0
+        self.requests: Counter = Counter()
+        self._hash = None
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "RemarkableCloudStandIn":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def root_index(self) -> dict:
+        digest = hashlib.sha256()
+        for path in sorted(self.root.rglob("*")):
+            digest.update(path.relative_to(self.root).as_posix().encode())
+            if path.is_file():
+                digest.update(hashlib.sha256(path.read_bytes()).digest())
+        with self._lock:
+            if digest.hexdigest() != self._hash:
+                self._hash = digest.hexdigest()
+                self.generation += 1
+            return {"hash": self._hash, "generation": self.generation, "schemaVersion": 3}
+
+    def _handler_class(self):
+        cloud = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                cloud.requests[self.path] += 1
+                if self.headers.get("Authorization") != f"Bearer {cloud.token}":
+                    status, body = 401, b"invalid token"
+                elif self.path != "/sync/v4/root":
+                    status, body = 404, b"not found"
+                else:
+                    status, body = 200, json.dumps(cloud.root_index()).encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
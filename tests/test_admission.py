@@ -0,0 +1,79 @@
+"""
+Tests for the in-flight byte budget shared by the sync stages.
+"""
+
+import threading
+import time
+
+import pytest
+
+from tests.mocks import MockReMarkableAPI, MockZoteroAPI
+from zrm.admission import ByteBudget
+from zrm.sync_functions import upload_attachments_to_rm
+
+MiB = 2**20
+
+
+@pytest.mark.mock
+def test_reservations_wait_for_the_budget():
+    budget = ByteBudget(max_bytes=10)
+    budget.acquire(8)
+    admitted = threading.Event()
+
+    def reserve():
+        with budget.reserve(5):
+            admitted.set()
+
+    thread = threading.Thread(target=reserve)
+    thread.start()
+    assert not admitted.wait(0.1)
+    budget.release(8)
+    assert admitted.wait(1)
+    thread.join()
+
+    assert budget.in_flight == 0
+    assert budget.peak == 8
+
+
+@pytest.mark.mock
+def test_oversized_payloads_run_alone_and_spill():
+    budget = ByteBudget(max_bytes=10, spill_threshold=4)
+
+    assert budget.try_acquire(50)
+    assert not budget.try_acquire(1)
+    budget.release(50)
+
+    assert budget.spill(b"tiny") == b"tiny"
+    spilled = budget.spill(b"0123456789")
+    assert spilled.read() == b"0123456789"
+
+
+@pytest.mark.mock
+def test_push_stays_within_the_budget():
+    class WatchedZotero(MockZoteroAPI):
+        def get_file_content(self, handle):
+            # Downloads are read into memory whole, so their size must be reserved by now
+            in_flight_during[handle] = budget.in_flight
+            return super().get_file_content(handle)
+
+    in_flight_during = {}
+    zotero = WatchedZotero(latency=0.005)
+    rm = MockReMarkableAPI(files={}, folders={"", "Zotero", "Zotero/unread"})
+    item = zotero.create_item(["Books"])
+    for i in range(12):
+        zotero.create_file(item, f"book {i}.pdf", bytes([i]) * MiB)
+    scanned = zotero.create_file(item, "scanned.pdf", b"s" * 5 * MiB)
+    attachments = zotero.list_children(item)
+
+    budget = ByteBudget(max_bytes=3 * MiB, spill_threshold=2 * MiB)
+    results = upload_attachments_to_rm(
+        attachments, zotero, rm, "Zotero/unread", workers=8, budget=budget
+    )
+
+    assert all(results.values())
+    assert rm.get_file_content("Zotero/unread/scanned.pdf") == b"s" * 5 * MiB
+    # The file larger than the budget was downloaded on its own, and counted
+    assert in_flight_during.pop(scanned) == 5 * MiB
+    assert all(MiB <= in_flight <= 3 * MiB for in_flight in in_flight_during.values())
+    assert budget.peak == 5 * MiB
+    assert budget.in_flight == 0
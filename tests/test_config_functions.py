@@ -1,4 +1,21 @@
-from zrm.config_functions import normalize_rm_path
+import pytest
+
+from zrm.config_functions import (
+    load_all_profiles,
+    load_profiles,
+    normalize_rm_path,
+    rmapi_policy_from_dict,
+)
+from zrm.rmapi_policy import DEFAULT_TIMEOUTS
+
+CONFIG = """
+LIBRARY_ID: "1"
+LIBRARY_TYPE: user
+API_KEY: key
+USE_WEBDAV: "False"
+UNREAD_FOLDER: unread
+READ_FOLDER: read
+"""
 
 
 def test_normalize_rm_path():
@@ -17,3 +34,86 @@ def test_normalize_rm_path():
     assert normalize_rm_path("  //zotero/read") == "read"
     assert normalize_rm_path(" /zotero/read ") == "read"
     assert normalize_rm_path("foo/zotero/read") == "foo/zotero/read"
+
+
+def test_plain_config_is_one_profile(tmp_path):
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(CONFIG)
+
+    [profile] = load_profiles(config_path)
+    assert profile.name == "config"
+    assert profile.folders == {"unread": "unread", "read": "read"}
+    assert profile.state_dir == tmp_path / ".zrm"
+    assert profile.rmapi_config is None
+
+
+def test_profiles_section(tmp_path):
+    config_path = tmp_path / "lab.yml"
+    config_path.write_text(
+        CONFIG
+        + """
+PROFILES:
+  alice:
+    LIBRARY_ID: "2"
+    RMAPI_CONFIG: /home/alice/.rmapi
+  bob:
+    READ_FOLDER: /Zotero/done
+"""
+    )
+
+    alice, bob = load_profiles(config_path)
+    assert (alice.name, alice.zot.library_id, alice.rmapi_config) == (
+        "alice",
+        "2",
+        "/home/alice/.rmapi",
+    )
+    assert bob.zot.library_id == "1"
+    assert bob.folders["read"] == "done"
+    assert alice.state_dir != bob.state_dir
+    assert alice.state_dir.is_dir() and bob.state_dir.is_dir()
+
+
+
+def test_profiles_from_different_files_get_unique_names(tmp_path):
+    paths = []
+    for folder in ("a", "b"):
+        (tmp_path / folder).mkdir()
+        paths.append(tmp_path / folder / "config.yml")
+        paths[-1].write_text(CONFIG)
+
+    first, second = load_all_profiles(paths)
+    assert first.name == f"config ({paths[0]})"
+    assert second.name == f"config ({paths[1]})"
+
+    with pytest.raises(ValueError, match="configured 2 times"):
+        load_all_profiles([paths[0], paths[0]])
+
+def test_rmapi_policy_settings():
+    default = rmapi_policy_from_dict({})
+    assert default.timeouts == DEFAULT_TIMEOUTS
+    assert not default.hedge
+
+    policy = rmapi_policy_from_dict(
+        {"RMAPI_TIMEOUTS": {"ls": 5}, "RMAPI_RETRIES": 0, "RMAPI_HEDGE": "True"}
+    )
+    assert policy.timeout("ls") == 5
+    assert policy.timeout("get") == DEFAULT_TIMEOUTS["get"]
+    assert policy.retries == 0 and policy.hedge
+
+    assert rmapi_policy_from_dict({"RMAPI_TIMEOUTS": 30}).timeout("mput") == 30
+
+
+@pytest.mark.parametrize(
+    "value, hedge",
+    [
+        (True, True),
+        ("true", True),
+        ("True", True),
+        ("yes", True),
+        (False, False),
+        ("False", False),
+        ("no", False),
+    ],
+)
+def test_rmapi_hedge_accepts_yaml_booleans(value, hedge):
+    assert rmapi_policy_from_dict({"RMAPI_HEDGE": value}).hedge is hedge
@@ -0,0 +1,65 @@
+"""
+Tests for annotation fingerprints of downloaded reMarkable documents.
+"""
+
+import zipfile
+
+import pytest
+
+from zrm.fingerprints import FingerprintStore, annotation_fingerprint
+
+VALID_RM_DOCUMENT = "tests/on computable numbers - RMPP - highlighter tool v6.rmn"
+
+
+def rewrite(source, target, change):
+    """Copy a document, letting `change` alter the bytes of individual entries."""
+    with zipfile.ZipFile(source) as zin, zipfile.ZipFile(target, "w") as zout:
+        for name in zin.namelist():
+            zout.writestr(name, change(name, zin.read(name)))
+
+
+@pytest.mark.mock
+def test_fingerprint_ignores_metadata_but_not_ink(tmp_path):
+    original = annotation_fingerprint(VALID_RM_DOCUMENT)
+
+    moved = tmp_path / "moved.rmn"
+    rewrite(
+        VALID_RM_DOCUMENT,
+        moved,
+        lambda name, data: data.replace(b'"lastOpenedPage": 1', b'"lastOpenedPage": 2')
+        if name.endswith(".metadata")
+        else data,
+    )
+    assert annotation_fingerprint(moved) == original
+
+    inked = tmp_path / "inked.rmn"
+    rewrite(
+        VALID_RM_DOCUMENT,
+        inked,
+        lambda name, data: data + b"\0" if name.endswith(".rm") else data,
+    )
+    assert annotation_fingerprint(inked) != original
+
+
+@pytest.mark.mock
+def test_store_persists_and_replaces(tmp_path):
+    store = FingerprintStore(tmp_path / "fingerprints.json")
+    store.set("OLD", "abc")
+    store.set("NEW", "def", replaces="OLD")
+
+    reloaded = FingerprintStore(tmp_path / "fingerprints.json")
+    assert reloaded.get("NEW") == "def"
+    assert reloaded.get("OLD") is None
+
+
+@pytest.mark.mock
+@pytest.mark.parametrize("saved", [b'{"OLD": "ab', b"[]", b'{"\xff": "abc"}'])
+def test_store_starts_empty_when_unreadable(tmp_path, saved):
+    path = tmp_path / "fingerprints.json"
+    path.write_bytes(saved)
+
+    store = FingerprintStore(path)
+    assert store.get("OLD") is None
+    store.set("NEW", "def")
+
+    assert FingerprintStore(path).get("NEW") == "def"
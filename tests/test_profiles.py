@@ -0,0 +1,142 @@
+"""
+Tests for syncing several profiles in one process, against local stand-ins for Zotero and rmapi.
+"""
+
+import logging
+
+import pytest
+
+from tests.fake_rmapi import install_fake_rmapi, read_log
+from tests.remarkable_cloud import RemarkableCloudStandIn
+from tests.zotero_server import ZoteroStandIn
+from zrm.config_functions import Profile
+from zrm.zotero_rm_bridge import run_profiles
+
+FOLDERS = {"unread": "unread", "read": "read"}
+
+
+def make_tablet(tmp_path, name):
+    root = tmp_path / name
+    (root / "Zotero" / "unread").mkdir(parents=True)
+    (root / "Zotero" / "read").mkdir()
+    rmapi_config = tmp_path / f"{name}.rmapi"
+    rmapi_config.write_text(str(root))
+    return root, str(rmapi_config)
+
+
+def make_profile(tmp_path, name, server, rmapi_config):
+    state_dir = tmp_path / "state" / name
+    state_dir.mkdir(parents=True)
+    return Profile(name, server.client(), False, FOLDERS, state_dir, rmapi_config)
+
+
+@pytest.mark.mock
+def test_profiles_sync_to_their_own_tablets(tmp_path, monkeypatch):
+    install_fake_rmapi(tmp_path, monkeypatch)
+    with ZoteroStandIn() as alice_zotero, ZoteroStandIn() as bob_zotero:
+        profiles = []
+        tablets = {}
+        for name, server in [("alice", alice_zotero), ("bob", bob_zotero)]:
+            entry = server.add_item(f"{name} paper", tags=("to_sync",))
+            server.add_item(f"{name} paper.pdf", parent=entry, content=b"%PDF")
+            tablets[name], rmapi_config = make_tablet(tmp_path, name)
+            profiles.append(make_profile(tmp_path, name, server, rmapi_config))
+
+        results = run_profiles(profiles, ["push"])
+
+        assert results == {"alice": True, "bob": True}
+        for name, server in [("alice", alice_zotero), ("bob", bob_zotero)]:
+            assert [p.name for p in (tablets[name] / "Zotero" / "unread").iterdir()] == [
+                f"{name} paper"
+            ]
+            [entry] = [
+                item for item in server.items.values() if "parentItem" not in item["data"]
+            ]
+            assert entry["data"]["tags"] == [{"tag": "synced"}]
+            assert (tmp_path / "state" / name / "zotero_items.json").exists()
+
+
+@pytest.mark.mock
+def test_failing_profile_does_not_stop_the_others(tmp_path, monkeypatch):
+    install_fake_rmapi(tmp_path, monkeypatch)
+    broken_zotero = ZoteroStandIn().start()
+    broken_zotero.stop()
+    with ZoteroStandIn() as working_zotero:
+        entry = working_zotero.add_item("paper", tags=("to_sync",))
+        working_zotero.add_item("paper.pdf", parent=entry, content=b"%PDF")
+        _, broken_config = make_tablet(tmp_path, "broken")
+        working_tablet, working_config = make_tablet(tmp_path, "working")
+
+        results = run_profiles(
+            [
+                make_profile(tmp_path, "broken", broken_zotero, broken_config),
+                make_profile(tmp_path, "working", working_zotero, working_config),
+            ],
+            ["push"],
+        )
+
+        assert results == {"broken": False, "working": True}
+        assert (working_tablet / "Zotero" / "unread" / "paper").exists()
+
+
+
+@pytest.mark.mock
+def test_profiles_must_have_unique_names(tmp_path):
+    with ZoteroStandIn() as zotero:
+        _, rmapi_config = make_tablet(tmp_path, "alice")
+        profile = make_profile(tmp_path, "alice", zotero, rmapi_config)
+
+        with pytest.raises(ValueError, match="not unique"):
+            run_profiles([profile, profile], ["push"])
+
+@pytest.mark.mock
+def test_pull_is_skipped_while_the_tablet_is_unchanged(tmp_path, monkeypatch):
+    root = install_fake_rmapi(tmp_path, monkeypatch)
+    (root / "Zotero" / "unread").mkdir(parents=True)
+    (root / "Zotero" / "read").mkdir()
+    # rmapi's own config, holding the token for the cloud
+    config_home = tmp_path / "config"
+    (config_home / "rmapi").mkdir(parents=True)
+    (config_home / "rmapi" / "rmapi.conf").write_text(
+        "devicetoken: test-device-token\nusertoken: test-user-token\n"
+    )
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(config_home))
+    monkeypatch.delenv("RMAPI_CONFIG", raising=False)
+
+    with ZoteroStandIn() as zotero, RemarkableCloudStandIn(root) as cloud:
+        monkeypatch.setenv("RMAPI_HOST", cloud.url)
+        profile = make_profile(tmp_path, "alice", zotero, None)
+        assert run_profiles([profile], ["pull"]) == {"alice": True}
+        rmapi_calls = len(read_log(tmp_path))
+        zotero_requests = sum(zotero.requests.values())
+
+        assert run_profiles([profile], ["pull"]) == {"alice": True}
+        assert len(read_log(tmp_path)) == rmapi_calls
+        assert sum(zotero.requests.values()) == zotero_requests
+        assert cloud.requests["/sync/v4/root"] == 2
+
+        (root / "Zotero" / "read" / "paper").write_bytes(b"rmdoc")
+        assert run_profiles([profile], ["pull"]) == {"alice": True}
+        assert ["find", "Zotero"] in read_log(tmp_path)[rmapi_calls:]
+
+
+@pytest.mark.mock
+def test_each_run_logs_only_its_own_rmapi_calls(tmp_path, monkeypatch, caplog):
+    install_fake_rmapi(tmp_path, monkeypatch)
+    with ZoteroStandIn() as zotero:
+        _, rmapi_config = make_tablet(tmp_path, "alice")
+        profile = make_profile(tmp_path, "alice", zotero, rmapi_config)
+        summaries = []
+        for _ in range(2):
+            caplog.clear()
+            with caplog.at_level(logging.INFO):
+                run_profiles([profile], ["push"])
+            summaries.append(
+                [r.getMessage() for r in caplog.records if r.msg.startswith("rmapi ")]
+            )
+
+        assert summaries[0]
+        assert [line.split(",")[0] for line in summaries[1]] == [
+            line.split(",")[0] for line in summaries[0]
+        ]
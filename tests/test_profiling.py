@@ -0,0 +1,154 @@
+"""
+Tests for the per-phase profiles of sync runs.
+"""
+
+import cProfile
+import pstats
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from tests.fake_rmapi import install_fake_rmapi
+from tests.test_profiles import make_profile, make_tablet
+from tests.zotero_server import ZoteroStandIn
+from zrm import profiling
+from zrm.zotero_rm_bridge import run_profiles
+
+
+def busy_worker(n):
+    return sum(i * i for i in range(n))
+
+
+def sleepy_worker():
+    time.sleep(0.2)
+
+
+def profiled_functions(path):
+    return {name for _, _, name in pstats.Stats(str(path)).stats}
+
+
+@pytest.fixture
+def session(tmp_path):
+    yield lambda mode: profiling.start(mode, tmp_path)
+    profiling.stop()
+
+
+def recorded_functions(paths):
+    """The functions in cProfile output, and in collapsed stacks from sampling."""
+    functions = set()
+    for path in paths:
+        if path.suffix == ".prof":
+            functions |= profiled_functions(path)
+        else:
+            for line in path.read_text().splitlines():
+                functions |= {frame.split(" ")[0] for frame in line.split(";")}
+    return functions
+
+
+class SingleThreadProfile(cProfile.Profile):
+    """Like cProfile from Python 3.12, only one of these can be enabled at a time."""
+
+    active = 0
+    lock = threading.Lock()
+
+    def enable(self, *args, **kwargs):
+        with self.lock:
+            if SingleThreadProfile.active:
+                raise ValueError("Another profiling tool is already active")
+            SingleThreadProfile.active += 1
+        super().enable(*args, **kwargs)
+
+    def disable(self):
+        super().disable()
+        with self.lock:
+            SingleThreadProfile.active -= 1
+
+
+@pytest.mark.mock
+def test_profile_includes_work_on_worker_threads(tmp_path, session):
+    session(profiling.DETERMINISTIC)
+    with profiling.phase("push"):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(profiling.wrap(busy_worker), [10_000] * 4))
+
+    written = profiling.stop()
+
+    assert all(path.parent == tmp_path for path in written)
+    assert any(path.name.endswith("-push.prof") for path in written)
+    assert "busy_worker" in recorded_functions(written)
+
+
+@pytest.mark.mock
+def test_threads_without_a_profiler_of_their_own_are_sampled(
+    tmp_path, monkeypatch, session
+):
+    monkeypatch.setattr(profiling.cProfile, "Profile", SingleThreadProfile)
+    session(profiling.DETERMINISTIC)
+    with profiling.phase("pull"):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(profiling.wrap(sleepy_worker)).result()
+
+    written = {path.suffix: path for path in profiling.stop()}
+
+    assert set(written) == {".prof", ".collapsed"}
+    assert "sleepy_worker" not in profiled_functions(written[".prof"])
+    stacks = written[".collapsed"].read_text().splitlines()
+    assert all(line.startswith("pull;") for line in stacks)
+    assert any("sleepy_worker" in line for line in stacks)
+
+
+@pytest.mark.mock
+def test_profile_includes_work_in_other_processes(tmp_path, session):
+    session(profiling.DETERMINISTIC)
+    with profiling.phase("render"):
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            results = list(
+                executor.map(profiling.wrap_for_process(busy_worker), [10, 20])
+            )
+
+    [written] = profiling.stop()
+
+    assert results == [busy_worker(10), busy_worker(20)]
+    assert written.name.endswith("-render.prof")
+    assert "busy_worker" in profiled_functions(written)
+
+
+@pytest.mark.mock
+def test_sampling_writes_collapsed_stacks_per_phase(tmp_path, session):
+    session(profiling.SAMPLING)
+    with profiling.phase("pull"):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(profiling.wrap(sleepy_worker)).result()
+
+    [written] = profiling.stop()
+
+    assert written.suffix == ".collapsed"
+    stacks = written.read_text().splitlines()
+    assert stacks
+    assert all(line.startswith("pull;") for line in stacks)
+    assert any("sleepy_worker" in line for line in stacks)
+
+
+@pytest.mark.mock
+def test_profiles_of_a_sync_run_are_split_by_phase(tmp_path, monkeypatch, session):
+    install_fake_rmapi(tmp_path, monkeypatch)
+    with ZoteroStandIn() as server:
+        entry = server.add_item("paper", tags=("to_sync",))
+        server.add_item("paper.pdf", parent=entry, content=b"%PDF")
+        _, rmapi_config = make_tablet(tmp_path, "tablet")
+        profile = make_profile(tmp_path, "alice", server, rmapi_config)
+
+        session(profiling.DETERMINISTIC)
+        assert run_profiles([profile], ["push", "pull"]) == {"alice": True}
+        written = {
+            path.name.rsplit("-", 1)[1]: path
+            for path in profiling.stop()
+            # From Python 3.12 the worker threads are sampled into a .collapsed file
+            if path.suffix == ".prof"
+        }
+
+    assert set(written) == {"push.prof", "pull.prof"}
+    assert "upload_attachments_to_rm" in profiled_functions(written["push.prof"])
+    assert "plan_pull" in profiled_functions(written["pull.prof"])
@@ -0,0 +1,63 @@
+"""
+Tests for the in-memory snapshot of the reMarkable `Zotero/` subtree.
+"""
+
+import pytest
+
+from zrm.adapters.RemoteSnapshot import RemoteSnapshot
+from zrm.rmapi_shim import parse_find_output
+
+FIND_OUTPUT = """[d] /Zotero
+[d] /Zotero/read
+[f] /Zotero/read/On computable numbers
+[d] /Zotero/unread
+[f] /Zotero/unread/paper1
+[f] /Zotero/unread/paper2
+"""
+
+
+@pytest.mark.mock
+def test_parse_find_output():
+    entries = parse_find_output(FIND_OUTPUT)
+    assert ("/Zotero/read", True) in entries
+    assert ("/Zotero/read/On computable numbers", False) in entries
+    assert len(entries) == 6
+
+
+@pytest.mark.mock
+def test_snapshot_lookups_and_listings():
+    snapshot = RemoteSnapshot.from_entries("Zotero", parse_find_output(FIND_OUTPUT))
+
+    assert snapshot.lookup("Zotero/read").is_folder
+    assert not snapshot.lookup("Zotero/read/On computable numbers").is_folder
+    assert snapshot.lookup("Zotero/missing") is None
+    assert sorted(snapshot.list_files("Zotero/unread")) == ["paper1", "paper2"]
+    # Folders are not listed as files
+    assert snapshot.list_files("Zotero") == []
+
+    node = snapshot.lookup("Zotero/unread/paper1")
+    assert node.parent.path == "Zotero/unread"
+    assert node.path == "Zotero/unread/paper1"
+
+
+@pytest.mark.mock
+def test_snapshot_accepts_relative_find_paths():
+    snapshot = RemoteSnapshot.from_entries(
+        "Zotero", [("read", True), ("read/paper", False)]
+    )
+    assert snapshot.list_files("Zotero/read") == ["paper"]
+
+
+@pytest.mark.mock
+def test_snapshot_mutations():
+    snapshot = RemoteSnapshot.from_entries("Zotero", parse_find_output(FIND_OUTPUT))
+
+    snapshot.add("Zotero/unread/paper3", is_folder=False)
+    assert "paper3" in snapshot.list_files("Zotero/unread")
+
+    assert snapshot.remove("Zotero/read/On computable numbers")
+    assert snapshot.list_files("Zotero/read") == []
+    assert not snapshot.remove("Zotero/read/On computable numbers")
+
+    assert snapshot.covers("Zotero/read/anything")
+    assert not snapshot.covers("Other/read")
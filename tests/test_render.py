@@ -0,0 +1,198 @@
+"""
+Tests for the remarks server render backend against local stand-in servers.
+"""
+
+import io
+import threading
+import time
+import zipfile
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from zrm.render import InProcessRenderer, RemarksServerRenderer, render_inputs
+
+
+def make_stand_in(healthy=True, delay=0.0, health_delay=0.0):
+    """A local HTTP server that answers like `remarks.server`.
+
+    Documents containing `broken` are answered with a 500.
+    """
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(health_delay)
+            if self.path == "/health" and healthy:
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b'{"status": "healthy"}')
+            else:
+                self.send_response(503)
+                self.end_headers()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            requests.append(body)
+            time.sleep(delay)
+            if b"broken" in body:
+                self.send_response(500)
+                self.end_headers()
+                return
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, "w") as zf:
+                zf.writestr("paper _remarks.pdf", b"%PDF annotated")
+                zf.writestr("paper _obsidian.md", b"# notes")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.end_headers()
+            self.wfile.write(archive.getvalue())
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", requests
+
+
+@pytest.fixture
+def rmn(tmp_path):
+    path = tmp_path / "process_me.rmn"
+    path.write_bytes(b"rmn content")
+    return path
+
+
+@pytest.mark.mock
+def test_renders_through_server(rmn, tmp_path):
+    server, url, requests = make_stand_in()
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+
+    rendered = RemarksServerRenderer([url]).render(rmn, output_dir)
+
+    assert rendered.name == "paper"
+    assert rendered.pdf == output_dir / "paper _remarks.pdf"
+    assert rendered.markdown.read_bytes() == b"# notes"
+    assert b"rmn content" in requests[0]
+    server.shutdown()
+
+
+@pytest.mark.mock
+def test_skips_unhealthy_and_balances_load(rmn, tmp_path):
+    sick, sick_url, sick_requests = make_stand_in(healthy=False)
+    first, first_url, first_requests = make_stand_in(delay=0.2)
+    second, second_url, second_requests = make_stand_in(delay=0.2)
+    renderer = RemarksServerRenderer([sick_url, first_url, second_url])
+
+    def render(i):
+        output_dir = tmp_path / f"out{i}"
+        output_dir.mkdir()
+        renderer.render(rmn, output_dir)
+
+    threads = [threading.Thread(target=render, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not sick_requests
+    assert len(first_requests) == 2
+    assert len(second_requests) == 2
+    for server in (sick, first, second):
+        server.shutdown()
+
+
+@pytest.mark.mock
+def test_times_out_and_fails_over(rmn, tmp_path):
+    slow, slow_url, _ = make_stand_in(delay=2)
+    fast, fast_url, fast_requests = make_stand_in()
+    renderer = RemarksServerRenderer([slow_url, fast_url], timeout=0.5)
+
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    assert renderer.render(rmn, output_dir).pdf.name == "paper _remarks.pdf"
+    assert len(fast_requests) == 1
+    assert not renderer.workers[0].healthy
+    for server in (slow, fast):
+        server.shutdown()
+
+
+@pytest.mark.mock
+def test_document_a_server_cannot_render_fails_alone(rmn, tmp_path):
+    first, first_url, first_requests = make_stand_in()
+    second, second_url, second_requests = make_stand_in()
+    renderer = RemarksServerRenderer([first_url, second_url])
+    broken = tmp_path / "broken.rmn"
+    broken.write_bytes(b"broken rmn content")
+
+    with pytest.raises(RuntimeError, match="could not render broken.rmn"):
+        renderer.render(broken, tmp_path)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    assert renderer.render(rmn, output_dir).name == "paper"
+
+    # The broken document was not tried on every server, and both stay in use
+    assert len(first_requests) + len(second_requests) == 2
+    assert all(worker.healthy for worker in renderer.workers)
+    first.shutdown()
+    second.shutdown()
+
+
+@pytest.mark.mock
+def test_health_checks_run_outside_the_lock(rmn, tmp_path):
+    slow, slow_url, _ = make_stand_in(health_delay=0.5)
+    renderer = RemarksServerRenderer([slow_url])
+    rendering = threading.Thread(target=renderer.render, args=(rmn, tmp_path))
+    rendering.start()
+    time.sleep(0.2)
+
+    # Other renders can pick a worker while this health check is answered
+    assert renderer._lock.acquire(timeout=0.1)
+    renderer._lock.release()
+    rendering.join()
+    slow.shutdown()
+
+
+@pytest.mark.mock
+def test_no_healthy_server_raises(rmn, tmp_path):
+    sick, sick_url, _ = make_stand_in(healthy=False)
+    with pytest.raises(RuntimeError):
+        RemarksServerRenderer([sick_url]).render(rmn, tmp_path)
+    sick.shutdown()
+
+
+@pytest.mark.mock
+def test_in_process_renderer_returns_output_paths(tmp_path):
+    rendered = InProcessRenderer().render(
+        Path("tests/on computable numbers - RMPP - highlighter tool v6.rmn"), tmp_path
+    )
+    assert rendered.name == "On computable numbers"
+    assert rendered.pdf == tmp_path / "On computable numbers _remarks.pdf"
+    assert rendered.markdown == tmp_path / "On computable numbers _obsidian.md"
+    assert rendered.pdf.is_file()
+
+
+@pytest.mark.mock
+def test_in_process_renderer_rejects_documents_without_metadata(tmp_path):
+    empty = tmp_path / "empty.rmn"
+    with zipfile.ZipFile(empty, "w") as zf:
+        zf.writestr("unrelated.txt", b"")
+    with pytest.raises(RuntimeError):
+        InProcessRenderer().render(empty, tmp_path)
+
+
+def test_render_inputs_leave_thumbnails_and_caches_packed():
+    names = [
+        "/doc.metadata",
+        "/doc.content",
+        "/doc.pagedata",
+        "/doc.pdf",
+        "/doc/page.rm",
+        "/doc.highlights/page.json",
+        "/doc.thumbnails/page.png",
+        "/doc.textconversion/page.md",
+        "/other.pdf",
+    ]
+    assert render_inputs(names, "/doc.metadata") == names[:6]
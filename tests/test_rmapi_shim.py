@@ -0,0 +1,256 @@
+"""
+Tests for parsing rmapi's output, and for the real ReMarkableAPI against a fake rmapi.
+"""
+
+import time
+
+import pytest
+
+from tests.fake_rmapi import install_fake_rmapi, read_log
+from zrm import rmapi_shim
+from zrm.adapters.ReMarkableAPI import ReMarkableAPI
+from zrm.rmapi_policy import (
+    DEFAULT_TIMEOUTS,
+    MIN_SAMPLES,
+    PERMANENT,
+    TIMEOUT,
+    TRANSIENT,
+    CallStats,
+    RmapiPolicy,
+    classify_failure,
+)
+from zrm.rmapi_shim import parse_mput_output
+
+MPUT_OUTPUT = """Starting mput...
+ uploading: [paper1.pdf]... complete
+ uploading: [paper2.pdf]...
+ paper3.pdf: document already exists, skipping
+"""
+
+
+@pytest.mark.mock
+def test_parse_mput_output():
+    results = parse_mput_output(
+        MPUT_OUTPUT, ["paper1.pdf", "paper2.pdf", "paper3.pdf"]
+    )
+    assert results == {"paper1.pdf": True, "paper2.pdf": False, "paper3.pdf": False}
+
+
+@pytest.fixture
+def tablet(tmp_path, monkeypatch):
+    root = install_fake_rmapi(tmp_path, monkeypatch)
+    (root / "Zotero" / "unread").mkdir(parents=True)
+    (root / "Zotero" / "read").mkdir()
+    return root
+
+
+@pytest.mark.mock
+def test_upload_overwrites_existing_documents(tablet, tmp_path):
+    rm = ReMarkableAPI()
+
+    assert rm.upload_file("Zotero/unread/paper.pdf", b"first")
+    assert rm.upload_file("Zotero/unread/paper.pdf", b"second")
+
+    assert (tablet / "Zotero" / "unread" / "paper").read_bytes() == b"second"
+    commands = [call[0] for call in read_log(tmp_path)]
+    # The second put hits "entry already exists" and is retried after an rm
+    assert commands == ["ls", "put", "put", "rm", "put"]
+
+
+@pytest.mark.mock
+def test_snapshot_answers_lookups_without_rmapi_calls(tablet, tmp_path):
+    (tablet / "Zotero" / "read" / "paper").write_bytes(b"rmdoc")
+    rm = ReMarkableAPI()
+    rm.snapshot("Zotero")
+    calls_after_snapshot = len(read_log(tmp_path))
+
+    assert rm.is_folder("Zotero/read")
+    assert rm.is_file("Zotero/read/paper.pdf")
+    assert rm.list_children("Zotero/read") == ["paper"]
+    assert not rm.file_or_folder_exists("Zotero/read/missing.pdf")
+    assert len(read_log(tmp_path)) == calls_after_snapshot
+
+
+@pytest.mark.mock
+def test_batched_upload_and_download(tablet, tmp_path):
+    rm = ReMarkableAPI()
+    (tablet / "Zotero" / "unread" / "paper2").write_bytes(b"already there")
+
+    results = rm.upload_files(
+        "Zotero/unread", [(f"paper{i}.pdf", f"pdf {i}".encode()) for i in range(5)]
+    )
+    assert all(results.values())
+    assert (tablet / "Zotero" / "unread" / "paper2").read_bytes() == b"pdf 2"
+
+    names = [f"paper{i}" for i in range(5)]
+    downloaded = {
+        name: path.read_bytes() for name, path in rm.download_files("Zotero/unread", names)
+    }
+    assert downloaded == {f"paper{i}": f"pdf {i}".encode() for i in range(5)}
+    # One mput plus the retried existing document, and a single mget
+    commands = [call[0] for call in read_log(tmp_path)]
+    assert commands.count("mput") == 1
+    assert commands.count("mget") == 1
+    assert "get" not in commands
+
+
+@pytest.mark.mock
+def test_failed_transfers_are_retried_one_by_one(tmp_path, monkeypatch):
+    root = install_fake_rmapi(tmp_path, monkeypatch, latency=0.01, fail="mget,put:1")
+    (root / "Zotero" / "read").mkdir(parents=True)
+    (root / "Zotero" / "read" / "paper").write_bytes(b"rmdoc")
+    rm = ReMarkableAPI()
+
+    assert not rm.upload_file("Zotero/read/other.pdf", b"pdf")
+    assert rm.upload_file("Zotero/read/other.pdf", b"pdf")
+    assert [name for name, _ in rm.download_files("Zotero/read", ["paper"])] == [
+        "paper"
+    ]
+    assert ["get", "Zotero/read/paper"] in read_log(tmp_path)
+
+
+@pytest.mark.mock
+def test_missing_folders_and_documents(tablet):
+    rm = ReMarkableAPI()
+
+    assert not rm.is_folder("Zotero/missing")
+    assert not rm.upload_file("Zotero/missing/paper.pdf", b"pdf")
+    assert not rm.delete_file_or_folder("Zotero/unread/missing")
+    with pytest.raises(FileNotFoundError):
+        rm.get_file_content("Zotero/unread/missing")
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Killed children of a killed process may linger as zombies
+            return f.read().rsplit(")", 1)[1].split()[0] not in "ZX"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    fresh = CallStats()
+    monkeypatch.setattr(rmapi_shim, "stats", fresh)
+    return fresh
+
+
+def quick_policy(**timeouts):
+    return RmapiPolicy(timeouts={**DEFAULT_TIMEOUTS, **timeouts}, backoff=0)
+
+
+@pytest.mark.mock
+def test_hung_commands_are_killed_with_their_children_and_retried(
+    tmp_path, monkeypatch, stats
+):
+    root = install_fake_rmapi(tmp_path, monkeypatch, hang="get:1")
+    (root / "paper").write_bytes(b"rmdoc")
+    rm = ReMarkableAPI(policy=quick_policy(get=1))
+
+    assert rm.get_file_content("paper") == b"rmdoc"
+
+    [pid] = (tmp_path / "rmapi.pids").read_text().split()
+    assert not is_running(int(pid))
+    assert [call[0] for call in read_log(tmp_path)].count("get") == 2
+    assert stats.events("get")[TIMEOUT] == 1
+    assert stats.events("get")["retried"] == 1
+
+
+@pytest.mark.mock
+def test_timed_out_uploads_are_not_retried(tmp_path, monkeypatch, stats):
+    root = install_fake_rmapi(tmp_path, monkeypatch, hang="put:1")
+    (root / "Zotero").mkdir()
+    rm = ReMarkableAPI(policy=quick_policy(put=1))
+
+    # The upload may have gone through before it hung, so only the caller
+    # can tell whether to try again
+    assert not rm.upload_file("Zotero/paper.pdf", b"pdf")
+    assert [call[0] for call in read_log(tmp_path)].count("put") == 1
+
+
+@pytest.mark.mock
+def test_transient_failures_are_retried(tmp_path, monkeypatch, stats):
+    root = install_fake_rmapi(
+        tmp_path,
+        monkeypatch,
+        fail="put:2",
+        error="Put https://internal.cloud.remarkable.com: dial tcp: i/o timeout",
+    )
+    (root / "Zotero").mkdir()
+    rm = ReMarkableAPI(policy=quick_policy())
+
+    assert rm.upload_file("Zotero/paper.pdf", b"pdf")
+    assert (root / "Zotero" / "paper").read_bytes() == b"pdf"
+    assert stats.events("put")[TRANSIENT] == 2
+
+
+@pytest.mark.mock
+def test_slow_reads_are_hedged(tmp_path, monkeypatch, stats):
+    root = install_fake_rmapi(tmp_path, monkeypatch, hang="get:1")
+    (root / "paper").write_bytes(b"rmdoc")
+    for _ in range(MIN_SAMPLES):
+        stats.record("get", 0.2)
+    rm = ReMarkableAPI(policy=RmapiPolicy(hedge=True))
+
+    started = time.monotonic()
+    assert rm.get_file_content("paper") == b"rmdoc"
+
+    # The hung call is abandoned long before its timeout
+    assert time.monotonic() - started < 10
+    assert stats.events("get")["hedged"] == 1
+    assert stats.events("get")["hedge won"] == 1
+    [summary] = [line for line in stats.summary() if line.startswith("rmapi get")]
+    assert "1 hedged, 1 won by the hedge" in summary
+
+
+@pytest.mark.mock
+def test_hung_folder_download_falls_back_to_single_downloads(
+    tmp_path, monkeypatch, stats
+):
+    root = install_fake_rmapi(tmp_path, monkeypatch, hang="mget")
+    (root / "Zotero" / "read").mkdir(parents=True)
+    (root / "Zotero" / "read" / "paper").write_bytes(b"rmdoc")
+    rm = ReMarkableAPI(policy=quick_policy(mget=1))
+
+    downloads = {
+        name: path.read_bytes()
+        for name, path in rm.download_files("Zotero/read", ["paper"], 0.05)
+    }
+
+    assert downloads == {"paper": b"rmdoc"}
+    assert stats.events("mget")[TIMEOUT] == 1
+
+
+@pytest.mark.mock
+def test_abandoned_folder_download_stops_mget(tmp_path, monkeypatch, stats):
+    root = install_fake_rmapi(tmp_path, monkeypatch, latency=1)
+    (root / "Zotero" / "read").mkdir(parents=True)
+    names = [f"paper{i}" for i in range(5)]
+    for name in names:
+        (root / "Zotero" / "read" / name).write_bytes(b"rmdoc")
+    processes = []
+    start_folder_download = rmapi_shim.start_folder_download
+
+    def remember_process(*args):
+        processes.append(start_folder_download(*args))
+        return processes[-1]
+
+    monkeypatch.setattr(rmapi_shim, "start_folder_download", remember_process)
+    rm = ReMarkableAPI(policy=quick_policy())
+
+    downloads = rm.download_files("Zotero/read", names, 0.05)
+    assert next(downloads)[0] == "paper0"
+    downloads.close()
+
+    [process] = processes
+    assert process.poll() is not None
+    assert not is_running(process.pid)
+
+
+@pytest.mark.mock
+def test_classify_failure():
+    assert classify_failure("Error: 503 Service Unavailable") == TRANSIENT
+    assert classify_failure("read tcp: connection reset by peer") == TRANSIENT
+    assert classify_failure("Error: entry already exists") == PERMANENT
+    assert classify_failure("Error: directory doesn't exist: Zotero") == PERMANENT
@@ -0,0 +1,121 @@
+"""
+Tests for the order in which sync work is done.
+"""
+
+import time
+
+import pytest
+
+from tests.mocks import MockReMarkableAPI, MockZoteroAPI
+from zrm.adapters.TreeNode import TreeNode
+from zrm.config_functions import schedule_from_dict
+from zrm.scheduling import OLDEST_FIRST, SchedulePolicy
+from zrm.sync_plan import (
+    PlannedRender,
+    SyncOptions,
+    _downloads_by_priority,
+    execute_plan,
+    plan_push,
+)
+
+FOLDERS = {"unread": "unread", "read": "read"}
+
+
+def add_paper(zotero, title, size, tags=("to_sync",), added=""):
+    handle = zotero.create_item([title])
+    zotero._item_data(handle)["dateAdded"] = added
+    zotero.create_file(handle, f"{title}.pdf", b"x" * size)
+    zotero.add_tags(handle, list(tags))
+    return handle
+
+
+@pytest.mark.mock
+def test_push_plans_urgent_then_smallest_first():
+    zotero = MockZoteroAPI()
+    add_paper(zotero, "textbook", 3000)
+    add_paper(zotero, "paper", 10)
+    urgent = add_paper(zotero, "deadline", 500, tags=("to_sync_urgent",))
+
+    plan = plan_push(zotero, FOLDERS)
+
+    assert [upload.attachment.name for upload in plan.uploads] == [
+        "deadline.pdf",
+        "paper.pdf",
+        "textbook.pdf",
+    ]
+    [change] = [change for change in plan.tag_changes if change.handle == urgent]
+    assert change.remove == ["to_sync", "to_sync_urgent"]
+
+
+@pytest.mark.mock
+def test_push_can_go_oldest_first():
+    zotero = MockZoteroAPI()
+    add_paper(zotero, "new", 10, added="2024-05-01T00:00:00Z")
+    add_paper(zotero, "old", 3000, added="2019-01-01T00:00:00Z")
+    add_paper(zotero, "undated", 10)
+
+    plan = plan_push(zotero, FOLDERS, SchedulePolicy(order=OLDEST_FIRST))
+
+    assert [upload.attachment.name for upload in plan.uploads] == [
+        "old.pdf",
+        "new.pdf",
+        "undated.pdf",
+    ]
+
+
+@pytest.mark.mock
+def test_large_files_are_transferred_after_the_rest():
+    zotero = MockZoteroAPI()
+    rm = MockReMarkableAPI(files={}, folders={"", "Zotero", "Zotero/unread"})
+    add_paper(zotero, "textbook", 3000)
+    add_paper(zotero, "paper", 10)
+    add_paper(zotero, "deadline", 500, tags=("to_sync_urgent",))
+    schedule = SchedulePolicy(large_file_bytes=1000)
+
+    execute_plan(
+        plan_push(zotero, FOLDERS, schedule),
+        zotero,
+        rm,
+        SyncOptions(schedule=schedule),
+    )
+
+    # One batch per wave, so the small paper is on the tablet before the
+    # textbook has even been downloaded
+    assert rm.calls["upload_files"] == 3
+    assert list(rm._files) == [
+        "Zotero/unread/deadline.pdf",
+        "Zotero/unread/paper.pdf",
+        "Zotero/unread/textbook.pdf",
+    ]
+
+
+@pytest.mark.mock
+def test_waiting_downloads_are_rendered_most_important_first():
+    sizes = {"huge": 5000, "large": 3000, "small": 10, "tiny": 1}
+    rm = MockReMarkableAPI(
+        files={f"Zotero/read/{name}": b"rmdoc" for name in sizes},
+        folders={"", "Zotero", "Zotero/read"},
+    )
+    node = TreeNode(tags=(), handle="", type="", name="", path="")
+    to_download = {
+        name: PlannedRender(name, f"Zotero/read/{name}", node, node, size=size)
+        for name, size in sizes.items()
+    }
+
+    downloads = _downloads_by_priority(rm, "Zotero/read", to_download, SyncOptions())
+    rendered = [next(downloads)[0].rm_name]
+    # Rendering the first document takes long enough for the rest to arrive
+    time.sleep(0.2)
+    rendered += [render.rm_name for render, *_ in downloads]
+
+    assert sorted(rendered) == sorted(sizes)
+    assert rendered[1:] == sorted(rendered[1:], key=sizes.get)
+
+
+def test_schedule_settings_in_the_config():
+    assert schedule_from_dict({}) == SchedulePolicy()
+    assert schedule_from_dict(
+        {"URGENT_TAGS": "now", "SYNC_ORDER": "age", "LARGE_FILE_MB": 1}
+    ) == SchedulePolicy(urgent_tags=("now",), order="age", large_file_bytes=2**20)
+    with pytest.raises(ValueError):
+        schedule_from_dict({"SYNC_ORDER": "random"})
@@ -0,0 +1,184 @@
+"""
+Tests for making PDFs smaller before they are pushed to the tablet.
+"""
+
+import hashlib
+import io
+import random
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pymupdf
+import pytest
+
+from tests.mocks import MockReMarkableAPI, MockZoteroAPI
+from zrm.render import RenderBackend, RenderedDocument
+from zrm.slimming import TABLET_DPI, PdfSlimmer, restore_original
+from zrm.sync_functions import upload_attachments_to_rm
+from zrm.sync_plan import SyncOptions
+from zrm.zotero_rm_bridge import rmToZot
+
+
+def scanned_pdf(pixels: int = 2000, **save_options) -> bytes:
+    """A one page PDF holding a noisy grey image printed at three inches square."""
+    noise = random.Random(0).randbytes(pixels * pixels)
+    image = pymupdf.Pixmap(pymupdf.csGRAY, pixels, pixels, noise, False)
+    with pymupdf.open() as doc:
+        page = doc.new_page()
+        page.insert_image(pymupdf.Rect(72, 72, 288, 288), pixmap=image)
+        return doc.tobytes(**save_options)
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__(max_workers=1)
+        self.submitted = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(fn, *args, **kwargs)
+
+
+@pytest.mark.mock
+def test_images_are_downsampled_to_the_tablet_resolution(tmp_path):
+    original = scanned_pdf()
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        slimmed = PdfSlimmer(tmp_path, executor).slim(original, "scan.pdf")
+
+    assert len(slimmed) < len(original) / 3
+    with pymupdf.open(stream=slimmed) as doc:
+        [image] = doc[0].get_images()
+        width = image[2]
+    assert 3 * TABLET_DPI <= width < 2000
+    md5 = hashlib.md5(original).hexdigest()
+    assert (tmp_path / f"{md5}.pdf").read_bytes() == slimmed
+
+
+@pytest.mark.mock
+def test_results_are_cached_by_md5(tmp_path):
+    executor = CountingExecutor()
+    large = scanned_pdf()
+    small = scanned_pdf(pixels=100, garbage=3, deflate=True, use_objstms=1)
+    slimmer = PdfSlimmer(tmp_path, executor)
+
+    first = slimmer.slim(large)
+    assert slimmer.slim(large) == first
+    # A PDF that cannot be made smaller is uploaded as it is, and not tried again
+    assert slimmer.slim(small) == small
+    assert slimmer.slim(small) == small
+    assert executor.submitted == 2
+    executor.shutdown()
+
+
+@pytest.mark.mock
+def test_broken_pdfs_are_uploaded_unchanged(tmp_path):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        slimmer = PdfSlimmer(tmp_path, executor)
+        assert slimmer.slim(b"not a pdf") == b"not a pdf"
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.mock
+def test_push_uploads_slimmed_pdfs(tmp_path):
+    zotero = MockZoteroAPI()
+    rm = MockReMarkableAPI(files={}, folders={"", "Zotero", "Zotero/unread"})
+    item = zotero.create_item(["Scans"])
+    original = scanned_pdf()
+    handle = zotero.create_file(item, "scan.pdf", original)
+    zotero._item_data(handle)["md5"] = hashlib.md5(original).hexdigest()
+    attachments = zotero.list_children(item)
+    executor = CountingExecutor()
+    slimmer = PdfSlimmer(tmp_path, executor)
+
+    results = upload_attachments_to_rm(
+        attachments, zotero, rm, "Zotero/unread", slimmer=slimmer
+    )
+
+    assert results == {handle: True}
+    assert len(rm._files["Zotero/unread/scan.pdf"]) < len(original) / 3
+
+    # Pushing the same file again needs neither a download nor slimming
+    rm.delete_file_or_folder("Zotero/unread/scan.pdf")
+    upload_attachments_to_rm(attachments, zotero, rm, "Zotero/unread", slimmer=slimmer)
+    assert zotero.calls["get_file_content"] == 1
+    assert executor.submitted == 1
+    executor.shutdown()
+
+
+def tablet_document(pdf: bytes) -> bytes:
+    """A downloaded document holding `pdf`, with one annotated page."""
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("/doc.metadata", '{"visibleName": "scan"}')
+        zf.writestr("/doc.content", "{}")
+        zf.writestr("/doc/page.rm", b"strokes")
+        zf.writestr("/doc.pdf", pdf)
+    return archive.getvalue()
+
+
+def slim_into(tmp_path, original: bytes) -> bytes:
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return PdfSlimmer(tmp_path, executor).slim(original)
+
+
+@pytest.mark.mock
+def test_original_is_restored_into_documents_holding_the_slimmed_copy(tmp_path):
+    original = scanned_pdf()
+    md5 = hashlib.md5(original).hexdigest()
+    slimmed = slim_into(tmp_path / "slimmed", original)
+    rmn = tmp_path / "process_me.rmn"
+
+    rmn.write_bytes(tablet_document(slimmed))
+    assert restore_original(rmn, tmp_path / "slimmed", md5, lambda: original)
+    with zipfile.ZipFile(rmn) as zf:
+        assert zf.read("/doc.pdf") == original
+        assert zf.read("/doc/page.rm") == b"strokes"
+
+    # Documents holding some other PDF are rendered as they are
+    other = scanned_pdf(pixels=100)
+    rmn.write_bytes(tablet_document(other))
+    assert not restore_original(rmn, tmp_path / "slimmed", md5, lambda: original)
+    # And so are documents whose original changed in Zotero since
+    rmn.write_bytes(tablet_document(slimmed))
+    assert not restore_original(rmn, tmp_path / "slimmed", md5, lambda: other)
+    with zipfile.ZipFile(rmn) as zf:
+        assert zf.read("/doc.pdf") == slimmed
+
+
+class RecordingRenderer(RenderBackend):
+    """Records the PDF of each document it is given, and renders it unchanged."""
+
+    def __init__(self):
+        self.pdfs = []
+
+    def render(self, rmn_path, output_dir):
+        with zipfile.ZipFile(rmn_path) as zf:
+            self.pdfs.append(zf.read("/doc.pdf"))
+        pdf = output_dir / "scan _remarks.pdf"
+        pdf.write_bytes(self.pdfs[-1])
+        markdown = output_dir / "scan _obsidian.md"
+        markdown.write_text("# scan")
+        return RenderedDocument("scan", pdf, markdown)
+
+
+@pytest.mark.mock
+def test_pull_renders_onto_the_original_pdf(tmp_path):
+    zotero = MockZoteroAPI()
+    rm = MockReMarkableAPI(files={}, folders={"", "Zotero", "Zotero/read"})
+    item = zotero.create_item(["scan"])
+    zotero.add_tags(item, ["synced"])
+    original = scanned_pdf()
+    handle = zotero.create_file(item, "scan.pdf", original)
+    slimmed = slim_into(tmp_path / "slimmed", original)
+    rm.upload_file("Zotero/read/scan.pdf", tablet_document(slimmed))
+    renderer = RecordingRenderer()
+
+    assert rmToZot(
+        zotero,
+        rm,
+        "read",
+        options=SyncOptions(renderer=renderer, slimmed_dir=tmp_path / "slimmed"),
+    )
+
+    assert renderer.pdfs == [original]
+    assert zotero.get_file_content(handle) == original
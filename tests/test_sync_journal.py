@@ -0,0 +1,51 @@
+"""
+Tests for the write-ahead sync journal.
+"""
+
+import pytest
+
+from zrm.sync_journal import SyncJournal
+
+
+@pytest.mark.mock
+def test_journal_survives_reopening(tmp_path):
+    journal = SyncJournal(tmp_path / "journal.jsonl")
+    journal.record("pull:Zotero/read/paper", "downloaded", rmn="/tmp/paper.rmn")
+    journal.record("pull:Zotero/read/paper", "rendered", pdf="/tmp/paper.pdf")
+    journal.record("push:ITEM", "uploaded:ATTACHMENT")
+    journal.finish("push:ITEM")
+    journal.close()
+
+    reopened = SyncJournal(tmp_path / "journal.jsonl")
+    assert reopened.completed("pull:Zotero/read/paper", "rendered")
+    assert reopened.data("pull:Zotero/read/paper", "downloaded") == {
+        "rmn": "/tmp/paper.rmn"
+    }
+    assert not reopened.completed("pull:Zotero/read/paper", "attached")
+    # Finished documents are forgotten and compacted away
+    assert not reopened.completed("push:ITEM", "uploaded:ATTACHMENT")
+    assert "push:ITEM" not in (tmp_path / "journal.jsonl").read_text()
+    reopened.close()
+
+
+@pytest.mark.mock
+def test_journal_ignores_torn_last_line(tmp_path):
+    journal = SyncJournal(tmp_path / "journal.jsonl")
+    journal.record("push:ITEM", "uploaded:ATTACHMENT")
+    journal.close()
+    with open(tmp_path / "journal.jsonl", "a") as f:
+        f.write('{"document": "push:ITEM", "st')
+
+    reopened = SyncJournal(tmp_path / "journal.jsonl")
+    assert reopened.completed("push:ITEM", "uploaded:ATTACHMENT")
+    reopened.close()
+
+
+@pytest.mark.mock
+def test_finish_removes_work_dir(tmp_path):
+    journal = SyncJournal(tmp_path / "journal.jsonl")
+    work_dir = journal.work_dir_for("pull:Zotero/read/paper")
+    (work_dir / "process_me.rmn").write_bytes(b"zip")
+    journal.finish("pull:Zotero/read/paper")
+    assert not work_dir.exists()
+    journal.close()
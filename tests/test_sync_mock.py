@@ -3,10 +3,17 @@ Mock version of the sync round trip test using in-memory APIs.
 """
 
 import logging
+import threading
+import time
+from pathlib import Path
+
 import pytest
 
 from tests.mocks import MockZoteroAPI, MockReMarkableAPI
-from zrm.zotero_rm_bridge import zotToRm, rmToZot
+from zrm.fingerprints import FingerprintStore, annotation_fingerprint
+from zrm.sync_journal import SyncJournal
+from zrm.sync_plan import SyncOptions, execute_plan, plan_push, plan_pull
+from zrm.zotero_rm_bridge import push_and_pull, zotToRm, rmToZot
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -381,3 +388,457 @@ def test_rmToZot_deletes_files_after_successful_sync():
     # Verify read folder is empty (no files to process)
     files_in_read_folder = mock_rm.list_children("Zotero/read")
     assert len(files_in_read_folder) == 0
+
+
+@pytest.mark.mock
+def test_plan_push_does_not_mutate():
+    """Planning a push lists the uploads and tag changes without performing them."""
+    mock_zotero = MockZoteroAPI()
+    folders = {"unread": "unread", "read": "read"}
+
+    handle = mock_zotero.create_item(["Test Paper"])
+    mock_zotero.add_tags(handle, ["to_sync"])
+    mock_zotero.create_file(handle, "test.pdf", b"%PDF")
+    mock_zotero.create_file(handle, "notes.txt", b"not a pdf")
+
+    plan = plan_push(mock_zotero, folders)
+
+    assert [upload.attachment.name for upload in plan.uploads] == ["test.pdf"]
+    assert plan.uploads[0].remote_folder == "Zotero/unread"
+    assert plan.tag_changes[0].handle == handle
+    assert plan.estimated_requests() > 0
+    assert mock_zotero.has_tags(handle, ["to_sync"])
+    assert not mock_zotero.has_tags(handle, ["synced"])
+
+
+def executed_calls(mock_zotero, mock_rm) -> int:
+    # The mock's upload_files goes through upload_file, rmapi uploads them in one process
+    return (
+        sum(mock_zotero.calls.values())
+        + sum(mock_rm.calls.values())
+        - mock_rm.calls["upload_file"]
+    )
+
+
+@pytest.mark.mock
+def test_estimated_requests_match_the_calls_made():
+    """The plan's estimate is the number of adapter calls executing it makes."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    folders = {"unread": "unread", "read": "read"}
+    with open(VALID_RM_DOCUMENT, "rb") as f:
+        rmdoc_content = f.read()
+
+    handles = []
+    for i in range(3):
+        handle = mock_zotero.create_item([f"Paper {i}"])
+        mock_zotero.create_file(handle, f"Paper {i}.pdf", b"%PDF")
+        mock_zotero.add_tags(handle, ["to_sync"])
+        handles.append(handle)
+
+    push = plan_push(mock_zotero, folders)
+    mock_zotero.calls.clear()
+    mock_rm.calls.clear()
+    assert execute_plan(push, mock_zotero, mock_rm)
+    assert executed_calls(mock_zotero, mock_rm) == push.estimated_requests()
+
+    for i, handle in enumerate(handles):
+        mock_rm.upload_file(f"Zotero/read/Paper {i}.pdf", rmdoc_content)
+        # Some entries have notes from an earlier pull to replace
+        if i % 2:
+            mock_zotero.create_file(handle, f"Paper {i}.md", b"# Notes")
+
+    pull = plan_pull(mock_zotero, mock_rm, "read")
+    mock_zotero.calls.clear()
+    mock_rm.calls.clear()
+    assert execute_plan(pull, mock_zotero, mock_rm)
+    assert executed_calls(mock_zotero, mock_rm) == pull.estimated_requests()
+
+
+@pytest.mark.mock
+def test_dry_run_prints_plan_and_changes_nothing(capsys):
+    """Dry runs print the plan for both directions and leave both sides untouched."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    folders = {"unread": "unread", "read": "read"}
+
+    handle = mock_zotero.create_item(["On computable numbers"])
+    mock_zotero.add_tags(handle, ["to_sync", "synced"])
+    with open(TEST_PDF, "rb") as f:
+        mock_zotero.create_file(handle, "On computable numbers.pdf", f.read())
+    with open(VALID_RM_DOCUMENT, "rb") as f:
+        mock_rm.upload_file("Zotero/read/On computable numbers.pdf", f.read())
+
+    zotToRm(zotero=mock_zotero, rm=mock_rm, folders=folders, dry_run=True)
+    rmToZot(zotero=mock_zotero, rm=mock_rm, read_folder="read", dry_run=True)
+
+    output = capsys.readouterr().out
+    assert "upload  On computable numbers.pdf -> Zotero/unread" in output
+    assert "render  Zotero/read/On computable numbers.pdf" in output
+    assert "delete  Zotero/read/On computable numbers.pdf" in output
+    assert "Estimated requests" in output
+
+    assert not mock_rm.is_file("Zotero/unread/On computable numbers.pdf")
+    assert mock_rm.is_file("Zotero/read/On computable numbers.pdf")
+    assert mock_zotero.has_tags(handle, ["to_sync"])
+    assert len(mock_zotero.list_children(handle)) == 1
+
+
+@pytest.mark.mock
+def test_interrupted_pull_resumes_from_journal(tmp_path):
+    """A document attached by a crashed run is only deleted from the tablet, not re-rendered."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+
+    handle = mock_zotero.create_item(["On computable numbers"])
+    mock_zotero.add_tags(handle, ["synced"])
+    mock_zotero.create_file(handle, "On computable numbers.pdf", b"%PDF original")
+    with open(VALID_RM_DOCUMENT, "rb") as f:
+        mock_rm.upload_file("Zotero/read/On computable numbers.pdf", f.read())
+
+    journal = SyncJournal(tmp_path / "journal.jsonl")
+    journal.record(
+        "pull:Zotero/read/On computable numbers.pdf",
+        "attached",
+        fingerprint=annotation_fingerprint(Path(VALID_RM_DOCUMENT)),
+    )
+
+    rmToZot(
+        zotero=mock_zotero,
+        rm=mock_rm,
+        read_folder="read",
+        options=SyncOptions(journal=journal),
+    )
+
+    assert not mock_rm.is_file("Zotero/read/On computable numbers.pdf")
+    # Nothing was rendered or uploaded again
+    assert len(mock_zotero.list_children(handle)) == 1
+    assert not journal.completed(
+        "pull:Zotero/read/On computable numbers.pdf", "attached"
+    )
+    journal.close()
+
+
+@pytest.mark.mock
+def test_journal_steps_for_older_annotations_are_ignored(tmp_path):
+    """A document inked again after a crashed run attached it is synced again, not just deleted."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+
+    handle = mock_zotero.create_item(["On computable numbers"])
+    mock_zotero.add_tags(handle, ["synced"])
+    with open(TEST_PDF, "rb") as f:
+        pdf = mock_zotero.create_file(handle, "On computable numbers.pdf", f.read())
+    with open(VALID_RM_DOCUMENT, "rb") as f:
+        mock_rm.upload_file("Zotero/read/On computable numbers.pdf", f.read())
+
+    journal = SyncJournal(tmp_path / "journal.jsonl")
+    journal.record(
+        "pull:Zotero/read/On computable numbers.pdf",
+        "attached",
+        fingerprint="annotations before the crash",
+    )
+
+    rmToZot(
+        zotero=mock_zotero,
+        rm=mock_rm,
+        read_folder="read",
+        options=SyncOptions(journal=journal),
+    )
+
+    assert "annotated" in mock_zotero.get_tags(pdf)
+    assert not mock_rm.is_file("Zotero/read/On computable numbers.pdf")
+    journal.close()
+
+
+@pytest.mark.mock
+def test_journal_forgets_documents_that_are_gone(tmp_path):
+    """Steps of a document no longer in the read folder are dropped with their files."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    journal = SyncJournal(tmp_path / "journal.jsonl")
+    gone = "pull:Zotero/read/Deleted on the tablet.pdf"
+    work_dir = journal.work_dir_for(gone)
+    journal.record(gone, "rendered", pdf=str(work_dir / "rendered.pdf"))
+    journal.record("push:ITEM", "uploaded:ATTACHMENT")
+
+    rmToZot(
+        zotero=mock_zotero,
+        rm=mock_rm,
+        read_folder="read",
+        options=SyncOptions(journal=journal),
+    )
+
+    assert journal.documents() == ["push:ITEM"]
+    assert not work_dir.exists()
+    journal.close()
+
+
+@pytest.mark.mock
+def test_interrupted_push_does_not_reupload(tmp_path):
+    """Attachments a crashed run already uploaded are skipped, and the item still gets tagged."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    folders = {"unread": "unread", "read": "read"}
+
+    handle = mock_zotero.create_item(["Test Paper"])
+    mock_zotero.add_tags(handle, ["to_sync"])
+    done = mock_zotero.create_file(handle, "done.pdf", b"%PDF done")
+    mock_zotero.create_file(handle, "todo.pdf", b"%PDF todo")
+
+    journal = SyncJournal(tmp_path / "journal.jsonl")
+    journal.record(f"push:{handle}", f"uploaded:{done}")
+    mock_rm.upload_file("Zotero/unread/done.pdf", b"uploaded by the crashed run")
+
+    zotToRm(
+        zotero=mock_zotero,
+        rm=mock_rm,
+        folders=folders,
+        options=SyncOptions(journal=journal),
+    )
+
+    done_content = mock_rm.get_file_content("Zotero/unread/done.pdf")
+    assert done_content == b"uploaded by the crashed run"
+    assert mock_rm.is_file("Zotero/unread/todo.pdf")
+    assert mock_zotero.has_tags(handle, ["synced"])
+    journal.close()
+
+
+@pytest.mark.mock
+def test_upload_recorded_by_an_earlier_run_is_redone_if_the_file_is_gone(tmp_path):
+    """An item tagged again after its upload was deleted from the tablet is uploaded again."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    handle = mock_zotero.create_item(["Test Paper"])
+    mock_zotero.add_tags(handle, ["to_sync"])
+    attachment = mock_zotero.create_file(handle, "paper.pdf", b"%PDF")
+    journal = SyncJournal(tmp_path / "journal.jsonl")
+    journal.record(f"push:{handle}", f"uploaded:{attachment}")
+
+    zotToRm(
+        zotero=mock_zotero,
+        rm=mock_rm,
+        folders={"unread": "unread", "read": "read"},
+        options=SyncOptions(journal=journal),
+    )
+
+    assert mock_rm.is_file("Zotero/unread/paper.pdf")
+    assert mock_zotero.has_tags(handle, ["synced"])
+    journal.close()
+
+
+@pytest.mark.mock
+def test_journal_forgets_items_no_longer_tagged_for_pushing(tmp_path):
+    """Steps of an item whose tagging failed are dropped once it is no longer planned."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    handle = mock_zotero.create_item(["Test Paper"])
+    mock_zotero.add_tags(handle, ["to_sync"])
+    mock_zotero.create_file(handle, "paper.pdf", b"%PDF")
+    journal = SyncJournal(tmp_path / "journal.jsonl")
+    journal.record("push:UNTAGGED", "uploaded:ATTACHMENT")
+
+    zotToRm(
+        zotero=mock_zotero,
+        rm=mock_rm,
+        folders={"unread": "unread", "read": "read"},
+        options=SyncOptions(journal=journal),
+    )
+
+    assert journal.documents() == []
+    journal.close()
+
+
+@pytest.mark.mock
+def test_unchanged_annotations_are_not_rendered_again(tmp_path):
+    """Re-filing a document without new ink only removes it from the read folder."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    options = SyncOptions(fingerprints=FingerprintStore(tmp_path / "fingerprints.json"))
+
+    handle = mock_zotero.create_item(["On computable numbers"])
+    mock_zotero.add_tags(handle, ["synced"])
+    with open(TEST_PDF, "rb") as f:
+        mock_zotero.create_file(handle, "On computable numbers.pdf", f.read())
+    with open(VALID_RM_DOCUMENT, "rb") as f:
+        rmdoc_content = f.read()
+
+    mock_rm.upload_file("Zotero/read/On computable numbers.pdf", rmdoc_content)
+    rmToZot(zotero=mock_zotero, rm=mock_rm, read_folder="read", options=options)
+    md_attachment = next(
+        child
+        for child in mock_zotero.list_children(handle)
+        if child.name.endswith(".md")
+    )
+    first_md = mock_zotero.get_file_content(md_attachment.handle)
+
+    mock_rm.upload_file("Zotero/read/On computable numbers.pdf", rmdoc_content)
+    rmToZot(zotero=mock_zotero, rm=mock_rm, read_folder="read", options=options)
+
+    # The markdown embeds a timestamp, so an unchanged file proves nothing was re-rendered
+    assert mock_zotero.get_file_content(md_attachment.handle) == first_md
+    assert not mock_rm.is_file("Zotero/read/On computable numbers.pdf")
+
+
+@pytest.mark.mock
+def test_planning_scales_with_the_synced_items_not_the_library():
+    """On a 10 000 item library, planning touches each item to sync once."""
+    mock_zotero = MockZoteroAPI()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    folders = {"unread": "unread", "read": "read"}
+
+    for i in range(10_000):
+        handle = mock_zotero.create_item([f"Paper {i}"])
+        mock_zotero.create_file(handle, f"paper {i}.pdf", b"%PDF")
+        if i % 100 == 0:
+            mock_zotero.add_tags(handle, ["to_sync"])
+        if i % 1000 == 0:
+            mock_zotero.add_tags(handle, ["synced"])
+            mock_rm.upload_file(f"Zotero/read/paper {i}.pdf", b"rmdoc")
+    mock_zotero.calls.clear()
+    mock_rm.calls.clear()
+
+    push = plan_push(mock_zotero, folders)
+    assert len(push.uploads) == 100
+    # One query for to_sync and one for to_sync_urgent
+    assert mock_zotero.calls["find_nodes_with_tag"] == 2
+    assert mock_zotero.calls["list_children"] == 100
+
+    mock_zotero.calls.clear()
+    pull = plan_pull(mock_zotero, mock_rm, "read")
+    assert len(pull.renders) == 10
+    assert mock_rm.calls["list_children"] == 1
+    assert mock_zotero.calls["list_children"] <= 10
+
+
+@pytest.mark.mock
+def test_mock_latency_is_applied_per_call():
+    mock_rm = MockReMarkableAPI(files={}, folders={"", "Zotero"}, latency=0.02)
+
+    start = time.monotonic()
+    for _ in range(3):
+        mock_rm.is_folder("Zotero")
+
+    assert time.monotonic() - start >= 0.06
+    assert mock_rm.calls["is_folder"] == 3
+
+
+@pytest.mark.mock
+def test_both_directions_run_at_the_same_time():
+    class RendezvousZotero(MockZoteroAPI):
+        """Only lets the push and the pull plan once both are planning."""
+
+        def __init__(self):
+            super().__init__()
+            self.planning = threading.Barrier(2, timeout=5)
+
+        def find_nodes_with_tag(self, tag):
+            if tag in ("to_sync", "synced"):
+                self.planning.wait()
+            return super().find_nodes_with_tag(tag)
+
+    zotero = RendezvousZotero()
+    rm = MockReMarkableAPI(
+        files={"Zotero/read/Unknown.pdf": b"%PDF"},
+        folders={"", "Zotero", "Zotero/unread", "Zotero/read"},
+    )
+    handle = zotero.create_item(["Paper"])
+    zotero.create_file(handle, "Paper.pdf", b"%PDF")
+    zotero.add_tags(handle, ["to_sync"])
+
+    push_and_pull(zotero, rm, {"unread": "unread", "read": "read"})
+
+    assert zotero.has_tags(handle, ["synced"])
+    assert rm.is_file("Zotero/unread/Paper.pdf")
+
+
+@pytest.mark.mock
+def test_pull_with_a_failed_attach_is_not_remembered():
+    """A document that could not be attached keeps later pulls from being skipped."""
+
+    class FlakyZotero(MockZoteroAPI):
+        failing = True
+
+        def update_file_content(self, parent_handle, handle, content):
+            if self.failing:
+                raise ConnectionError("Zotero went away")
+            return super().update_file_content(parent_handle, handle, content)
+
+    class RememberingReMarkable(MockReMarkableAPI):
+        remembered = False
+
+        def unchanged_since_last_pull(self) -> bool:
+            return self.remembered
+
+        def remember_pull(self):
+            self.remembered = True
+
+    mock_zotero = FlakyZotero()
+    mock_rm = RememberingReMarkable(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    handle = mock_zotero.create_item(["On computable numbers"])
+    mock_zotero.add_tags(handle, ["synced"])
+    with open(TEST_PDF, "rb") as f:
+        pdf = mock_zotero.create_file(handle, "On computable numbers.pdf", f.read())
+    with open(VALID_RM_DOCUMENT, "rb") as f:
+        mock_rm.upload_file("Zotero/read/On computable numbers.pdf", f.read())
+
+    rmToZot(zotero=mock_zotero, rm=mock_rm, read_folder="read")
+
+    assert not mock_rm.remembered
+    assert mock_rm.is_file("Zotero/read/On computable numbers.pdf")
+
+    mock_zotero.failing = False
+    rmToZot(zotero=mock_zotero, rm=mock_rm, read_folder="read")
+
+    assert "annotated" in mock_zotero.get_tags(pdf)
+    assert not mock_rm.is_file("Zotero/read/On computable numbers.pdf")
+    assert mock_rm.remembered
+
+
+@pytest.mark.mock
+def test_failed_tag_change_fails_the_push(caplog):
+    """An item whose tags could not be changed is logged and reported as not synced."""
+
+    class ReadOnlyTagsZotero(MockZoteroAPI):
+        def remove_tags(self, handle, tags):
+            raise ConnectionError("Zotero went away")
+
+    mock_zotero = ReadOnlyTagsZotero()
+    mock_rm = MockReMarkableAPI(
+        files={}, folders={"", "Zotero", "Zotero/unread", "Zotero/read"}
+    )
+    handle = mock_zotero.create_item(["Test Paper"])
+    mock_zotero.add_tags(handle, ["to_sync"])
+    mock_zotero.create_file(handle, "test.pdf", b"%PDF")
+
+    assert not zotToRm(
+        zotero=mock_zotero, rm=mock_rm, folders={"unread": "unread", "read": "read"}
+    )
+    assert mock_rm.is_file("Zotero/unread/test.pdf")
+    assert any(
+        f"Could not remove to_sync from {handle}" in record.message
+        for record in caplog.records
+        if record.levelname == "ERROR"
+    )
@@ -0,0 +1,138 @@
+"""
+Memory benchmark for TreeNode on a large synthetic library, listed through ZoteroAPI.
+"""
+
+import gc
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+import pytest
+
+from zrm.adapters.TreeNode import TreeNode
+from zrm.adapters.ZoteroAPI import ZoteroAPI
+
+LIBRARY_SIZE = 20_000
+
+
+def zotero_item(i):
+    """An attachment as pyzotero returns it, freshly parsed from JSON."""
+    return {
+        "key": f"K{i:07d}",
+        "version": i,
+        "library": {"type": "group", "id": 1, "name": "Lab"},
+        "links": {"self": {"href": f"https://api.zotero.org/groups/1/items/K{i:07d}"}},
+        "meta": {"numChildren": 0},
+        "data": {
+            "key": f"K{i:07d}",
+            "version": i,
+            "parentItem": f"P{i:07d}",
+            "itemType": "attachment",
+            "linkMode": "imported_file",
+            "title": f"Paper {i}.pdf",
+            "filename": f"Paper {i}.pdf",
+            "contentType": "application/pdf",
+            "md5": f"{i:032x}",
+            "mtime": 1700000000000 + i,
+            "tags": [{"tag": "to_sync"}, {"tag": "synced"}],
+            "relations": {},
+            "dateAdded": "2024-01-01T00:00:00Z",
+            "dateModified": "2024-01-01T00:00:00Z",
+        },
+    }
+
+
+class SyntheticLibrary:
+    """Answers ZoteroAPI's listing calls like pyzotero, with fresh dicts every time."""
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def items(self, **kwargs):
+        return None
+
+    def everything(self, query):
+        return [zotero_item(i) for i in range(self.size)]
+
+
+def retained_bytes(build):
+    """Bytes still allocated by whatever `build` returns once its input is gone."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    retained = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del retained
+    return after - before
+
+
+@dataclass
+class BaselineTreeNode:
+    """TreeNode as it was before it was slimmed down, holding each item's data."""
+
+    tags: List[str]
+    handle: str
+    type: str
+    name: str
+    path: str
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_zotero_item(cls, zot_item: Dict[str, Any]):
+        data = zot_item.get("data", {})
+        return cls(
+            handle=data["key"],
+            name=data.get("filename", ""),
+            type=data.get("itemType", ""),
+            tags=data.get("tags", []),
+            path=data.get("path", ""),
+            metadata=data,
+        )
+
+
+@pytest.mark.mock
+def test_listing_a_large_library_takes_less_memory_than_before():
+    """A push and a pull list the library, keeping their nodes and the item cache."""
+    library = SyntheticLibrary(LIBRARY_SIZE)
+
+    def baseline():
+        listings = [library.everything(None) for _listing in ("push", "pull")]
+        return [
+            [BaselineTreeNode.from_zotero_item(item) for item in items]
+            for items in listings
+        ]
+
+    def current():
+        zotero = ZoteroAPI(library)
+        pushed = zotero.find_nodes_with_tag("to_sync")
+        pulled = zotero.find_nodes_with_tag("synced")
+        return zotero, pushed, pulled
+
+    before = retained_bytes(baseline)
+    after = retained_bytes(current)
+    print(
+        f"{LIBRARY_SIZE} items listed twice: {before / 2**20:.1f} MiB retained "
+        f"before, {after / 2**20:.1f} MiB with the item cache and slim nodes"
+    )
+    assert after < before * 0.9
+
+
+@pytest.mark.mock
+def test_nodes_share_tags_and_load_metadata_on_request():
+    items = {item["key"]: item for item in (zotero_item(i) for i in range(2))}
+    loaded = []
+
+    def load(key):
+        loaded.append(key)
+        return items[key]["data"]
+
+    first, second = [TreeNode.from_zotero_item(item, load) for item in items.values()]
+
+    assert first.tags == ("to_sync", "synced")
+    assert first.tags[0] is second.tags[0]
+    assert not hasattr(first, "__dict__")
+    assert loaded == []
+    assert first.load_metadata()["md5"] == f"{0:032x}"
+    assert loaded == [first.handle]
@@ -0,0 +1,426 @@
+"""
+Tests for ZoteroAPI's caching, using a recording stand-in for the pyzotero client.
+"""
+
+import gc
+import hashlib
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import httpx
+import pytest
+from pyzotero.zotero import Zotero
+
+from tests.mocks import MockReMarkableAPI
+from tests.zotero_server import ZoteroStandIn
+from zrm.adapters.TreeNode import TreeNode
+from zrm.adapters.ZoteroAPI import ZoteroAPI
+from zrm.sync_functions import attach_rendered_document
+from zrm.sync_plan import execute_plan, plan_push
+
+FOLDERS = {"unread": "unread", "read": "read"}
+
+
+class RecordingZotero:
+    """Answers the pyzotero calls ZoteroAPI makes from an in-memory library."""
+
+    def __init__(self, items):
+        self.library = {item["key"]: item for item in items}
+        self.calls = Counter()
+
+    def item(self, key):
+        self.calls["item"] += 1
+        return self.library[key]
+
+    def item_versions(self, **kwargs):
+        self.calls["item_versions"] += 1
+        return {key: item["version"] for key, item in self.library.items()}
+
+    def everything(self, query):
+        return query
+
+    def items(self, tag=None):
+        self.calls["items"] += 1
+        return [
+            item
+            for item in self.library.values()
+            if tag in [t["tag"] for t in item["data"]["tags"]]
+        ]
+
+
+def make_item(key, version, tags=()):
+    return {
+        "key": key,
+        "version": version,
+        "data": {"key": key, "tags": [{"tag": tag} for tag in tags]},
+    }
+
+
+@pytest.mark.mock
+def test_existence_is_answered_from_versions():
+    zot = RecordingZotero([make_item("A", 1), make_item("B", 2)])
+    api = ZoteroAPI(zot)
+    api.refresh_versions()
+
+    assert api.item_exists("A")
+    assert api.item_exists("B")
+    assert not api.item_exists("MISSING")
+    assert zot.calls == Counter({"item_versions": 1})
+
+
+@pytest.mark.mock
+def test_tagged_items_seed_the_cache():
+    zot = RecordingZotero([make_item("A", 1, ["to_sync"])])
+    api = ZoteroAPI(zot)
+
+    api.find_nodes_with_tag("to_sync")
+    assert api.item_exists("A")
+    assert api.get_tags("A") == ["to_sync"]
+    assert zot.calls["item"] == 0
+
+
+@pytest.mark.mock
+def test_persisted_items_are_reused_until_their_version_changes(tmp_path):
+    cache_path = tmp_path / "zotero_items.json"
+    zot = RecordingZotero([make_item("A", 1, ["synced"]), make_item("B", 1)])
+    first_run = ZoteroAPI(zot, cache_path=cache_path)
+    first_run.get_tags("A")
+    first_run.get_tags("B")
+    first_run.save_cache()
+
+    zot.library["B"] = make_item("B", 2, ["read"])
+    zot.calls.clear()
+
+    second_run = ZoteroAPI(zot, cache_path=cache_path)
+    second_run.refresh_versions()
+    assert second_run.get_tags("A") == ["synced"]
+    assert second_run.get_tags("B") == ["read"]
+    # Only the item whose version changed was fetched again
+    assert zot.calls == Counter({"item_versions": 1, "item": 1})
+
+
+
+@pytest.mark.mock
+def test_cache_keeps_only_what_the_sync_reads(tmp_path):
+    cache_path = tmp_path / "zotero_items.json"
+    item = make_item("A", 1, ["synced"])
+    item["library"] = {"type": "user", "id": 1}
+    item["meta"] = {"numChildren": 0}
+    item["links"] = {"self": {"href": "..."}, "enclosure": {"length": 1234}}
+    zot = RecordingZotero([item])
+    first_run = ZoteroAPI(zot, cache_path=cache_path)
+    first_run.find_nodes_with_tag("synced")
+    first_run.save_cache()
+
+    assert json.loads(cache_path.read_text()) == {
+        "A": {"key": "A", "version": 1, "data": item["data"], "size": 1234}
+    }
+    second_run = ZoteroAPI(zot, cache_path=cache_path)
+    second_run.refresh_versions()
+    assert second_run.attachment_size("A") == 1234
+    assert zot.calls["item"] == 0
+
+@pytest.mark.mock
+@pytest.mark.parametrize("content", ['{"A": {"key": "A", "vers', "[]", "\udcff"])
+def test_unreadable_cache_is_ignored(tmp_path, content):
+    cache_path = tmp_path / "zotero_items.json"
+    cache_path.write_text(content, errors="surrogateescape")
+    zot = RecordingZotero([make_item("A", 1, ["synced"])])
+
+    zotero = ZoteroAPI(zot, cache_path=cache_path)
+
+    assert zotero.get_tags("A") == ["synced"]
+    zotero.save_cache()
+    assert "A" in json.loads(cache_path.read_text())
+
+
+class FileUploadServer:
+    """Answers the item and file upload requests of the Zotero web API for one attachment."""
+
+    def __init__(self, key, content):
+        self.key = key
+        self.content = content
+        self.version = 1
+        self.requests = []
+
+    def item(self):
+        return {
+            "key": self.key,
+            "version": self.version,
+            "data": {
+                "key": self.key,
+                "version": self.version,
+                "itemType": "attachment",
+                "linkMode": "imported_file",
+                "title": "paper.pdf",
+                "filename": "paper.pdf",
+                "md5": hashlib.md5(self.content).hexdigest(),
+                "tags": [],
+            },
+        }
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append((request.method, request.url.path))
+        if request.url.path == f"/users/1/items/{self.key}":
+            return httpx.Response(200, json=self.item())
+        if request.url.path == f"/users/1/items/{self.key}/file":
+            form = parse_qs(request.content.decode())
+            if request.headers.get("If-Match") != hashlib.md5(self.content).hexdigest():
+                return httpx.Response(412)
+            if "upload" in form:
+                self.content = self.pending
+                self.version += 1
+                return httpx.Response(204)
+            return httpx.Response(
+                200,
+                json={
+                    "url": "https://storage.example/upload",
+                    "contentType": "application/pdf",
+                    "prefix": "<",
+                    "suffix": ">",
+                    "uploadKey": "upload-key",
+                },
+            )
+        if request.url.host == "storage.example":
+            self.storage_headers = request.headers
+            self.pending = request.content[1:-1]
+            return httpx.Response(201)
+        return httpx.Response(404)
+
+
+def api_for(server):
+    zot = Zotero("1", "user", "api-key")
+    zot.client = httpx.Client(
+        headers=zot.default_headers(), transport=httpx.MockTransport(server)
+    )
+    return ZoteroAPI(
+        zot, storage_client=httpx.Client(transport=httpx.MockTransport(server))
+    )
+
+
+@pytest.mark.mock
+def test_attachment_file_is_replaced_in_place():
+    server = FileUploadServer("ATT", b"original")
+    api = api_for(server)
+
+    assert api.update_file_content("PARENT", "ATT", b"annotated") == "ATT"
+    assert server.content == b"annotated"
+    assert server.version == 2
+    assert ("DELETE", "/users/1/items/ATT") not in server.requests
+    # The storage service gets the file, but not the API key
+    assert "Authorization" not in server.storage_headers
+    assert "Zotero-API-Key" not in server.storage_headers
+    # The cached attachment is refetched so its new md5 is seen
+    assert api._get_item_by_key("ATT")["data"]["md5"] == hashlib.md5(
+        b"annotated"
+    ).hexdigest()
+
+
+@pytest.mark.mock
+def test_identical_attachment_file_is_not_uploaded():
+    server = FileUploadServer("ATT", b"annotated")
+    api = api_for(server)
+
+    assert api.update_file_content("PARENT", "ATT", b"annotated") == "ATT"
+    assert server.requests == [("GET", "/users/1/items/ATT")]
+
+
+@pytest.mark.mock
+def test_attachment_changed_elsewhere_is_not_overwritten():
+    server = FileUploadServer("ATT", b"original")
+    api = api_for(server)
+    api._get_item_by_key("ATT")
+    server.content = b"edited in another client"
+
+    with pytest.raises(RuntimeError, match="changed in Zotero"):
+        api.update_file_content("PARENT", "ATT", b"annotated")
+    assert server.content == b"edited in another client"
+
+
+@pytest.fixture
+def zotero_server():
+    with ZoteroStandIn() as server:
+        yield server
+
+
+@pytest.mark.mock
+def test_tagged_items_are_read_across_pages(zotero_server):
+    zotero_server.page_limit = 40
+    for i in range(100):
+        zotero_server.add_item(f"Paper {i}", tags=("to_sync",))
+    zotero_server.add_item("Untagged")
+    api = ZoteroAPI(zotero_server.client())
+
+    assert len(api.find_nodes_with_tag("to_sync")) == 100
+    assert zotero_server.requests[("GET", "/users/1/items")] == 3
+
+
+@pytest.mark.mock
+def test_round_trip_through_pyzotero(zotero_server):
+    entry = zotero_server.add_item("Paper", tags=("to_sync",))
+    pdf = zotero_server.add_item("paper.pdf", parent=entry, content=b"%PDF original")
+    api = ZoteroAPI(zotero_server.client())
+    api.refresh_versions()
+
+    assert [child.handle for child in api.list_children(entry)] == [pdf]
+    assert api.get_file_content(pdf) == b"%PDF original"
+
+    api.add_tags(entry, ["synced"])
+    api.remove_tags(entry, ["to_sync"])
+    assert api.get_tags(entry) == ["synced"]
+
+    assert api.update_file_content(entry, pdf, b"%PDF annotated") == pdf
+    notes = api.create_file(entry, "paper.md", b"# notes")
+    assert zotero_server.files == {pdf: b"%PDF annotated", notes: b"# notes"}
+    assert zotero_server.items[notes]["data"]["parentItem"] == entry
+    assert not any(method == "DELETE" for method, _ in zotero_server.requests)
+
+
+@pytest.mark.mock
+def test_retry_after_is_honoured(zotero_server):
+    entry = zotero_server.add_item("Paper")
+    zot = zotero_server.client()
+
+    zotero_server.throttle(1, retry_after=0.3)
+    zot.item(entry)
+    start = time.monotonic()
+    assert zot.item(entry)["key"] == entry
+    assert time.monotonic() - start >= 0.3
+
+
+@pytest.mark.mock
+def test_reattaching_unchanged_renders_writes_nothing(zotero_server, tmp_path):
+    entry = zotero_server.add_item("Paper", tags=("synced",))
+    zotero_server.add_item("Paper.pdf", parent=entry, content=b"%PDF original")
+    zotero_server.add_item("Paper.md", parent=entry, content=b"# old notes")
+    rendered_pdf = tmp_path / "Paper _remarks.pdf"
+    rendered_pdf.write_bytes(b"%PDF annotated")
+    rendered_md = tmp_path / "Paper _obsidian.md"
+    rendered_md.write_bytes(b"# notes")
+    api = ZoteroAPI(zotero_server.client())
+    [entry_node] = api.find_nodes_with_tag("synced")
+
+    def attach():
+        md, pdf = sorted(api.list_children(entry), key=lambda node: node.name)
+        return attach_rendered_document(rendered_pdf, entry_node, pdf, md, api)
+
+    def writes():
+        return sum(
+            count
+            for (method, _), count in zotero_server.requests.items()
+            if method != "GET"
+        )
+
+    first = attach()
+    assert sorted(zotero_server.files.values()) == [b"# notes", b"%PDF annotated"]
+    writes_after_first_attach = writes()
+
+    assert attach() == first
+    assert writes() == writes_after_first_attach
+
+
+@pytest.mark.mock
+def test_concurrent_use_from_worker_threads(zotero_server):
+    zotero_server.page_limit = 10
+    entry = zotero_server.add_item("Paper")
+    for tag in ("a", "b", "c", "d"):
+        for i in range(25):
+            zotero_server.add_item(f"{tag} {i}", tags=(tag,))
+    api = ZoteroAPI(zotero_server.client())
+    api.refresh_versions()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        # Each listing follows its own pagination links
+        listings = executor.map(api.find_nodes_with_tag, ["a", "b", "c", "d"])
+        # and changes to one item do not overwrite each other
+        list(executor.map(lambda tag: api.add_tags(entry, [tag]), "wxyz"))
+
+    for tag, nodes in zip("abcd", listings):
+        assert sorted(tag in node.tags for node in nodes) == [True] * 25
+    assert sorted(api.get_tags(entry)) == ["w", "x", "y", "z"]
+
+
+@pytest.mark.mock
+def test_worker_threads_share_the_http_client_without_closing_it(zotero_server):
+    zotero_server.add_item("Paper", tags=("synced",))
+    zot = zotero_server.client()
+    api = ZoteroAPI(zot)
+
+    def list_synced():
+        assert api.zot is not zot and api.zot.client is zot.client
+        return len(api.find_nodes_with_tag("synced"))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert list(executor.map(lambda _: list_synced(), range(4))) == [1] * 4
+    gc.collect()
+
+    assert not zot.client.is_closed
+    assert len(api.find_nodes_with_tag("synced")) == 1
+
+
+@pytest.mark.mock
+def test_tags_cannot_be_added_to_missing_items(zotero_server):
+    api = ZoteroAPI(zotero_server.client())
+    assert api.get_items(["MISSING1"]) == {}
+
+    assert not api.add_tags("MISSING1", ["synced"])
+
+
+@pytest.mark.mock
+def test_nodes_of_missing_items_have_no_metadata(zotero_server):
+    api = ZoteroAPI(zotero_server.client())
+    assert api.get_items(["MISSING1"]) == {}
+
+    node = TreeNode((), "MISSING1", "attachment", "paper.pdf", "", api._item_data)
+    assert node.load_metadata() == {}
+
+
+@pytest.mark.mock
+def test_missing_attachments_have_no_size(zotero_server):
+    api = ZoteroAPI(zotero_server.client())
+    assert api.get_items(["MISSING1"]) == {}
+
+    assert api.attachment_size("MISSING1") is None
+
+
+def item_reads(zotero_server, keys):
+    return sum(zotero_server.requests[("GET", f"/users/1/items/{key}")] for key in keys)
+
+
+@pytest.mark.mock
+def test_items_are_fetched_fifty_at_a_time(zotero_server):
+    keys = [zotero_server.add_item(f"Paper {i}", tags=("synced",)) for i in range(120)]
+    api = ZoteroAPI(zotero_server.client())
+
+    items = api.get_items(keys + ["MISSING1"])
+
+    assert list(items) == keys
+    assert zotero_server.requests[("GET", "/users/1/items")] == 3
+    requests_after_fetch = sum(zotero_server.requests.values())
+    assert all(api.get_tags(key) == ["synced"] for key in keys)
+    assert not api.item_exists("MISSING1")
+    assert sum(zotero_server.requests.values()) == requests_after_fetch
+
+
+@pytest.mark.mock
+def test_tag_changes_read_items_back_in_batches(zotero_server):
+    entries = []
+    for i in range(60):
+        entries.append(zotero_server.add_item(f"Paper {i}", tags=("to_sync",)))
+        zotero_server.add_item(f"paper{i}.pdf", parent=entries[-1], content=b"%PDF")
+    api = ZoteroAPI(zotero_server.client())
+    api.refresh_versions()
+    rm = MockReMarkableAPI(files={}, folders={"", "Zotero", "Zotero/unread"})
+
+    execute_plan(plan_push(api, FOLDERS), api, rm)
+
+    assert all(
+        zotero_server.items[key]["data"]["tags"] == [{"tag": "synced"}]
+        for key in entries
+    )
+    # Every entry was changed twice, but read back with two batch requests
+    # instead of one request each
+    assert item_reads(zotero_server, entries) == 0
@@ -0,0 +1,225 @@
+"""
+Tests for pushing on changes reported by the Zotero streaming API, against a local stand-in for it.
+"""
+
+import threading
+import time
+
+import pytest
+from pyzotero.zotero import Zotero
+
+from tests.fake_rmapi import install_fake_rmapi
+from tests.test_profiles import make_profile, make_tablet
+from tests.zotero_server import LIBRARY_ID, ZoteroStandIn
+from tests.zotero_stream_server import ZoteroStreamStandIn
+from zrm.config_functions import Profile
+from zrm.zotero_rm_bridge import run_profiles
+from zrm.zotero_stream import StreamListener, WebSocket, library_topic
+
+
+def library_profile(tmp_path, name, library_id):
+    return Profile(
+        name, Zotero(library_id, "user", f"{name}-key"), False, {}, tmp_path / name
+    )
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+class Listening:
+    """Runs a StreamListener on a thread for the duration of a `with` block."""
+
+    def __init__(self, listener: StreamListener):
+        self.listener = listener
+        self.thread = threading.Thread(target=listener.run, daemon=True)
+
+    def __enter__(self) -> StreamListener:
+        self.thread.start()
+        return self.listener
+
+    def __exit__(self, *exc_info):
+        self.listener.stop()
+        self.thread.join(timeout=5)
+        assert not self.thread.is_alive()
+
+
+@pytest.mark.mock
+def test_burst_of_changes_pushes_the_changed_library_once(tmp_path):
+    alice = library_profile(tmp_path, "alice", "1")
+    bob = library_profile(tmp_path, "bob", "2")
+    pushes = []
+    with ZoteroStreamStandIn() as stream:
+        listener = StreamListener(
+            [alice, bob],
+            lambda changed: pushes.append([p.name for p in changed]),
+            url=stream.url,
+            debounce=0.3,
+        )
+        with Listening(listener):
+            stream.wait_for_subscribers("/users/2")
+            for version in range(5):
+                stream.publish("/users/1", version)
+                time.sleep(0.05)
+            wait_until(lambda: pushes)
+            time.sleep(0.5)
+
+        assert pushes == [["alice"]]
+        assert stream.subscriptions == [
+            {"apiKey": "alice-key", "topics": ["/users/1"]},
+            {"apiKey": "bob-key", "topics": ["/users/2"]},
+        ]
+        assert stream.pongs == 1
+
+
+
+@pytest.mark.mock
+def test_profiles_with_the_same_name_are_both_pushed(tmp_path):
+    first = library_profile(tmp_path / "a", "config", "1")
+    second = library_profile(tmp_path / "b", "config", "2")
+    pushes = []
+    with ZoteroStreamStandIn() as stream:
+        listener = StreamListener(
+            [first, second], pushes.append, url=stream.url, debounce=0.2
+        )
+        with Listening(listener):
+            stream.wait_for_subscribers("/users/2")
+            stream.publish("/users/1", 1)
+            stream.publish("/users/2", 1)
+            wait_until(lambda: pushes)
+
+        [pushed] = pushes
+        assert sorted(p.zot.library_id for p in pushed) == ["1", "2"]
+
+@pytest.mark.mock
+def test_library_that_keeps_changing_is_pushed_after_max_delay(tmp_path):
+    alice = library_profile(tmp_path, "alice", "1")
+    pushes = []
+    with ZoteroStreamStandIn() as stream:
+        listener = StreamListener(
+            [alice],
+            lambda changed: pushes.append(time.monotonic()),
+            url=stream.url,
+            debounce=0.5,
+            max_delay=1.0,
+        )
+        with Listening(listener):
+            stream.wait_for_subscribers(library_topic(alice))
+            start = time.monotonic()
+            version = 0
+            while not pushes:
+                assert time.monotonic() - start < 5
+                version += 1
+                stream.publish(library_topic(alice), version)
+                time.sleep(0.1)
+
+        assert pushes[0] - start < 2
+
+
+@pytest.mark.mock
+def test_handshake_with_the_wrong_accept_key_is_refused():
+    with ZoteroStreamStandIn(accept_key="bm90IHRoZSByaWdodCBrZXk=") as stream:
+        with pytest.raises(ConnectionError, match="Sec-WebSocket-Accept"):
+            WebSocket(stream.url)
+
+
+@pytest.mark.mock
+def test_malformed_events_do_not_stop_the_listener(tmp_path):
+    alice = library_profile(tmp_path, "alice", "1")
+    pushes = []
+    with ZoteroStreamStandIn() as stream:
+        listener = StreamListener(
+            [alice],
+            lambda changed: pushes.append([p.name for p in changed]),
+            url=stream.url,
+            debounce=0.1,
+        )
+        with Listening(listener):
+            stream.wait_for_subscribers("/users/1")
+            stream.send("/users/1", '{"event": "topicUpdated"}')
+            stream.send("/users/1", '{"event": "topicUpdated", "topic": ["/users/1"]}')
+            stream.send("/users/1", '["topicUpdated"]')
+            stream.send("/users/1", "not json")
+            stream.publish("/users/1", 1)
+            wait_until(lambda: pushes)
+
+        assert pushes == [["alice"]]
+        assert len(stream.subscriptions) == 1
+
+
+@pytest.mark.mock
+def test_reconnect_pushes_every_library(tmp_path):
+    alice = library_profile(tmp_path, "alice", "1")
+    bob = library_profile(tmp_path, "bob", "2")
+    pushes = []
+    with ZoteroStreamStandIn(retry_ms=50) as stream:
+        listener = StreamListener(
+            [alice, bob],
+            lambda changed: pushes.append(sorted(p.name for p in changed)),
+            url=stream.url,
+            debounce=0.1,
+        )
+        with Listening(listener):
+            stream.wait_for_subscribers("/users/2")
+            stream.drop_connections()
+            stream.wait_for_subscribers("/users/2")
+            wait_until(lambda: pushes)
+
+        assert pushes == [["alice", "bob"]]
+
+
+@pytest.mark.mock
+def test_tagged_paper_reaches_the_tablet_without_a_manual_run(tmp_path, monkeypatch):
+    install_fake_rmapi(tmp_path, monkeypatch)
+    with ZoteroStandIn() as zotero, ZoteroStreamStandIn() as stream:
+        tablet, rmapi_config = make_tablet(tmp_path, "alice")
+        profile = make_profile(tmp_path, "alice", zotero, rmapi_config)
+        listener = StreamListener(
+            [profile],
+            lambda changed: run_profiles(changed, ["push"]),
+            url=stream.url,
+            debounce=0.2,
+        )
+        with Listening(listener):
+            stream.wait_for_subscribers(f"/users/{LIBRARY_ID}")
+            entry = zotero.add_item("paper", tags=("to_sync",))
+            zotero.add_item("paper.pdf", parent=entry, content=b"%PDF")
+            stream.publish(f"/users/{LIBRARY_ID}", 2)
+
+            wait_until(lambda: (tablet / "Zotero" / "unread" / "paper").exists())
+
+
+@pytest.mark.mock
+def test_changes_made_by_the_push_are_not_pushed_again(tmp_path, monkeypatch):
+    install_fake_rmapi(tmp_path, monkeypatch)
+    with ZoteroStandIn() as zotero, ZoteroStreamStandIn() as stream:
+        tablet, rmapi_config = make_tablet(tmp_path, "alice")
+        profile = make_profile(tmp_path, "alice", zotero, rmapi_config)
+        runs = []
+
+        def push(changed):
+            run_profiles(changed, ["push"])
+            runs.append(zotero.version)
+
+        listener = StreamListener([profile], push, url=stream.url, debounce=0.2)
+        with Listening(listener):
+            stream.wait_for_subscribers(f"/users/{LIBRARY_ID}")
+            entry = zotero.add_item("paper", tags=("to_sync",))
+            zotero.add_item("paper.pdf", parent=entry, content=b"%PDF")
+            stream.publish(f"/users/{LIBRARY_ID}", zotero.version)
+            wait_until(lambda: runs)
+
+            # The push tagged the paper, which Zotero reports as a change
+            stream.publish(f"/users/{LIBRARY_ID}", runs[0])
+            time.sleep(1)
+            assert len(runs) == 1
+
+            entry = zotero.add_item("another paper", tags=("to_sync",))
+            zotero.add_item("another paper.pdf", parent=entry, content=b"%PDF")
+            stream.publish(f"/users/{LIBRARY_ID}", zotero.version)
+            wait_until(lambda: len(runs) == 2)
+
+        assert (tablet / "Zotero" / "unread" / "another paper").exists()
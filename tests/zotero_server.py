@@ -0,0 +1,498 @@
+"""
+A local stand-in for the subset of the Zotero web API (v3) that zrm uses.
+
+It keeps a single user library in memory and answers the requests pyzotero
+makes for it: reading items, children, tags and versions, creating, patching
+and deleting items, and the file upload/download protocol. Responses carry
+the same version, pagination and rate-limit headers as api.zotero.org, so a
+real `pyzotero.zotero.Zotero` pointed at it through `client()` behaves as it
+would against the live service.
+
+Latency, the page size limit and throttling (429 responses) are plain
+attributes that can be changed while the server runs.
+"""
+
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from pyzotero.zotero import Zotero
+
+LIBRARY_ID = "1"
+
+ITEM_FIELDS = ["title", "abstractNote", "date", "url", "accessDate", "extra"]
+
+TEMPLATES = {
+    "document": {
+        "itemType": "document",
+        "title": "",
+        "creators": [],
+        "abstractNote": "",
+        "date": "",
+        "url": "",
+        "accessDate": "",
+        "extra": "",
+        "tags": [],
+        "collections": [],
+        "relations": {},
+    },
+    "attachment": {
+        "itemType": "attachment",
+        "linkMode": "imported_file",
+        "title": "",
+        "accessDate": "",
+        "note": "",
+        "tags": [],
+        "collections": [],
+        "relations": {},
+        "contentType": "",
+        "charset": "",
+        "filename": "",
+        "md5": None,
+        "mtime": None,
+    },
+}
+
+
+def new_key() -> str:
+    return uuid.uuid4().hex[:8].upper()
+
+
+def tags_match(item: Dict, tag_filters: List[str]) -> bool:
+    """Apply `tag` query parameters: all must match, `-tag` negates, `a || b` is either."""
+    tags = {tag["tag"] for tag in item["data"].get("tags", [])}
+    for tag_filter in tag_filters:
+        if tag_filter.startswith("-"):
+            if tag_filter[1:] in tags:
+                return False
+        elif not any(option.strip() in tags for option in tag_filter.split("||")):
+            return False
+    return True
+
+
+class ZoteroStandIn:
+    """An in-memory Zotero user library served over HTTP on localhost."""
+
+    def __init__(self, latency: float = 0.0, page_limit: int = 100):
+        self.latency = latency
+        self.page_limit = page_limit
+        self.version = 0
+        self.items: Dict[str, Dict] = {}
+        self.files: Dict[str, bytes] = {}
+        self.requests: Counter = Counter()
+        self._uploads: Dict[str, Dict] = {}
+        self._throttled = 0
+        self._retry_after = 0.0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "ZoteroStandIn":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "ZoteroStandIn":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def client(self) -> Zotero:
+        """A real pyzotero client talking to this server."""
+        zot = Zotero(LIBRARY_ID, "user", "test-api-key")
+        zot.endpoint = self.url
+        return zot
+
+    def throttle(self, requests: int, retry_after: float = 1.0):
+        """Answer the next `requests` API requests with 429 Too Many Requests."""
+        with self._lock:
+            self._throttled = requests
+            self._retry_after = retry_after
+
+    def add_item(
+        self,
+        title: str,
+        item_type: str = "document",
+        parent: Optional[str] = None,
+        tags: tuple = (),
+        content: Optional[bytes] = None,
+    ) -> str:
+        """Seed the library with an item, or an attachment if `content` is given."""
+        data = dict(TEMPLATES["attachment" if content is not None else item_type])
+        data["title"] = title
+        data["tags"] = [{"tag": tag} for tag in tags]
+        if parent:
+            data["parentItem"] = parent
+        with self._lock:
+            key = self._store(data)
+            if content is not None:
+                self._store_file(key, title, content)
+        return key
+
+    # Library state, called with the lock held
+
+    def _bump(self) -> int:
+        self.version += 1
+        return self.version
+
+    def _store(self, data: Dict, key: Optional[str] = None) -> str:
+        key = key or data.get("key") or new_key()
+        version = self._bump()
+        data = {**data, "key": key, "version": version}
+        self.items[key] = {
+            "key": key,
+            "version": version,
+            "library": {"type": "user", "id": int(LIBRARY_ID), "name": "stand-in"},
+            "links": {},
+            "meta": {},
+            "data": data,
+        }
+        return key
+
+    def _store_file(self, key: str, filename: str, content: bytes):
+        self.files[key] = content
+        data = self.items[key]["data"]
+        data.update(
+            filename=filename,
+            md5=hashlib.md5(content).hexdigest(),
+            mtime=int(time.time() * 1000),
+            contentType=data.get("contentType") or "application/octet-stream",
+        )
+        self.items[key]["links"]["enclosure"] = {
+            "type": data["contentType"],
+            "href": f"{self.url}/users/{LIBRARY_ID}/items/{key}/file/view",
+            "title": filename,
+            "length": len(content),
+        }
+        self.items[key]["version"] = data["version"] = self._bump()
+
+    def _item_json(self, key: str) -> Dict:
+        item = json.loads(json.dumps(self.items[key]))
+        item["meta"]["numChildren"] = sum(
+            1 for other in self.items.values() if other["data"].get("parentItem") == key
+        )
+        return item
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(ZoteroRequestHandler):
+            server_state = stand_in
+
+        return Handler
+
+
+class ZoteroRequestHandler(BaseHTTPRequestHandler):
+    server_state: ZoteroStandIn
+
+    def log_message(self, format, *args):
+        pass
+
+    # Plumbing
+
+    def _dispatch(self, method: str):
+        state = self.server_state
+        parsed = urlparse(self.path)
+        self.query = parse_qs(parsed.query)
+        self.route = [part for part in parsed.path.split("/") if part]
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+
+        with state._lock:
+            state.requests[(method, parsed.path)] += 1
+            throttled = state._throttled > 0
+            if throttled:
+                state._throttled -= 1
+        if state.latency:
+            time.sleep(state.latency)
+        if throttled:
+            self._send(
+                429,
+                b"Too Many Requests",
+                "text/plain",
+                {"Retry-After": str(state._retry_after)},
+            )
+            return
+
+        handler = getattr(self, f"_{method.lower()}", None)
+        with state._lock:
+            handler()
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _send(
+        self,
+        status: int,
+        body: bytes = b"",
+        content_type: str = "application/json",
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified-Version", str(self.server_state.version))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload, headers: Optional[Dict] = None):
+        self._send(status, json.dumps(payload).encode(), headers=headers)
+
+    def _form(self) -> Dict[str, str]:
+        return {
+            name: values[0] for name, values in parse_qs(self.body.decode()).items()
+        }
+
+    def _item_route(self) -> Optional[List[str]]:
+        """The path below /users/<id>/items, or None for anything else."""
+        if self.route[:3] == ["users", LIBRARY_ID, "items"]:
+            return self.route[3:]
+        return None
+
+    def _not_modified_since(self, key: str) -> bool:
+        expected = self.headers.get("If-Unmodified-Since-Version")
+        if expected is not None and self.server_state.items[key]["version"] > int(
+            expected
+        ):
+            self._send(412, b"Item has been modified since specified version", "text/plain")
+            return False
+        return True
+
+    # Reads
+
+    def _get(self):
+        state = self.server_state
+        if self.route == ["items", "new"]:
+            template = TEMPLATES[self.query["itemType"][0]]
+            self._send_json(200, template)
+            return
+        if self.route == ["itemFields"]:
+            self._send_json(200, [{"field": field} for field in ITEM_FIELDS])
+            return
+        if self.route == ["users", LIBRARY_ID, "tags"]:
+            counts = Counter(
+                tag["tag"]
+                for item in state.items.values()
+                for tag in item["data"].get("tags", [])
+            )
+            self._send_json(
+                200,
+                [{"tag": tag, "meta": {"numItems": n}} for tag, n in sorted(counts.items())],
+            )
+            return
+
+        route = self._item_route()
+        if route is None:
+            self._send(404, b"Not found", "text/plain")
+        elif not route:
+            self._list_items(list(state.items))
+        elif route[0] not in state.items:
+            self._send(404, b"Item not found", "text/plain")
+        elif len(route) == 1:
+            self._send_json(200, state._item_json(route[0]))
+        elif route[1] == "children":
+            self._list_items(
+                [
+                    key
+                    for key, item in state.items.items()
+                    if item["data"].get("parentItem") == route[0]
+                ]
+            )
+        elif route[1] == "file":
+            if route[0] not in state.files:
+                self._send(404, b"File not found", "text/plain")
+            else:
+                content_type = state.items[route[0]]["data"]["contentType"]
+                self._send(200, state.files[route[0]], content_type)
+        else:
+            self._send(404, b"Not found", "text/plain")
+
+    def _list_items(self, keys: List[str]):
+        state = self.server_state
+        if "itemKey" in self.query:
+            wanted = self.query["itemKey"][0].split(",")
+            keys = [key for key in keys if key in wanted]
+        if "tag" in self.query:
+            keys = [key for key in keys if tags_match(state.items[key], self.query["tag"])]
+        if "since" in self.query:
+            since = int(self.query["since"][0])
+            keys = [key for key in keys if state.items[key]["version"] > since]
+
+        headers = {"Total-Results": str(len(keys))}
+        if self.query.get("format") == ["versions"]:
+            self._send_json(
+                200, {key: state.items[key]["version"] for key in keys}, headers
+            )
+            return
+
+        limit = min(int(self.query.get("limit", ["25"])[0]), state.page_limit)
+        start = int(self.query.get("start", ["0"])[0])
+        page = keys[start : start + limit]
+        if start + limit < len(keys):
+            headers["Link"] = self._links(start + limit, limit, len(keys))
+        self._send_json(200, [state._item_json(key) for key in page], headers)
+
+    def _links(self, next_start: int, limit: int, total: int) -> str:
+        path = urlparse(self.path).path
+        query = {name: values for name, values in self.query.items()}
+
+        def link(start: int, rel: str) -> str:
+            query["start"] = [str(start)]
+            query["limit"] = [str(limit)]
+            return f'<{self.server_state.url}{path}?{urlencode(query, doseq=True)}>; rel="{rel}"'
+
+        last_start = (total - 1) // limit * limit
+        return ", ".join([link(next_start, "next"), link(last_start, "last")])
+
+    # Writes
+
+    def _post(self):
+        route = self._item_route()
+        if route == []:
+            self._create_items()
+        elif route and len(route) == 2 and route[1] == "file":
+            self._file_request(route[0])
+        elif self.route == ["upload", *self.route[1:]] and len(self.route) == 2:
+            self._receive_upload(self.route[1])
+        else:
+            self._send(404, b"Not found", "text/plain")
+
+    def _create_items(self):
+        state = self.server_state
+        result = {"successful": {}, "success": {}, "unchanged": {}, "failed": {}}
+        for index, data in enumerate(json.loads(self.body)):
+            key = data.get("key")
+            if key and key in state.items:
+                data = {**state.items[key]["data"], **data}
+            key = state._store(data, key)
+            result["successful"][str(index)] = state._item_json(key)
+            result["success"][str(index)] = key
+        self._send_json(200, result)
+
+    def _patch(self):
+        state = self.server_state
+        route = self._item_route()
+        if not route or len(route) != 1 or route[0] not in state.items:
+            self._send(404, b"Item not found", "text/plain")
+            return
+        key = route[0]
+        if not self._not_modified_since(key):
+            return
+        state._store({**state.items[key]["data"], **json.loads(self.body)}, key)
+        self._send(204)
+
+    def _delete(self):
+        state = self.server_state
+        route = self._item_route()
+        if route == [] and "itemKey" in self.query:
+            keys = self.query["itemKey"][0].split(",")
+        elif route and len(route) == 1 and route[0] in state.items:
+            keys = route
+            if not self._not_modified_since(route[0]):
+                return
+        else:
+            self._send(404, b"Item not found", "text/plain")
+            return
+        for key in keys:
+            state.items.pop(key, None)
+            state.files.pop(key, None)
+        state._bump()
+        self._send(204)
+
+    # File upload protocol
+
+    def _file_request(self, key: str):
+        """Authorise an upload, or register a finished one."""
+        state = self.server_state
+        if key not in state.items:
+            self._send(404, b"Item not found", "text/plain")
+            return
+        form = self._form()
+        current_md5 = state.items[key]["data"].get("md5")
+
+        if "upload" in form:
+            upload = state._uploads.pop(form["upload"], None)
+            if upload is None or "content" not in upload:
+                self._send(400, b"Upload not found", "text/plain")
+                return
+            state._store_file(key, upload["filename"], upload["content"])
+            self._send(204)
+            return
+
+        if_match = self.headers.get("If-Match")
+        if_none_match = self.headers.get("If-None-Match")
+        if (if_match is not None and if_match != current_md5) or (
+            if_none_match == "*" and current_md5
+        ):
+            self._send(412, b"File has changed", "text/plain")
+            return
+        if form["md5"] == current_md5:
+            self._send_json(200, {"exists": 1})
+            return
+
+        upload_key = uuid.uuid4().hex
+        state._uploads[upload_key] = {"key": key, "filename": form["filename"]}
+        upload_url = f"{state.url}/upload/{upload_key}"
+        if "params" in form:
+            self._send_json(
+                200,
+                {"url": upload_url, "params": {"key": upload_key}, "uploadKey": upload_key},
+            )
+        else:
+            boundary = uuid.uuid4().hex
+            self._send_json(
+                200,
+                {
+                    "url": upload_url,
+                    "contentType": f"multipart/form-data; boundary={boundary}",
+                    "prefix": (
+                        f"--{boundary}\r\n"
+                        'Content-Disposition: form-data; name="file"; filename="upload"\r\n'
+                        "Content-Type: application/octet-stream\r\n\r\n"
+                    ),
+                    "suffix": f"\r\n--{boundary}--\r\n",
+                    "uploadKey": upload_key,
+                },
+            )
+
+    def _receive_upload(self, upload_key: str):
+        """Play the storage service: accept the multipart upload of an authorised file."""
+        upload = self.server_state._uploads.get(upload_key)
+        if upload is None:
+            self._send(403, b"Unknown upload", "text/plain")
+            return
+        message = BytesParser(policy=default_policy).parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + self.body
+        )
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                upload["content"] = part.get_payload(decode=True)
+        self._send(201)
@@ -0,0 +1,177 @@
+"""
+A local stand-in for the Zotero streaming API (wss://stream.zotero.org).
+
+It speaks just enough WebSocket to accept connections, greets them with a
+`connected` event, records `createSubscriptions` requests and answers them,
+and sends `topicUpdated` events to the connections subscribed to a topic
+when `publish` is called. Every connection is pinged once, and pongs are
+counted, so tests can check that the client answers them. `send` delivers
+any message, so tests can send malformed events too.
+"""
+
+import base64
+import hashlib
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+from typing import Dict, List, Optional
+
+_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def _frame(opcode: int, payload: bytes) -> bytes:
+    # Frames from a server are never masked
+    header = bytes([0x80 | opcode])
+    if len(payload) < 126:
+        return header + bytes([len(payload)]) + payload
+    return header + bytes([126]) + struct.pack("!H", len(payload)) + payload
+
+
+class ZoteroStreamStandIn:
+    def __init__(self, retry_ms: int = 100, accept_key: Optional[str] = None):
+        self.retry_ms = retry_ms
+        # Answers handshakes with this Sec-WebSocket-Accept instead of the right one
+        self.accept_key = accept_key
+        self.subscriptions: List[Dict] = []
+        self.pongs = 0
+        self._connections: Dict[socket.socket, List[str]] = {}
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(
+            ("127.0.0.1", 0), self._handler_class()
+        )
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"ws://{host}:{port}"
+
+    def __enter__(self) -> "ZoteroStreamStandIn":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.drop_connections()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def wait_for_subscribers(self, topic: str, count: int = 1, timeout: float = 5.0):
+        """Wait until `count` connections are subscribed to `topic`."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if sum(topic in topics for topics in self._connections.values()) >= count:
+                    return
+            time.sleep(0.01)
+        raise TimeoutError(f"Nobody subscribed to {topic}")
+
+    def publish(self, topic: str, version: int):
+        """Send a `topicUpdated` event to every connection subscribed to `topic`."""
+        self.send(
+            topic,
+            json.dumps({"event": "topicUpdated", "topic": topic, "version": version}),
+        )
+
+    def send(self, topic: str, message: str):
+        """Send a text message to every connection subscribed to `topic`."""
+        with self._lock:
+            for connection, topics in self._connections.items():
+                if topic in topics:
+                    connection.sendall(_frame(0x1, message.encode()))
+
+    def drop_connections(self):
+        """Close every connection, as a server restart or network failure would."""
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self._connections.clear()
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = b""
+                while b"\r\n\r\n" not in request:
+                    request += self.request.recv(4096)
+                headers = dict(
+                    line.split(": ", 1)
+                    for line in request.decode().split("\r\n")[1:]
+                    if ": " in line
+                )
+                accept = stand_in.accept_key or base64.b64encode(
+                    hashlib.sha1((headers["Sec-WebSocket-Key"] + _GUID).encode()).digest()
+                ).decode()
+                self.request.sendall(
+                    (
+                        "HTTP/1.1 101 Switching Protocols\r\n"
+                        "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                        f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+                    ).encode()
+                )
+                with stand_in._lock:
+                    stand_in._connections[self.request] = []
+                connected = {"event": "connected", "retry": stand_in.retry_ms}
+                self.request.sendall(_frame(0x1, json.dumps(connected).encode()))
+                self.request.sendall(_frame(0x9, b"are you there"))
+
+                try:
+                    while True:
+                        opcode, payload = self.read_frame()
+                        if opcode == 0x8:
+                            break
+                        if opcode == 0xA:
+                            with stand_in._lock:
+                                stand_in.pongs += 1
+                        elif opcode == 0x1:
+                            self.handle_message(json.loads(payload))
+                except (ConnectionError, OSError, struct.error):
+                    pass
+                finally:
+                    with stand_in._lock:
+                        stand_in._connections.pop(self.request, None)
+
+            def read_exact(self, n: int) -> bytes:
+                data = self.rfile.read(n)
+                if len(data) < n:
+                    raise ConnectionError("client went away")
+                return data
+
+            def read_frame(self):
+                first, second = self.read_exact(2)
+                length = second & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", self.read_exact(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self.read_exact(8))[0]
+                mask = self.read_exact(4)
+                payload = bytes(
+                    b ^ mask[i % 4] for i, b in enumerate(self.read_exact(length))
+                )
+                return first & 0x0F, payload
+
+            def handle_message(self, message: Dict):
+                if message.get("action") != "createSubscriptions":
+                    return
+                subscriptions = message["subscriptions"]
+                with stand_in._lock:
+                    stand_in.subscriptions.extend(subscriptions)
+                    for subscription in subscriptions:
+                        stand_in._connections[self.request].extend(
+                            subscription["topics"]
+                        )
+                    reply = {
+                        "event": "subscriptionsCreated",
+                        "subscriptions": subscriptions,
+                        "errors": [],
+                    }
+                    self.request.sendall(_frame(0x1, json.dumps(reply).encode()))
+
+        return Handler
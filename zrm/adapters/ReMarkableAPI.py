@@ -1,19 +1,109 @@
+import functools
+import json
 import logging
-from typing import List
+import os
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
 from pathlib import Path
+import shutil
 import tempfile
+import time
 
 from zrm import rmapi_shim as rmapi
+from zrm.adapters.RemoteSnapshot import RemoteSnapshot
+from zrm.rmapi_policy import PERMANENT, TIMEOUT, RmapiPolicy
 
 logger = logging.getLogger(__name__)
 
 
+def _on_own_tablet(method):
+    """Run a method's rmapi commands against the tablet this instance was created for."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with rmapi.use_config(self.rmapi_config, self.policy):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
 class ReMarkableAPI:
-    def __init__(self):
-        # Verify rmapi is working
-        if not rmapi.check_rmapi():
-            raise RuntimeError("rmapi is not properly configured or accessible")
+    rmapi_config: Optional[str] = None
+
+    def __init__(
+        self,
+        rmapi_config: Optional[str] = None,
+        policy: Optional[RmapiPolicy] = None,
+        root_state_path: Optional[Path] = None,
+    ):
+        self.rmapi_config = rmapi_config
+        # Timeouts and retries of this tablet's rmapi commands
+        self.policy = policy or RmapiPolicy()
+        # Where the cloud's root as of the last completed pull is kept
+        self.root_state_path = root_state_path
+        self._root: Optional[Dict] = None
+        with rmapi.use_config(rmapi_config, self.policy):
+            if root_state_path:
+                self._root = rmapi.root_state()
+            # The cloud accepting rmapi's token shows it is set up, so the
+            # check is only needed without it
+            if self._root is None and not rmapi.check_rmapi():
+                raise RuntimeError("rmapi is not properly configured or accessible")
+        self._snapshot: Optional[RemoteSnapshot] = None
+
+    def unchanged_since_last_pull(self) -> bool:
+        """Whether nothing on the tablet changed since the last completed pull.
+
+        Every change to any document moves the cloud's root to a new hash
+        and generation, so comparing them with the ones seen when the last
+        pull started takes a single request. False when that is not known.
+        """
+        if self._root is None or not self.root_state_path:
+            return False
+        try:
+            with open(self.root_state_path, encoding="utf-8") as f:
+                return json.load(f) == self._root
+        except (OSError, ValueError):
+            return False
+
+    def remember_pull(self):
+        """Record that everything up to the root seen at start-up has been pulled."""
+        if self._root is None or not self.root_state_path:
+            return
+        temp_path = self.root_state_path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self._root, f)
+        os.replace(temp_path, self.root_state_path)
+
+    @_on_own_tablet
+    def snapshot(self, root: str = "Zotero") -> Optional[RemoteSnapshot]:
+        """Fetch the whole subtree below `root` once.
+
+        Existence checks and listings inside `root` are answered from the
+        snapshot for the rest of the run, and uploads/deletes keep it current.
+        """
+        entries = rmapi.find(root)
+        if entries is None:
+            logger.warning(
+                f"Could not take a snapshot of {root}, falling back to per-folder listings"
+            )
+            self._snapshot = None
+        else:
+            self._snapshot = RemoteSnapshot.from_entries(root, entries)
+            logger.info(f"Took a snapshot of {len(entries)} entries below {root}")
+        return self._snapshot
 
+    def _snapshot_for(self, path: str) -> Optional[RemoteSnapshot]:
+        if self._snapshot is not None and self._snapshot.covers(path):
+            return self._snapshot
+        return None
+
+    @staticmethod
+    def _visible_path(path: str) -> str:
+        """The path rmapi shows for an uploaded file, which drops the `.pdf` suffix."""
+        actual_path = Path(path)
+        return str(actual_path.with_name(actual_path.name.removesuffix(".pdf")))
+
+    @_on_own_tablet
     def upload_file(self, path: str, content: bytes) -> bool:
         """Upload a file to reMarkable."""
         try:
@@ -30,6 +120,9 @@ class ReMarkableAPI:
 
                     try:
                         success = rmapi.upload_file(f.name, str(actual_path.parent))
+                        snapshot = self._snapshot_for(path)
+                        if success and snapshot:
+                            snapshot.add(self._visible_path(path), is_folder=False)
                         return success
                     except Exception as e:
                         logger.error(e)
@@ -39,6 +132,44 @@ class ReMarkableAPI:
             logger.error(e)
             return False
 
+    @_on_own_tablet
+    def upload_files(
+        self, folder: str, files: Iterable[Tuple[str, bytes | BinaryIO]]
+    ) -> Dict[str, bool]:
+        """Upload many files to one folder with a single rmapi process.
+
+        `files` is consumed lazily and every file is written to a staging
+        directory as soon as it arrives, so the contents are never all held in
+        memory at once. Contents may be bytes or a binary file. Returns whether
+        each filename was uploaded.
+        """
+        results: Dict[str, bool] = {}
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                for filename, content in files:
+                    with open(Path(d) / filename, "wb") as f:
+                        if isinstance(content, bytes):
+                            f.write(content)
+                        else:
+                            shutil.copyfileobj(content, f)
+                    results[filename] = False
+
+                if results:
+                    results.update(rmapi.upload_files(d, folder))
+        except Exception as e:
+            logger.error(e)
+            return results
+
+        snapshot = self._snapshot_for(folder)
+        if snapshot:
+            for filename, success in results.items():
+                if success:
+                    snapshot.add(
+                        self._visible_path(f"{folder}/{filename}"), is_folder=False
+                    )
+        return results
+
+    @_on_own_tablet
     def file_or_folder_exists(self, path: str) -> bool:
         """Check if a file or folder exists."""
         actual_path = Path(path)
@@ -48,6 +179,10 @@ class ReMarkableAPI:
             # Root always exists
             return True
 
+        snapshot = self._snapshot_for(path)
+        if snapshot:
+            return snapshot.lookup(self._visible_path(path)) is not None
+
         files = rmapi.get_children(d)
 
         if files:
@@ -55,11 +190,17 @@ class ReMarkableAPI:
 
         return False
 
+    @_on_own_tablet
     def is_folder(self, path: str) -> bool:
         """Check if the path represents a folder."""
         if not path:
             return True  # Root is always a collection
 
+        snapshot = self._snapshot_for(path)
+        if snapshot:
+            node = snapshot.lookup(path)
+            return node is not None and node.is_folder
+
         # If get_files succeeds and returns a list, it's a folder
         return isinstance(rmapi.get_files(path), list)
 
@@ -70,6 +211,7 @@ class ReMarkableAPI:
 
         return self.file_or_folder_exists(path) and not self.is_folder(path)
 
+    @_on_own_tablet
     def get_file_content(self, path: str) -> bytes:
         """Download and return file content."""
         try:
@@ -95,8 +237,106 @@ class ReMarkableAPI:
         except Exception as e:
             raise FileNotFoundError(f"Could not retrieve file content: {str(e)}")
 
+    def download_files(
+        self, folder: str, names: List[str], poll_interval: float = 0.2
+    ) -> Iterator[Tuple[str, Path]]:
+        """Download files from a folder with a single `rmapi mget`.
+
+        Yields `(name, local_path)` as soon as each file has finished
+        downloading, so callers can start processing the first file while the
+        rest are still arriving. A yielded path is only valid until the next
+        item is requested. Files that mget did not deliver, also when it was
+        killed for running past its timeout, are fetched one by one with
+        `rmapi get`.
+        """
+        wanted = set(names)
+        with tempfile.TemporaryDirectory() as staging, tempfile.TemporaryFile(
+            "w+"
+        ) as log_file:
+            staging_path = Path(staging)
+            seen: set[Path] = set()
+            previous: Optional[Path] = None
+            with rmapi.use_config(self.rmapi_config, self.policy):
+                process = rmapi.start_folder_download(folder, staging, log_file)
+            started = time.monotonic()
+            deadline = started + self.policy.timeout("mget")
+
+            try:
+                while True:
+                    finished = process.poll() is not None
+                    timed_out = not finished and time.monotonic() >= deadline
+                    if timed_out:
+                        rmapi.kill_process_group(process)
+                        rmapi.stats.record(
+                            "mget", time.monotonic() - started, TIMEOUT
+                        )
+                        logger.warning(
+                            f"rmapi mget of {folder} timed out, "
+                            "fetching the rest one by one"
+                        )
+                    arrived = sorted(
+                        (
+                            p
+                            for p in staging_path.rglob("*")
+                            if p.is_file() and p not in seen
+                        ),
+                        key=lambda p: p.stat().st_mtime,
+                    )
+                    # mget downloads one file at a time, so everything but the
+                    # newest file is complete until the process exits
+                    ready = arrived if finished else arrived[:-1]
+                    for local_path in ready:
+                        seen.add(local_path)
+                        name = local_path.stem
+                        if name not in wanted:
+                            continue
+                        wanted.discard(name)
+                        if previous:
+                            previous.unlink(missing_ok=True)
+                        previous = local_path
+                        yield name, local_path
+                    if finished or timed_out:
+                        break
+                    time.sleep(poll_interval)
+            finally:
+                # Abandoning the generator early must not leave mget running
+                if process.poll() is None:
+                    rmapi.kill_process_group(process)
+
+            if finished:
+                rmapi.stats.record(
+                    "mget",
+                    time.monotonic() - started,
+                    None if process.returncode == 0 else PERMANENT,
+                )
+            if process.returncode != 0 and not timed_out:
+                log_file.seek(0)
+                logger.error(f"rmapi mget failed: {log_file.read()}")
+
+            for name in names:
+                if name not in wanted:
+                    continue
+                logger.info(f"mget did not deliver {name}, downloading it on its own")
+                try:
+                    content = self.get_file_content(f"{folder}/{name}")
+                except FileNotFoundError as e:
+                    logger.error(e)
+                    continue
+                local_path = staging_path / f"{name}.rmn"
+                with open(local_path, "wb") as f:
+                    f.write(content)
+                if previous:
+                    previous.unlink(missing_ok=True)
+                previous = local_path
+                yield name, local_path
+
+    @_on_own_tablet
     def list_children(self, path: str) -> List[str]:
         """List files in a folder."""
+        snapshot = self._snapshot_for(path)
+        if snapshot:
+            return snapshot.list_files(path)
+
         files = rmapi.get_files(path)
 
         if isinstance(files, list):
@@ -104,9 +344,14 @@ class ReMarkableAPI:
         else:
             return []
 
+    @_on_own_tablet
     def delete_file_or_folder(self, path: str) -> bool:
         """Delete a file or folder."""
         if not path:
             return False
 
-        return rmapi.delete_file(path)
+        success = rmapi.delete_file(path)
+        snapshot = self._snapshot_for(path)
+        if success and snapshot:
+            snapshot.remove(self._visible_path(path))
+        return success
@@ -0,0 +1,113 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+def normalize_remote_path(path: str) -> str:
+    """Strip leading/trailing slashes so `/Zotero/read/` and `Zotero/read` compare equal."""
+    return path.strip("/")
+
+
+@dataclass
+class RemoteNode:
+    """A file or folder in the reMarkable cloud as seen by a snapshot"""
+
+    name: str
+    is_folder: bool
+    parent: Optional["RemoteNode"] = field(default=None, repr=False)
+    children: Dict[str, "RemoteNode"] = field(default_factory=dict, repr=False)
+
+    @property
+    def path(self) -> str:
+        parts = []
+        node: Optional[RemoteNode] = self
+        while node is not None and node.name:
+            parts.append(node.name)
+            node = node.parent
+        return "/".join(reversed(parts))
+
+
+class RemoteSnapshot:
+    """In-memory copy of a reMarkable subtree, fetched once and kept up to date locally.
+
+    Paths are the visible names rmapi uses, so `Zotero/unread/paper` rather
+    than `Zotero/unread/paper.pdf`. A push and a pull may change it at the
+    same time, so changes and listings are made under a lock.
+    """
+
+    def __init__(self, root: str):
+        self.root_path = normalize_remote_path(root)
+        self._lock = threading.RLock()
+        self._root = RemoteNode(name="", is_folder=True)
+        if self.root_path:
+            self.add(self.root_path, is_folder=True)
+
+    @classmethod
+    def from_entries(
+        cls, root: str, entries: Iterable[Tuple[str, bool]]
+    ) -> "RemoteSnapshot":
+        """Build a snapshot from `(path, is_folder)` pairs, e.g. the output of `rmapi find`."""
+        snapshot = cls(root)
+        for path, is_folder in entries:
+            path = normalize_remote_path(path)
+            if not snapshot.covers(path):
+                # `rmapi find` may print paths relative to the folder it searched
+                path = normalize_remote_path(f"{snapshot.root_path}/{path}")
+            snapshot.add(path, is_folder)
+        return snapshot
+
+    def covers(self, path: str) -> bool:
+        """Whether the snapshot is authoritative for `path`."""
+        path = normalize_remote_path(path)
+        if not self.root_path:
+            return True
+        return path == self.root_path or path.startswith(self.root_path + "/")
+
+    def lookup(self, path: str) -> Optional[RemoteNode]:
+        node = self._root
+        for part in self._parts(path):
+            child = node.children.get(part)
+            if child is None:
+                return None
+            node = child
+        return node
+
+    def add(self, path: str, is_folder: bool) -> RemoteNode:
+        """Insert a node, creating any missing parent folders."""
+        with self._lock:
+            node = self._root
+            parts = self._parts(path)
+            for i, part in enumerate(parts):
+                child = node.children.get(part)
+                if child is None:
+                    last = i == len(parts) - 1
+                    child = RemoteNode(
+                        name=part, is_folder=is_folder if last else True, parent=node
+                    )
+                    node.children[part] = child
+                node = child
+            return node
+
+    def remove(self, path: str) -> bool:
+        with self._lock:
+            node = self.lookup(path)
+            if node is None or node.parent is None:
+                return False
+            del node.parent.children[node.name]
+            node.parent = None
+            return True
+
+    def list_files(self, path: str) -> List[str]:
+        """Names of the files (not subfolders) directly inside `path`."""
+        with self._lock:
+            node = self.lookup(path)
+            if node is None or not node.is_folder:
+                return []
+            return [
+                child.name for child in node.children.values() if not child.is_folder
+            ]
+
+    @staticmethod
+    def _parts(path: str) -> List[str]:
+        path = normalize_remote_path(path)
+        return path.split("/") if path else []
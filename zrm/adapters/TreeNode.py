@@ -1,26 +1,48 @@
+import sys
 from dataclasses import dataclass, field
-from typing import List, Any, Dict
+from typing import Any, Callable, Dict, Optional, Tuple
 
 
-@dataclass
+@dataclass(slots=True)
 class TreeNode:
-    """Base class for all tree nodes"""
+    """Base class for all tree nodes
 
-    tags: List[str]
+    Nodes only keep what the sync needs to decide what to do with an item.
+    Tags are interned, as the same handful of tags repeat across a library,
+    and the full item data is looked up on demand through `load_metadata`
+    rather than kept on every node.
+    """
+
+    tags: Tuple[str, ...]
     handle: str
     type: str
     name: str
     path: str
-    metadata: Dict[str, Any] = field(default_factory=dict)
+    _load_metadata: Optional[Callable[[str], Dict[str, Any]]] = field(
+        default=None, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        self.tags = tuple(sys.intern(tag) for tag in self.tags)
+
+    def load_metadata(self) -> Dict[str, Any]:
+        """The item's full data, from the adapter's cache or else the API"""
+        if self._load_metadata is None:
+            return {}
+        return self._load_metadata(self.handle)
 
     @classmethod
-    def from_zotero_item(cls, zot_item: Dict[str, Any]):
+    def from_zotero_item(
+        cls,
+        zot_item: Dict[str, Any],
+        load_metadata: Optional[Callable[[str], Dict[str, Any]]] = None,
+    ):
         data = zot_item.get("data", {})
         return TreeNode(
             handle=data["key"],
             name=data.get("filename", ""),
-            type=data.get("itemType", ""),
-            tags=data.get("tags", []),
+            type=sys.intern(data.get("itemType", "")),
+            tags=tuple(tag["tag"] for tag in data.get("tags", [])),
             path=data.get("path", ""),
-            metadata=data,
+            _load_metadata=load_metadata,
         )
@@ -1,32 +1,249 @@
+import hashlib
+import json
+import logging
 import os
 import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Any, Dict, Optional
+from typing import List, Any, Dict, Iterable, Iterator, Optional
 
+import httpx
 from pyzotero.zotero import Zotero
 
 from zrm.adapters.TreeNode import TreeNode
 
+logger = logging.getLogger(__name__)
+
+# Attachments whose file lives in Zotero storage and can be uploaded to
+STORED_LINK_MODES = ("imported_file", "imported_url")
+# Most keys the Zotero API accepts in one `itemKey` filter
+ITEM_KEY_BATCH = 50
+
+
+def _slim_item(item: Dict) -> Dict:
+    """The parts of an item the sync reads, to keep in the item cache.
+
+    Items from the API also carry links, library and meta sections, which
+    the sync never reads apart from the size of an attachment's file. Writes
+    send an item's data alone, which holds its key and version as well.
+    """
+    slim = {key: item[key] for key in ("key", "version", "data") if key in item}
+    if "links" in item:
+        size = item["links"].get("enclosure", {}).get("length")
+    else:
+        # Already slimmed, as items loaded from the cache file are
+        size = item.get("size")
+    if size is not None:
+        slim["size"] = size
+    return slim
+
+
+class _ThreadZotero(Zotero):
+    """A pyzotero client for one thread, sharing another client's HTTP client.
+
+    pyzotero keeps the state of the last request on the client, so threads
+    cannot share one, but they can share its connection pool. The HTTP
+    client belongs to the client it was taken from, so this one does not
+    close it when it is collected.
+    """
+
+    def __init__(self, shared: Zotero):
+        super().__init__(
+            shared.library_id,
+            shared.library_type.removesuffix("s"),
+            shared.api_key,
+            preserve_json_order=shared.preserve_json_order,
+            locale=shared.locale,
+            local=shared.local,
+        )
+        self.endpoint = shared.endpoint
+        self.client.close()
+        self.client = shared.client
+
+    def __del__(self):
+        pass
+
 
 class ZoteroAPI:
-    def __init__(self, zotero_client: Zotero):
-        self.zot = zotero_client
+    """Zotero library access for the sync, safe to share between threads.
+
+    The item cache is guarded by a lock, and changes to one item are made
+    one at a time (see `_item_lock`), so a push and a pull running at the
+    same time cannot undo each other's tag or file changes.
+    """
+
+    def __init__(
+        self,
+        zotero_client: Zotero,
+        cache_path: Path | None = None,
+        storage_client: Optional[httpx.Client] = None,
+    ):
+        self._zot = zotero_client
+        # Uploads files to Zotero's storage service. Unlike the pyzotero
+        # client it sends no API key, which is only meant for Zotero's API
+        self.storage_client = storage_client or httpx.Client()
+        self._local = threading.local()
+        self._local.zot = zotero_client
+        self._cache_lock = threading.RLock()
+        self._item_locks: Dict[str, threading.RLock] = {}
         self._item_cache: dict[str, Dict] = {}
         self._collection_cache: dict[Any, Any] = {}
+        # key -> version, from the lightweight `format=versions` endpoint
+        self._versions: dict[str, int] = {}
+        self._versions_complete = False
+        # Items fetched during this run; items loaded from disk need a version check first
+        self._fresh: set[str] = set()
+        self._created: set[str] = set()
+        # Keys a batch fetch asked for that Zotero did not return
+        self._missing: set[str] = set()
+        self.cache_path = cache_path
+        if cache_path and cache_path.exists():
+            try:
+                with open(cache_path, encoding="utf-8") as f:
+                    cached = json.load(f)
+                if not isinstance(cached, dict):
+                    raise ValueError("it does not hold an object")
+                # Caches written before items were slimmed hold them whole
+                self._item_cache = {
+                    key: _slim_item(item) for key, item in cached.items()
+                }
+            except (OSError, ValueError, AttributeError, TypeError) as e:
+                # Only a cache, so an interrupted write just costs some requests
+                logger.warning(f"Ignoring the item cache {cache_path}: {e}")
+
+    @property
+    def zot(self) -> Zotero:
+        """The pyzotero client for the calling thread.
+
+        pyzotero keeps the state of the last request (its query and
+        pagination links) on the client, so every other thread gets a client
+        of its own with the same credentials, sharing the HTTP connection pool.
+        """
+        zot = getattr(self._local, "zot", None)
+        if zot is None:
+            zot = _ThreadZotero(self._zot)
+            self._local.zot = zot
+        return zot
+
+    @contextmanager
+    def _item_lock(self, key: str) -> Iterator[None]:
+        """Hold while reading and then changing an item, so concurrent changes are not lost."""
+        with self._cache_lock:
+            lock = self._item_locks.setdefault(key, threading.RLock())
+        with lock:
+            yield
+
+    def save_cache(self):
+        """Persist the item cache so the next run can reuse items whose version did not change."""
+        if self.cache_path:
+            temp_path = self.cache_path.with_suffix(".tmp")
+            with self._cache_lock, open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self._item_cache, f)
+            os.replace(temp_path, self.cache_path)
+
+    def refresh_versions(self, **kwargs) -> Dict[str, int]:
+        """Fetch key -> version for the whole library (or e.g. a `tag` filter) in one request."""
+        versions = self.zot.item_versions(**kwargs)
+        with self._cache_lock:
+            if kwargs:
+                self._versions.update(versions)
+            else:
+                self._versions = dict(versions)
+                self._versions_complete = True
+                # Forget cached items that were deleted since they were cached
+                for key in list(self._item_cache):
+                    if key not in self._versions:
+                        self._item_cache.pop(key)
+        return versions
+
+    def _cache_item(self, item: Dict) -> Dict:
+        """Cache what the sync reads of an item, and return that."""
+        key = item["key"]
+        item = _slim_item(item)
+        with self._cache_lock:
+            self._item_cache[key] = item
+            self._fresh.add(key)
+            if "version" in item:
+                self._versions[key] = item["version"]
+        return item
+
+    def _current_item(self, key: str) -> Optional[Dict]:
+        """The cached item, if it is known to be up to date."""
+        with self._cache_lock:
+            cached = self._item_cache.get(key)
+            if key in self._fresh or (
+                cached is not None
+                and key in self._versions
+                and cached.get("version") == self._versions[key]
+            ):
+                return cached
+            return None
 
     def _get_item_by_key(self, key: str) -> Optional[Dict]:
         """Get item by key with caching."""
-        if key not in self._item_cache:
-            self._item_cache[key] = self.zot.item(key)
-        return self._item_cache[key]
+        if key in self._missing:
+            return None
+        item = self._current_item(key)
+        if item is None:
+            item = self._cache_item(self.zot.item(key))
+        return item
+
+    def get_items(self, keys: Iterable[str]) -> Dict[str, Dict]:
+        """Get many items by key, fetching those not cached up to 50 per request.
+
+        Keys of items that do not exist are left out of the result.
+        """
+        items: Dict[str, Dict] = {}
+        to_fetch = []
+        for key in dict.fromkeys(keys):
+            item = None if key in self._missing else self._current_item(key)
+            if item is not None:
+                items[key] = item
+            elif key not in self._missing:
+                to_fetch.append(key)
+
+        for start in range(0, len(to_fetch), ITEM_KEY_BATCH):
+            batch = to_fetch[start : start + ITEM_KEY_BATCH]
+            for item in self.zot.everything(self.zot.items(itemKey=",".join(batch))):
+                items[item["key"]] = self._cache_item(item)
+            with self._cache_lock:
+                self._missing.update(key for key in batch if key not in items)
+        return items
+
+    def prefetch(self, keys: Iterable[str]):
+        """Load items into the cache in batches, before they are read one by one."""
+        self.get_items(keys)
+
+    def _item_data(self, key: str) -> Dict:
+        """The `data` of an item, used to load TreeNode metadata lazily.
+
+        Empty for an item that no longer exists.
+        """
+        item = self._get_item_by_key(key)
+        return item["data"] if item else {}
 
     def _invalidate_cache(self, item_key: str | None = None):
         """Invalidate cache for specific item or all items."""
-        if item_key:
-            self._item_cache.pop(item_key, None)
-        else:
-            self._item_cache.clear()
-            self._collection_cache.clear()
+        with self._cache_lock:
+            if item_key:
+                self._item_cache.pop(item_key, None)
+                self._fresh.discard(item_key)
+            else:
+                self._item_cache.clear()
+                self._collection_cache.clear()
+                self._fresh.clear()
+
+    def _track_created(self, key: str):
+        """Items created during this run exist even if the versions map predates them."""
+        self._created.add(key)
+
+    def _forget_deleted(self, key: str):
+        with self._cache_lock:
+            self._invalidate_cache(key)
+            self._versions.pop(key, None)
+            self._created.discard(key)
 
     def create_item(self, path: List[str]) -> str:
         # Create standalone item
@@ -34,7 +251,9 @@ class ZoteroAPI:
         item_template["title"] = path[0]
         result = self.zot.create_items([item_template])
         self._invalidate_cache()
-        return result["successful"]["0"]["key"]
+        key = result["successful"]["0"]["key"]
+        self._track_created(key)
+        return key
 
     def create_file(self, handle: str, filename: str, content: bytes) -> str:
         """Create a file attachment"""
@@ -49,6 +268,7 @@ class ZoteroAPI:
                 if result["success"]:
                     key = result["success"][0]["key"]
                     self._invalidate_cache(handle)
+                    self._track_created(key)
                     return key
                 elif result["unchanged"]:
                     key = result["unchanged"][0]["key"]
@@ -59,6 +279,10 @@ class ZoteroAPI:
 
     def item_exists(self, handle: str) -> bool:
         """Check if a node exists at the given path."""
+        if handle in self._versions or handle in self._created:
+            return True
+        if self._versions_complete or handle in self._missing:
+            return False
         return self._get_item_by_key(handle) is not None
 
     def get_file_content(self, handle: str) -> bytes | None:
@@ -77,51 +301,156 @@ class ZoteroAPI:
     def update_file_content(
         self, parent_handle: str, attachment_handle: str, content: bytes
     ) -> str:
-        """Update the content of an existing file attachment."""
-        old_attachment = self._get_item_by_key(attachment_handle)
-        if old_attachment is None:
-            raise RuntimeError(f"Was unable to find attachment {attachment_handle}")
+        """Replace the file of an existing attachment, keeping its key.
+
+        Stored attachments get the new file through Zotero's file upload
+        protocol, authorised against the md5 of the file they hold now. If
+        that md5 already matches `content`, nothing is uploaded. Attachments
+        that are not stored in Zotero (linked files) are recreated instead.
+        """
+        with self._item_lock(attachment_handle):
+            old_attachment = self._get_item_by_key(attachment_handle)
+            if old_attachment is None:
+                raise RuntimeError(f"Was unable to find attachment {attachment_handle}")
+
+            data = old_attachment["data"]
+            if data.get("linkMode") not in STORED_LINK_MODES:
+                return self._recreate_attachment(old_attachment, parent_handle, content)
+
+            md5 = hashlib.md5(content).hexdigest()
+            if data.get("md5") == md5:
+                return attachment_handle
+
+            self._upload_attachment_file(
+                attachment_handle,
+                data.get("filename") or data["title"],
+                content,
+                md5,
+                previous_md5=data.get("md5"),
+            )
+            self._invalidate_cache(attachment_handle)
+            return attachment_handle
+
+    def _upload_attachment_file(
+        self,
+        key: str,
+        filename: str,
+        content: bytes,
+        md5: str,
+        previous_md5: str | None,
+    ):
+        """Run the authorise / upload / register steps of the Zotero file upload protocol."""
+        file_url = (
+            f"{self.zot.endpoint}/{self.zot.library_type}/"
+            f"{self.zot.library_id}/items/{key}/file"
+        )
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if previous_md5:
+            headers["If-Match"] = previous_md5
         else:
-            name = old_attachment["data"]["title"]
-            with tempfile.TemporaryDirectory() as d:
-                with open(Path(d) / name, "wb") as f:
-                    f.write(content)
-                    self.zot.delete_item(old_attachment)
-                    new_attachment = self.zot.attachment_simple([f.name], parent_handle)
-                    old_key = old_attachment["data"]["key"]
-                    self._invalidate_cache(old_key)
-                    if new_attachment["success"]:
-                        new_key = new_attachment["success"][0]["key"]
-                    elif new_attachment["unchanged"]:
-                        new_key = new_attachment["unchanged"][0]["key"]
-                    else:
-                        raise RuntimeError(
-                            f"Was unable to find the key in the updated attachment: {new_attachment}"
-                        )
-                    return new_key
+            headers["If-None-Match"] = "*"
+
+        authorisation = self.zot.client.post(
+            file_url,
+            headers=headers,
+            data={
+                "md5": md5,
+                "filename": filename,
+                "filesize": str(len(content)),
+                "mtime": str(int(time.time() * 1000)),
+            },
+        )
+        if authorisation.status_code == 412:
+            raise RuntimeError(
+                f"The file of attachment {key} changed in Zotero since it was last read"
+            )
+        authorisation.raise_for_status()
+        upload = authorisation.json()
+        if upload.get("exists"):
+            return
+
+        upload_response = self.storage_client.post(
+            upload["url"],
+            headers={"Content-Type": upload["contentType"]},
+            content=upload["prefix"].encode() + content + upload["suffix"].encode(),
+        )
+        upload_response.raise_for_status()
+
+        registration = self.zot.client.post(
+            file_url,
+            headers=headers,
+            data={"upload": upload["uploadKey"]},
+        )
+        registration.raise_for_status()
+
+    def _recreate_attachment(
+        self, old_attachment: Dict, parent_handle: str, content: bytes
+    ) -> str:
+        """Delete an attachment and upload `content` as a new one, returning the new key."""
+        name = old_attachment["data"]["title"]
+        with tempfile.TemporaryDirectory() as d:
+            with open(Path(d) / name, "wb") as f:
+                f.write(content)
+                self.zot.delete_item(old_attachment["data"])
+                new_attachment = self.zot.attachment_simple([f.name], parent_handle)
+                old_key = old_attachment["data"]["key"]
+                self._forget_deleted(old_key)
+                if new_attachment["success"]:
+                    new_key = new_attachment["success"][0]["key"]
+                elif new_attachment["unchanged"]:
+                    new_key = new_attachment["unchanged"][0]["key"]
+                else:
+                    raise RuntimeError(
+                        f"Was unable to find the key in the updated attachment: {new_attachment}"
+                    )
+                self._track_created(new_key)
+                return new_key
 
     def list_children(self, handle: str) -> List[TreeNode]:
         """List the children of a collection node."""
-        return [TreeNode.from_zotero_item(child) for child in self.zot.children(handle)]
+        children = self.zot.everything(self.zot.children(handle))
+        for child in children:
+            self._cache_item(child)
+        return [
+            TreeNode.from_zotero_item(child, self._item_data) for child in children
+        ]
 
-    def add_tags(self, handle: str, tags: List[str]) -> bool:
-        """Add tags to an item."""
+    def attachment_size(self, handle: str) -> Optional[int]:
+        """The size in bytes of an attachment's file, if Zotero stores it."""
         item = self._get_item_by_key(handle)
-        self.zot.add_tags(item, *tags)
-        self._invalidate_cache(handle)
-        return True
+        return item.get("size") if item else None
 
-    def remove_tags(self, handle: str, tags: List[str]) -> bool:
-        """Remove tags from an item."""
-        item = self._get_item_by_key(handle)
-        if item:
-            current_tags = item.get("data", {}).get("tags", [])
-            new_tags = [tag for tag in current_tags if tag.get("tag") not in tags]
-            item["data"]["tags"] = new_tags
-            self.zot.update_item(item)
+    def add_tags(self, handle: str, tags: List[str]) -> bool:
+        """Add tags to an item, without a request if it has them all already.
+
+        Returns False if the item does not exist.
+        """
+        with self._item_lock(handle):
+            item = self._get_item_by_key(handle)
+            if item is None:
+                return False
+            current_tags = {tag.get("tag") for tag in item["data"].get("tags", [])}
+            if current_tags.issuperset(tags):
+                return True
+            # Change a copy, the cached item may be read by other threads
+            new_tags = list(item["data"].get("tags", []))
+            new_tags.extend({"tag": tag} for tag in tags if tag not in current_tags)
+            self.zot.update_item({**item["data"], "tags": new_tags})
             self._invalidate_cache(handle)
             return True
-        return False
+
+    def remove_tags(self, handle: str, tags: List[str]) -> bool:
+        """Remove tags from an item."""
+        with self._item_lock(handle):
+            item = self._get_item_by_key(handle)
+            if item:
+                current_tags = item.get("data", {}).get("tags", [])
+                new_tags = [tag for tag in current_tags if tag.get("tag") not in tags]
+                # Change a copy, the cached item may be read by other threads
+                self.zot.update_item({**item["data"], "tags": new_tags})
+                self._invalidate_cache(handle)
+                return True
+            return False
 
     def get_tags(self, handle: str) -> List[str]:
         """Get all tags for an item."""
@@ -138,4 +467,7 @@ class ZoteroAPI:
 
     def find_nodes_with_tag(self, tag: str) -> List[TreeNode]:
         """Find all items with a specific tag."""
-        return [TreeNode.from_zotero_item(item) for item in self.zot.items(tag=tag)]
+        items = self.zot.everything(self.zot.items(tag=tag))
+        for item in items:
+            self._cache_item(item)
+        return [TreeNode.from_zotero_item(item, self._item_data) for item in items]
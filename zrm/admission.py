@@ -0,0 +1,102 @@
+# admission.py
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Union
+
+logger = logging.getLogger("zotero_rM_bridge.admission")
+
+# What a payload is assumed to weigh before its real size is known
+DEFAULT_PAYLOAD_ESTIMATE = 16 * 2**20
+
+# Payloads above the spill threshold are held in a temporary file
+Payload = Union[bytes, BinaryIO, tempfile.SpooledTemporaryFile[bytes]]
+
+
+class ByteBudget:
+    """Admission control for the payload bytes all sync stages hold in memory.
+
+    A stage reserves the bytes it is about to hold before it starts on a
+    payload and releases them once the payload has been handed off (written
+    to disk or uploaded). Reservations wait while the budget is used up. A
+    payload larger than the whole budget is still let in once nothing else is
+    in flight, so it runs alone instead of waiting forever.
+
+    Without `max_bytes` nothing ever waits, but the bytes in flight are still
+    counted, so `peak` shows what a run needed.
+    """
+
+    def __init__(
+        self, max_bytes: Optional[int] = None, spill_threshold: Optional[int] = None
+    ):
+        self.max_bytes = max_bytes
+        if spill_threshold is None and max_bytes is not None:
+            spill_threshold = max_bytes // 4
+        # Payloads above this size are kept in a file rather than in memory
+        self.spill_threshold = spill_threshold
+        # What to reserve for a payload whose size is not known up front
+        self.payload_estimate = min(
+            DEFAULT_PAYLOAD_ESTIMATE, spill_threshold or DEFAULT_PAYLOAD_ESTIMATE
+        )
+        self.in_flight = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, nbytes: int) -> bool:
+        return (
+            self.max_bytes is None
+            or self.in_flight == 0
+            or self.in_flight + nbytes <= self.max_bytes
+        )
+
+    def _take(self, nbytes: int):
+        self.in_flight += nbytes
+        self.peak = max(self.peak, self.in_flight)
+
+    def try_acquire(self, nbytes: int) -> bool:
+        """Reserve `nbytes` if they fit right now, without waiting."""
+        with self._condition:
+            if not self._fits(nbytes):
+                return False
+            self._take(nbytes)
+            return True
+
+    def acquire(self, nbytes: int):
+        """Reserve `nbytes`, waiting until they fit in the budget."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(nbytes))
+            self._take(nbytes)
+
+    def release(self, nbytes: int):
+        with self._condition:
+            self.in_flight -= nbytes
+            self._condition.notify_all()
+
+    def resize(self, reserved: int, actual: int):
+        """Correct a reservation made on an estimate once the real size is known."""
+        with self._condition:
+            self._take(actual - reserved)
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int) -> Iterator[None]:
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+    def spill(self, content: bytes) -> Payload:
+        """Move a payload above the spill threshold out of memory into a temporary file."""
+        if self.spill_threshold is None or len(content) <= self.spill_threshold:
+            return content
+        spooled = tempfile.SpooledTemporaryFile(max_size=self.spill_threshold)
+        spooled.write(content)
+        spooled.seek(0)
+        return spooled
+
+
+def in_memory_size(payload: Payload) -> int:
+    """How many bytes of a (possibly spilled) payload are held in memory."""
+    return len(payload) if isinstance(payload, bytes) else 0
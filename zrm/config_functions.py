@@ -1,19 +1,158 @@
 # config_functions.py
 import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
 
 import yaml
 from pyzotero import zotero
 from webdav3.client import Client as wdClient
 
+from zrm.rmapi_policy import DEFAULT_TIMEOUTS, RmapiPolicy
+from zrm.scheduling import SchedulePolicy
+
 logger = logging.getLogger(__name__)
 
 
-def load_config(config_file):
+@dataclass
+class Profile:
+    """One Zotero library and reMarkable tablet to sync"""
+
+    name: str
+    zot: zotero.Zotero
+    webdav: Any
+    folders: Dict[str, str]
+    state_dir: Path
+    # rmapi config file holding the tablet's credentials, rmapi's default if unset
+    rmapi_config: Optional[str] = None
+    schedule: SchedulePolicy = field(default_factory=SchedulePolicy)
+    rmapi_policy: RmapiPolicy = field(default_factory=RmapiPolicy)
+    # Library versions this process's own writes produced, so the streaming
+    # API's reports of them are not taken for new changes
+    written_versions: Set[int] = field(default_factory=set, repr=False, compare=False)
+
+
+def read_config(config_file) -> Dict:
     with open(config_file, "r") as stream:
         try:
             config_dict = yaml.safe_load(stream)
         except yaml.YAMLError as exc:
             logger.exception(exc)
+    return config_dict
+
+
+def load_config(config_file):
+    return config_from_dict(read_config(config_file))
+
+
+def load_profiles(config_file) -> List[Profile]:
+    """Read the profiles in a config file.
+
+    A plain config file is a single profile. A file with a `PROFILES` section
+    holds one profile per entry, each falling back to the file's top level keys
+    for settings it does not set itself. Every profile keeps its sync state in
+    its own directory.
+    """
+    config_file = Path(config_file)
+    config_dict = read_config(config_file)
+    state_dir = get_state_dir(config_file)
+    if config_file.name != "config.yml":
+        state_dir = state_dir / config_file.stem
+
+    if "PROFILES" not in config_dict:
+        return [_profile(config_file.stem, config_dict, state_dir)]
+
+    defaults = {key: value for key, value in config_dict.items() if key != "PROFILES"}
+    return [
+        _profile(name, {**defaults, **profile_dict}, state_dir / name)
+        for name, profile_dict in config_dict["PROFILES"].items()
+    ]
+
+
+def load_all_profiles(config_files) -> List[Profile]:
+    """Read the profiles in several config files.
+
+    Profiles from different files that share a name, like two plain
+    `config.yml` files, are told apart by the path of their config file.
+    """
+    loaded = [
+        (Path(path), profile)
+        for path in config_files
+        for profile in load_profiles(path)
+    ]
+    names = Counter(profile.name for _, profile in loaded)
+    for path, profile in loaded:
+        if names[profile.name] > 1:
+            profile.name = f"{profile.name} ({path})"
+    profiles = [profile for _, profile in loaded]
+    for name, count in Counter(profile.name for profile in profiles).items():
+        if count > 1:
+            raise ValueError(f"Profile {name} is configured {count} times")
+    return profiles
+
+
+def _profile(name: str, config_dict: Dict, state_dir: Path) -> Profile:
+    zot, webdav, folders = config_from_dict(config_dict)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    return Profile(
+        name=name,
+        zot=zot,
+        webdav=webdav,
+        folders=folders,
+        state_dir=state_dir,
+        rmapi_config=config_dict.get("RMAPI_CONFIG"),
+        schedule=schedule_from_dict(config_dict),
+        rmapi_policy=rmapi_policy_from_dict(config_dict),
+    )
+
+
+def schedule_from_dict(config_dict: Dict) -> SchedulePolicy:
+    """The scheduling settings of a config, falling back to the defaults for those not set."""
+    defaults = SchedulePolicy()
+    urgent_tags = config_dict.get("URGENT_TAGS", defaults.urgent_tags)
+    if isinstance(urgent_tags, str):
+        urgent_tags = [urgent_tags]
+    large_file_mb = config_dict.get("LARGE_FILE_MB")
+    return SchedulePolicy(
+        urgent_tags=tuple(urgent_tags),
+        order=config_dict.get("SYNC_ORDER", defaults.order),
+        large_file_bytes=int(float(large_file_mb) * 2**20)
+        if large_file_mb is not None
+        else defaults.large_file_bytes,
+    )
+
+
+def _flag(value) -> bool:
+    """A yes/no setting, written as a YAML boolean or as a string like "True"."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "1")
+    return bool(value)
+
+
+def rmapi_policy_from_dict(config_dict: Dict) -> RmapiPolicy:
+    """The rmapi timeouts and retries of a config, falling back to the defaults for those not set.
+
+    `RMAPI_TIMEOUTS` is either a number of seconds for every command or a
+    mapping from command to seconds.
+    """
+    defaults = RmapiPolicy()
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    configured = config_dict.get("RMAPI_TIMEOUTS", {})
+    if isinstance(configured, dict):
+        timeouts.update(
+            (command, float(seconds)) for command, seconds in configured.items()
+        )
+    else:
+        timeouts = {command: float(configured) for command in timeouts}
+    return RmapiPolicy(
+        timeouts=timeouts,
+        retries=int(config_dict.get("RMAPI_RETRIES", defaults.retries)),
+        hedge=_flag(config_dict.get("RMAPI_HEDGE", defaults.hedge)),
+    )
+
+
+def config_from_dict(config_dict: Dict):
     zot = zotero.Zotero(
         config_dict["LIBRARY_ID"], config_dict["LIBRARY_TYPE"], config_dict["API_KEY"]
     )
@@ -91,3 +230,10 @@ def normalize_rm_path(folder_name: str) -> str:
             return s[len("zotero/") :]
         case _:
             return folder_name
+
+
+def get_state_dir(config_file) -> Path:
+    """Directory next to the config file where sync state (journal, caches) is kept"""
+    state_dir = Path(config_file).parent / ".zrm"
+    state_dir.mkdir(parents=True, exist_ok=True)
+    return state_dir
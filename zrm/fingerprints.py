@@ -0,0 +1,67 @@
+# fingerprints.py
+import hashlib
+import json
+import logging
+import os
+import threading
+import zipfile
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger("zotero_rM_bridge.fingerprints")
+
+ANNOTATION_SUFFIXES = (".rm", ".content")
+
+
+def annotation_fingerprint(rmn_path: Path) -> str:
+    """Hash the annotation layers (`.rm` pages) and `.content` inside a downloaded document.
+
+    The PDF itself and bookkeeping files like `.metadata` are left out, so a
+    document that was only moved between folders keeps its fingerprint.
+    """
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(rmn_path) as zf:
+        names = sorted(
+            name for name in zf.namelist() if name.endswith(ANNOTATION_SUFFIXES)
+        )
+        for name in names:
+            digest.update(name.encode())
+            digest.update(b"\0")
+            with zf.open(name) as f:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FingerprintStore:
+    """The annotation fingerprint last pushed to each Zotero attachment, kept in a JSON file"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._fingerprints: Dict[str, str] = {}
+        if self.path.exists():
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    fingerprints = json.load(f)
+                if not isinstance(fingerprints, dict):
+                    raise ValueError("it does not hold an object")
+                self._fingerprints = fingerprints
+            except (OSError, ValueError) as e:
+                # Without them unchanged annotations are only rendered again
+                logger.warning(f"Ignoring the fingerprints in {self.path}: {e}")
+
+    def get(self, attachment_handle: str) -> Optional[str]:
+        with self._lock:
+            return self._fingerprints.get(attachment_handle)
+
+    def set(self, attachment_handle: str, fingerprint: str, replaces: str | None = None):
+        """Store a fingerprint, dropping the one of the attachment it replaced."""
+        with self._lock:
+            if replaces:
+                self._fingerprints.pop(replaces, None)
+            self._fingerprints[attachment_handle] = fingerprint
+            temp_path = self.path.with_suffix(".tmp")
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self._fingerprints, f)
+            os.replace(temp_path, self.path)
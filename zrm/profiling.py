@@ -0,0 +1,301 @@
+# profiling.py
+"""CPU profiles of sync runs, split by phase (push, pull, render).
+
+`start()` begins a session in one of two modes:
+
+- `cprofile`: every phase is recorded with cProfile and saved as
+  `<prefix>-<phase>.prof`.
+- `sampling`: a background thread samples the stacks of all threads taking
+  part in a phase every few milliseconds. The samples are saved as collapsed
+  stacks (`<prefix>.collapsed`, one `phase;frame;...;frame count` line per
+  stack) that flame graph tools read. This is cheap enough for long runs.
+
+Work handed to thread pools is attributed to the phase that submitted it
+through `wrap()`, and work sent to process pools through
+`wrap_for_process()`, which profiles the call in the child with cProfile.
+From Python 3.12 cProfile can only be enabled on one thread at a time, and
+only records that thread, so in `cprofile` mode the threads that cannot
+start a profiler of their own are sampled instead.
+When the session stops, the files are written to the output directory and
+the top functions of every phase are printed.
+"""
+
+import cProfile
+import functools
+import io
+import itertools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("zotero_rM_bridge.profiling")
+
+DETERMINISTIC = "cprofile"
+SAMPLING = "sampling"
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 20
+# Phase for work that does not run inside a named phase
+DEFAULT_PHASE = "main"
+
+_session: Optional["ProfilingSession"] = None
+_process_calls = itertools.count()
+
+
+class ProfilingSession:
+    def __init__(
+        self,
+        mode: str,
+        output_dir: Path,
+        sample_interval: float = SAMPLE_INTERVAL,
+    ):
+        if mode not in (DETERMINISTIC, SAMPLING):
+            raise ValueError(f"Unknown profiling mode {mode}")
+        self.mode = mode
+        self.output_dir = Path(output_dir)
+        self.prefix = f"sync-profile-{time.strftime('%Y%m%d-%H%M%S')}"
+        self.sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._samples: Counter = Counter()
+        # thread ident -> the phase the thread is working in
+        self._thread_phases: Dict[int, str] = {}
+        # thread ident -> phases it is sampled in because cProfile was taken
+        self._sampled_threads: Counter = Counter()
+        self._stopped = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        if mode == SAMPLING:
+            self._start_sampler()
+
+    def _start_sampler(self):
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(
+                    target=self._sample, name="profiling-sampler", daemon=True
+                )
+                self._sampler.start()
+
+    @property
+    def process_dir(self) -> Path:
+        return self.output_dir / f"{self.prefix}-processes"
+
+    def current_phase(self) -> Optional[str]:
+        phases = getattr(self._local, "phases", None)
+        return phases[-1] if phases else None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Attribute the work done by this thread inside the block to phase `name`."""
+        ident = threading.get_ident()
+        phases = self._local.__dict__.setdefault("phases", [])
+        outer = getattr(self._local, "profiler", None)
+        phases.append(name)
+        with self._lock:
+            self._thread_phases[ident] = name
+
+        profiler = None
+        sampled = False
+        if self.mode == DETERMINISTIC:
+            if outer:
+                outer.disable()
+            profiler = self._enable_profiler()
+            sampled = profiler is None
+            if sampled:
+                with self._lock:
+                    self._sampled_threads[ident] += 1
+                self._start_sampler()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                self._add_stats(name, pstats.Stats(profiler))
+            self._local.profiler = outer
+            if outer:
+                self._resume(outer)
+            phases.pop()
+            with self._lock:
+                if sampled:
+                    self._sampled_threads[ident] -= 1
+                    if not self._sampled_threads[ident]:
+                        del self._sampled_threads[ident]
+                if phases:
+                    self._thread_phases[ident] = phases[-1]
+                else:
+                    self._thread_phases.pop(ident, None)
+
+    def _enable_profiler(self) -> Optional[cProfile.Profile]:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # From Python 3.12 only one profiler can be active per process, and
+            # it only records the thread that enabled it
+            return None
+        self._local.profiler = profiler
+        return profiler
+
+    @staticmethod
+    def _resume(profiler: cProfile.Profile):
+        try:
+            profiler.enable()
+        except ValueError:
+            pass
+
+    def _add_stats(self, phase: str, stats: pstats.Stats):
+        with self._lock:
+            if phase in self._stats:
+                self._stats[phase].add(stats)
+            else:
+                self._stats[phase] = stats
+
+    def wrap(self, fn: Callable) -> Callable:
+        """Run `fn` in the current phase, from whichever thread ends up calling it."""
+        phase = self.current_phase() or DEFAULT_PHASE
+
+        @functools.wraps(fn)
+        def run_in_phase(*args, **kwargs):
+            with self.phase(phase):
+                return fn(*args, **kwargs)
+
+        return run_in_phase
+
+    def wrap_for_process(self, fn: Callable) -> Callable:
+        """Profile `fn` with cProfile in whichever process ends up calling it."""
+        return functools.partial(
+            _profile_in_process,
+            fn,
+            str(self.process_dir),
+            self.current_phase() or DEFAULT_PHASE,
+        )
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.sample_interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, frame in frames.items():
+                    phase = self._thread_phases.get(ident)
+                    if ident == own or phase is None:
+                        continue
+                    # In cprofile mode only the threads cProfile cannot record
+                    if self.mode == DETERMINISTIC and not self._sampled_threads[ident]:
+                        continue
+                    self._samples[(phase, _stack(frame))] += 1
+
+    def stop(self) -> List[Path]:
+        """Stop profiling, write the results and print the hottest functions of each phase."""
+        self._stopped.set()
+        if self._sampler:
+            self._sampler.join()
+        self._collect_process_stats()
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        written = []
+        for phase, stats in sorted(self._stats.items()):
+            path = self.output_dir / f"{self.prefix}-{phase}.prof"
+            stats.dump_stats(path)
+            written.append(path)
+            print(_top_by_cumulative_time(phase, stats))
+        if self._samples:
+            path = self.output_dir / f"{self.prefix}.collapsed"
+            with open(path, "w", encoding="utf-8") as f:
+                for (phase, stack), count in sorted(self._samples.items()):
+                    f.write(f"{';'.join((phase,) + stack)} {count}\n")
+            written.append(path)
+            print(self._top_by_samples())
+        for path in written:
+            logger.info(f"Wrote profile {path}")
+        return written
+
+    def _collect_process_stats(self):
+        if not self.process_dir.is_dir():
+            return
+        for path in sorted(self.process_dir.glob("*.prof")):
+            phase = path.name.rsplit("-", 2)[0]
+            self._add_stats(phase, pstats.Stats(str(path)))
+
+    def _top_by_samples(self) -> str:
+        lines = []
+        phases = sorted({phase for phase, _ in self._samples})
+        for phase in phases:
+            inclusive: Counter = Counter()
+            for (sample_phase, stack), count in self._samples.items():
+                if sample_phase == phase:
+                    for frame in set(stack):
+                        inclusive[frame] += count
+            lines.append(f"Top functions in {phase} by sampled time:")
+            for frame, count in inclusive.most_common(TOP_FUNCTIONS):
+                lines.append(f"  {count * self.sample_interval:8.3f}s  {frame}")
+        return "\n".join(lines)
+
+
+def _stack(frame) -> Tuple[str, ...]:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def _top_by_cumulative_time(phase: str, stats: pstats.Stats) -> str:
+    output = io.StringIO()
+    report = pstats.Stats(stream=output)
+    report.add(stats)
+    report.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+    return f"Top functions in {phase} by cumulative time:\n{output.getvalue()}"
+
+
+def _profile_in_process(fn: Callable, output_dir: str, phase: str, *args, **kwargs):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+        os.makedirs(output_dir, exist_ok=True)
+        name = f"{phase}-{os.getpid()}-{next(_process_calls)}.prof"
+        profiler.dump_stats(os.path.join(output_dir, name))
+
+
+def start(mode: str, output_dir: Path) -> ProfilingSession:
+    global _session
+    _session = ProfilingSession(mode, output_dir)
+    return _session
+
+
+def stop() -> List[Path]:
+    global _session
+    if _session is None:
+        return []
+    session, _session = _session, None
+    return session.stop()
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Attribute the work inside the block to phase `name` when profiling is on."""
+    if _session is None:
+        yield
+    else:
+        with _session.phase(name):
+            yield
+
+
+def wrap(fn: Callable) -> Callable:
+    """Keep work handed to a thread pool in the submitting phase when profiling is on."""
+    return _session.wrap(fn) if _session else fn
+
+
+def wrap_for_process(fn: Callable) -> Callable:
+    """Profile work handed to a process pool when profiling is on."""
+    return _session.wrap_for_process(fn) if _session else fn
@@ -0,0 +1,229 @@
+# render.py
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+import httpx
+from remarks import remarks
+
+logger = logging.getLogger("zotero_rM_bridge.render")
+
+RENDERED_PDF_SUFFIX = " _remarks.pdf"
+RENDERED_MD_SUFFIX = " _obsidian.md"
+
+
+@dataclass
+class RenderedDocument:
+    name: str
+    pdf: Path
+    markdown: Path
+
+
+class RenderBackend(ABC):
+    """Turns a downloaded reMarkable document into an annotated PDF and markdown"""
+
+    @abstractmethod
+    def render(self, rmn_path: Path, output_dir: Path) -> RenderedDocument:
+        """Render `rmn_path` into `output_dir` and return where the outputs were written."""
+
+
+def rendered_outputs(name: str, output_dir: Path) -> RenderedDocument:
+    """The files remarks writes for a document, failing if the PDF is missing"""
+    rendered = RenderedDocument(
+        name=name,
+        pdf=output_dir / f"{name}{RENDERED_PDF_SUFFIX}",
+        markdown=output_dir / f"{name}{RENDERED_MD_SUFFIX}",
+    )
+    if not rendered.pdf.is_file():
+        raise RuntimeError(f"remarks did not produce a PDF for {name}")
+    return rendered
+
+
+def find_rendered_document(output_dir: Path) -> RenderedDocument:
+    rendered_pdf = [
+        file for file in os.listdir(output_dir) if file.endswith(RENDERED_PDF_SUFFIX)
+    ]
+    if not rendered_pdf:
+        raise RuntimeError("Was unable to find the processed pdf")
+    return rendered_outputs(
+        rendered_pdf[0].removesuffix(RENDERED_PDF_SUFFIX), output_dir
+    )
+
+
+# The files of a document remarks reads: its own files, and its pages and highlights
+RENDER_INPUT_SUFFIXES = (".metadata", ".content", ".pagedata", ".pdf", ".epub")
+RENDER_INPUT_FOLDERS = ("", ".highlights")
+
+
+def render_inputs(names: List[str], metadata_name: str) -> List[str]:
+    """The members of a document's zip remarks reads, leaving out thumbnails and caches"""
+    document = metadata_name.removesuffix(".metadata")
+    files = {document + suffix for suffix in RENDER_INPUT_SUFFIXES}
+    folders = tuple(document + folder + "/" for folder in RENDER_INPUT_FOLDERS)
+    return [name for name in names if name in files or name.startswith(folders)]
+
+
+class InProcessRenderer(RenderBackend):
+    """Renders with the bundled remarks package in the current process.
+
+    The downloaded document is opened as a zip in place: its name comes
+    straight from the `.metadata` entry, and remarks' `process_document` is
+    called on it directly, so the output paths are known up front instead of
+    being found by scanning the output directory. Only the members remarks
+    reads are unpacked for it.
+    """
+
+    def render(self, rmn_path: Path, output_dir: Path) -> RenderedDocument:
+        with zipfile.ZipFile(rmn_path) as zf:
+            metadata_names = [
+                name for name in zf.namelist() if name.endswith(".metadata")
+            ]
+            if not metadata_names:
+                raise RuntimeError(f"{rmn_path.name} does not contain a document")
+            metadata_name = metadata_names[0]
+            name = json.loads(zf.read(metadata_name))["visibleName"]
+
+            with tempfile.TemporaryDirectory() as extract_dir:
+                # remarks reads the pages from disk, thumbnails and caches stay packed
+                zf.extractall(extract_dir, render_inputs(zf.namelist(), metadata_name))
+                metadata_path = Path(extract_dir) / metadata_name.lstrip("/")
+                remarks.process_document(metadata_path, Path(name), output_dir)
+
+        return rendered_outputs(name, output_dir)
+
+
+class RenderPool(RenderBackend):
+    """Shares one backend between concurrent syncs, rendering at most `max_concurrent` documents at a time"""
+
+    def __init__(self, backend: RenderBackend, max_concurrent: Optional[int] = None):
+        self.backend = backend
+        self._slots = threading.BoundedSemaphore(max_concurrent or os.cpu_count() or 1)
+
+    def render(self, rmn_path: Path, output_dir: Path) -> RenderedDocument:
+        with self._slots:
+            return self.backend.render(rmn_path, output_dir)
+
+
+@dataclass
+class RenderWorker:
+    url: str
+    healthy: bool = True
+    checked_at: float = 0.0
+    in_flight: int = 0
+
+
+class RemarksServerRenderer(RenderBackend):
+    """Renders on a pool of `remarks.server` workers over HTTP.
+
+    Each document is POSTed as the `file` field of a multipart form to
+    `<url>/process`, which answers with a zip of remarks' output. Workers are
+    health checked through `<url>/health`, requests go to the healthy worker
+    with the fewest requests in flight, and a worker that fails or times out
+    is taken out of rotation until its next successful health check.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        timeout: float = 300,
+        health_timeout: float = 5,
+        health_interval: float = 30,
+    ):
+        if not urls:
+            raise ValueError("RemarksServerRenderer needs at least one server URL")
+        self.workers = [RenderWorker(url.rstrip("/")) for url in urls]
+        self.timeout = timeout
+        self.health_timeout = health_timeout
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._client = httpx.Client()
+
+    def _probe(self, worker: RenderWorker) -> bool:
+        try:
+            response = self._client.get(
+                f"{worker.url}/health", timeout=self.health_timeout
+            )
+        except httpx.HTTPError as e:
+            logger.warning(f"Render server {worker.url} failed its health check: {e}")
+            return False
+        return response.status_code == 200
+
+    def _record_health(self, worker: RenderWorker, healthy: bool):
+        with self._lock:
+            worker.healthy = healthy
+            worker.checked_at = time.monotonic()
+
+    def check_health(self, worker: RenderWorker) -> bool:
+        self._record_health(worker, self._probe(worker))
+        return worker.healthy
+
+    def _acquire_worker(self, exclude: List[RenderWorker]) -> Optional[RenderWorker]:
+        with self._lock:
+            now = time.monotonic()
+            candidates = [worker for worker in self.workers if worker not in exclude]
+            due = [
+                worker
+                for worker in candidates
+                if now - worker.checked_at > self.health_interval
+            ]
+        # Probe without the lock, so a slow server does not hold up every render
+        for worker in due:
+            self.check_health(worker)
+        with self._lock:
+            healthy = [worker for worker in candidates if worker.healthy]
+            if not healthy:
+                return None
+            worker = min(healthy, key=lambda w: w.in_flight)
+            worker.in_flight += 1
+            return worker
+
+    def _release_worker(self, worker: RenderWorker):
+        with self._lock:
+            worker.in_flight -= 1
+
+    def render(self, rmn_path: Path, output_dir: Path) -> RenderedDocument:
+        tried: List[RenderWorker] = []
+        while True:
+            worker = self._acquire_worker(tried)
+            if worker is None:
+                raise RuntimeError(
+                    f"No healthy render server left to render {rmn_path.name}"
+                )
+            tried.append(worker)
+            try:
+                archive = self._post_document(worker, rmn_path)
+            except httpx.TransportError as e:
+                # The server did not answer, so another one may
+                logger.warning(f"Render server {worker.url} failed: {e}")
+                self._record_health(worker, False)
+                continue
+            except httpx.HTTPStatusError as e:
+                # The server answered, but could not render this document
+                raise RuntimeError(
+                    f"Render server {worker.url} could not render {rmn_path.name}: {e}"
+                ) from e
+            finally:
+                self._release_worker(worker)
+
+            with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+                zf.extractall(output_dir)
+            return find_rendered_document(output_dir)
+
+    def _post_document(self, worker: RenderWorker, rmn_path: Path) -> bytes:
+        with open(rmn_path, "rb") as f:
+            response = self._client.post(
+                f"{worker.url}/process",
+                files={"file": (rmn_path.name, f, "application/octet-stream")},
+                timeout=self.timeout,
+            )
+        response.raise_for_status()
+        return response.content
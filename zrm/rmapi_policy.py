@@ -0,0 +1,172 @@
+# rmapi_policy.py
+import re
+import statistics
+import threading
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional
+
+# Seconds an rmapi command may take before it is killed. Transfers get more
+# time than listings, mget and mput the most as they move whole folders.
+DEFAULT_TIMEOUTS = {
+    "ls": 60.0,
+    "find": 120.0,
+    "get": 300.0,
+    "rm": 60.0,
+    "put": 600.0,
+    "mget": 3600.0,
+    "mput": 3600.0,
+}
+FALLBACK_TIMEOUT = 300.0
+
+# Commands that only read, so running them again, or twice at once, is safe
+IDEMPOTENT = ("ls", "find", "get", "mget")
+HEDGEABLE = ("ls", "get")
+
+# Why a command failed
+TIMEOUT = "timeout"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+# rmapi's messages for failures a retry can fix: network trouble and the
+# cloud asking us to back off
+_TRANSIENT_ERRORS = (
+    "timeout",
+    "timed out",
+    "connection reset",
+    "connection refused",
+    "broken pipe",
+    "unexpected eof",
+    "no such host",
+    "tls handshake",
+    "temporarily unavailable",
+    "too many requests",
+    "service unavailable",
+    "bad gateway",
+)
+_TRANSIENT_STATUS = re.compile(r"\b(?:429|50[0234])\b")
+
+# Successful calls needed before their p95 is trusted for hedging
+MIN_SAMPLES = 20
+_LATENCY_WINDOW = 500
+
+
+def classify_failure(stderr: str) -> str:
+    """Whether a failed rmapi call may work when retried, from its error output.
+
+    Calls that ran past their timeout are told apart by the caller.
+    """
+    stderr = stderr.lower()
+    if any(error in stderr for error in _TRANSIENT_ERRORS):
+        return TRANSIENT
+    if _TRANSIENT_STATUS.search(stderr):
+        return TRANSIENT
+    return PERMANENT
+
+
+@dataclass(frozen=True)
+class RmapiPolicy:
+    """How long rmapi commands may run and what happens when they fail.
+
+    A command running longer than its timeout is killed together with every
+    process it started. Transient failures are retried up to `retries` times
+    with exponential backoff; timeouts only for commands that do not change
+    the tablet, as a timed out upload may have gone through. With `hedge`
+    set, an `ls` or `get` still running after the p95 latency of earlier
+    calls gets a second copy started next to it, and the first to finish wins.
+    """
+
+    timeouts: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_TIMEOUTS))
+    retries: int = 2
+    backoff: float = 1.0
+    hedge: bool = False
+
+    def timeout(self, command: str) -> float:
+        return self.timeouts.get(command, FALLBACK_TIMEOUT)
+
+    def should_retry(self, command: str, failure: str, attempt: int) -> bool:
+        """Whether to retry `command` after its `attempt`th failure, counting from 1."""
+        if attempt > self.retries or failure == PERMANENT:
+            return False
+        return failure == TRANSIENT or command in IDEMPOTENT
+
+    def delay(self, attempt: int) -> float:
+        return self.backoff * 2 ** (attempt - 1)
+
+
+class CallStats:
+    """Latencies and outcomes of rmapi calls, per command.
+
+    Feeds hedging with the recent p95 latency of each command and the run
+    summary with what happened. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, Deque[float]] = defaultdict(
+            lambda: deque(maxlen=_LATENCY_WINDOW)
+        )
+        self._events: Dict[str, Counter] = defaultdict(Counter)
+
+    def reset(self):
+        """Forget earlier calls, so the next summary only covers what follows."""
+        with self._lock:
+            self._latencies.clear()
+            self._events.clear()
+
+    def record(self, command: str, elapsed: float, outcome: Optional[str] = None):
+        """Record a finished call; `outcome` is None for success or the kind of failure."""
+        with self._lock:
+            self._events[command]["calls"] += 1
+            if outcome is None:
+                self._latencies[command].append(elapsed)
+            else:
+                self._events[command][outcome] += 1
+
+    def count(self, command: str, event: str):
+        with self._lock:
+            self._events[command][event] += 1
+
+    def events(self, command: str) -> Counter:
+        with self._lock:
+            return Counter(self._events[command])
+
+    def p95(self, command: str) -> Optional[float]:
+        with self._lock:
+            latencies = list(self._latencies[command])
+        if len(latencies) < MIN_SAMPLES:
+            return None
+        return statistics.quantiles(latencies, n=20)[-1]
+
+    def summary(self) -> List[str]:
+        """One line per command that was run, for the log at the end of a run."""
+        with self._lock:
+            commands = sorted(self._events)
+            snapshot = {
+                command: (
+                    sorted(self._latencies[command]),
+                    Counter(self._events[command]),
+                )
+                for command in commands
+            }
+        lines = []
+        for command, (latencies, events) in snapshot.items():
+            line = f"rmapi {command}: {events['calls']} calls"
+            if latencies:
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                line += (
+                    f", p50 {statistics.median(latencies):.2f}s, p95 {p95:.2f}s,"
+                    f" max {latencies[-1]:.2f}s"
+                )
+            for event, label in (
+                (TIMEOUT, "timed out"),
+                (TRANSIENT, "failed transiently"),
+                (PERMANENT, "failed"),
+                ("retried", "retried"),
+                ("hedged", "hedged"),
+                ("hedge won", "won by the hedge"),
+            ):
+                if events[event]:
+                    line += f", {events[event]} {label}"
+            lines.append(line)
+        return lines
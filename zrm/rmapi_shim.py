@@ -1,14 +1,73 @@
 # rmapi_shim.py
 import os
+import signal
 import subprocess
 import logging
 import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from functools import cache
 
+import httpx
+import yaml
+
+from zrm.rmapi_policy import (
+    HEDGEABLE,
+    TIMEOUT,
+    CallStats,
+    RmapiPolicy,
+    classify_failure,
+)
+
 logger = logging.getLogger(__name__)
 
+# The rmapi config file, and so the tablet, that commands in this context talk to
+_rmapi_config: ContextVar[Optional[str]] = ContextVar("rmapi_config", default=None)
+_policy: ContextVar[RmapiPolicy] = ContextVar("rmapi_policy", default=RmapiPolicy())
+
+# Commands that download into their working directory. Every attempt gets a
+# directory of its own, so a killed attempt never leaves a partial file behind
+_WRITES_TO_CWD = ("get",)
+_POLL_INTERVAL = 0.01
+
+# Every rmapi call of the run, for hedging and the run summary
+stats = CallStats()
+
+# rmapi talks to this host unless RMAPI_HOST points it at another cloud
+SYNC_HOST = "https://internal.cloud.remarkable.com"
+ROOT_REQUEST_TIMEOUT = 10.0
+
+
+@contextmanager
+def use_config(config_path: Optional[str], policy: Optional[RmapiPolicy] = None):
+    """Run the rmapi commands inside the block against another tablet's config file.
+
+    With a `policy`, the commands also get its timeouts and retries.
+    """
+    token = _rmapi_config.set(config_path)
+    policy_token = _policy.set(policy) if policy else None
+    try:
+        yield
+    finally:
+        if policy_token:
+            _policy.reset(policy_token)
+        _rmapi_config.reset(token)
+
+
+def current_policy() -> RmapiPolicy:
+    return _policy.get()
+
+
+def _with_config(kwargs: dict) -> dict:
+    config_path = _rmapi_config.get()
+    if config_path and "env" not in kwargs:
+        kwargs["env"] = {**os.environ, "RMAPI_CONFIG": config_path}
+    return kwargs
+
 
 @cache
 def get_rmapi_location() -> str:
@@ -19,18 +78,205 @@ def get_rmapi_location() -> str:
     return location
 
 
+def config_path() -> Path:
+    """The rmapi config file commands in this context use, found the way rmapi finds it."""
+    configured = _rmapi_config.get() or os.environ.get("RMAPI_CONFIG")
+    if configured:
+        return Path(configured)
+    legacy = Path.home() / ".rmapi"
+    if legacy.exists():
+        return legacy
+    config_home = os.environ.get("XDG_CONFIG_HOME") or Path.home() / ".config"
+    return Path(config_home) / "rmapi" / "rmapi.conf"
+
+
+def root_state() -> Optional[Dict]:
+    """The hash and generation of the cloud's root index, from one request.
+
+    The request is authorised with the user token rmapi keeps in its config
+    file. Returns None when that is not possible, e.g. before rmapi has
+    logged in, once the token expired (the next rmapi command renews it) or
+    when the cloud is unreachable.
+    """
+    try:
+        with open(config_path()) as f:
+            config = yaml.safe_load(f)
+        token = config.get("usertoken") if isinstance(config, dict) else None
+        if not token:
+            return None
+        host = os.environ.get("RMAPI_HOST") or SYNC_HOST
+        response = httpx.get(
+            f"{host.rstrip('/')}/sync/v4/root",
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=ROOT_REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+        root = response.json()
+        return {"hash": root["hash"], "generation": root["generation"]}
+    except (OSError, yaml.YAMLError, httpx.HTTPError, ValueError, KeyError) as e:
+        logger.info(f"Could not read the root of the reMarkable cloud: {e}")
+        return None
+
+
+def kill_process_group(process: subprocess.Popen):
+    """Kill an rmapi process started in its own session and everything it started."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+class _Attempt:
+    """One rmapi process, writing its output to files so it never blocks on a full pipe."""
+
+    def __init__(self, args: List[str], cwd: Optional[str], kwargs: dict):
+        self.cwd = cwd
+        self.stdout = tempfile.TemporaryFile("w+")
+        self.stderr = tempfile.TemporaryFile("w+")
+        self.started = time.monotonic()
+        self.process = subprocess.Popen(
+            args,
+            cwd=cwd,
+            stdout=self.stdout,
+            stderr=self.stderr,
+            text=True,
+            start_new_session=True,
+            **kwargs,
+        )
+
+    def result(self) -> subprocess.CompletedProcess:
+        self.stdout.seek(0)
+        self.stderr.seek(0)
+        return subprocess.CompletedProcess(
+            self.process.args,
+            self.process.returncode,
+            self.stdout.read(),
+            self.stderr.read(),
+        )
+
+    def close(self):
+        if self.process.poll() is None:
+            kill_process_group(self.process)
+        self.stdout.close()
+        self.stderr.close()
+
+
+def _run_once(
+    command: str, args: List[str], policy: RmapiPolicy, kwargs: dict
+) -> Tuple[subprocess.CompletedProcess, Optional[str]]:
+    """Run one rmapi call within its timeout, hedged if the policy asks for it.
+
+    Returns the result and None, or the kind of failure.
+    """
+    kwargs = dict(kwargs)
+    cwd = kwargs.pop("cwd", None)
+    private = cwd is not None and command in _WRITES_TO_CWD
+    hedge_after = stats.p95(command) if policy.hedge and command in HEDGEABLE else None
+
+    def start() -> _Attempt:
+        return _Attempt(args, tempfile.mkdtemp(dir=cwd) if private else cwd, kwargs)
+
+    attempts = [start()]
+    deadline = attempts[0].started + policy.timeout(command)
+    try:
+        winner = None
+        while winner is None:
+            running = [a for a in attempts if a.process.poll() is None]
+            finished = [a for a in attempts if a not in running]
+            winner = next((a for a in finished if a.process.returncode == 0), None)
+            if winner is None and finished and not running:
+                winner = finished[0]
+            if winner is not None:
+                break
+
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if hedge_after is not None and len(attempts) == 1:
+                hedge_at = attempts[0].started + hedge_after
+                if now >= hedge_at:
+                    logger.info(f"rmapi {command} is slow, starting a second copy")
+                    stats.count(command, "hedged")
+                    attempts.append(start())
+                    continue
+            if len(running) == 1 and len(attempts) == 1:
+                next_event = deadline
+                if hedge_after is not None:
+                    next_event = min(next_event, attempts[0].started + hedge_after)
+                try:
+                    running[0].process.wait(timeout=max(0.0, next_event - now))
+                except subprocess.TimeoutExpired:
+                    pass
+            else:
+                time.sleep(_POLL_INTERVAL)
+
+        elapsed = time.monotonic() - attempts[0].started
+        if winner is None:
+            result = attempts[0].result()
+            result.stderr += f"\nrmapi {command} timed out after {elapsed:.1f}s"
+            stats.record(command, elapsed, TIMEOUT)
+            return result, TIMEOUT
+
+        result = winner.result()
+        if result.returncode != 0:
+            failure = classify_failure(result.stderr)
+            stats.record(command, elapsed, failure)
+            return result, failure
+
+        stats.record(command, elapsed)
+        if winner is not attempts[0]:
+            stats.count(command, "hedge won")
+        if private and winner.cwd:
+            for path in Path(winner.cwd).iterdir():
+                shutil.move(str(path), cwd)
+        return result, None
+    finally:
+        for attempt in attempts:
+            attempt.close()
+            if private and attempt.cwd:
+                shutil.rmtree(attempt.cwd, ignore_errors=True)
+
+
 def run_rmapi_command(
     args: List[str], **kwargs
 ) -> tuple[bool, subprocess.CompletedProcess]:
-    """Run rmapi command and handle common success/failure logging."""
-    result = subprocess.run(
-        [get_rmapi_location()] + args, capture_output=True, text=True, **kwargs
+    """Run rmapi command and handle common success/failure logging.
+
+    The command is killed, with everything it started, when it runs past
+    the timeout of the current policy, and retried as the policy allows.
+    """
+    policy = current_policy()
+    command = args[0] if args else "ls"
+    attempt = 0
+    while True:
+        result, failure = _run_once(
+            command, [get_rmapi_location()] + args, policy, _with_config(kwargs)
+        )
+        if failure is None:
+            return True, result
+        attempt += 1
+        if not policy.should_retry(command, failure, attempt):
+            break
+        stats.count(command, "retried")
+        logger.warning(
+            f"rmapi {command} failed ({failure}), retrying in {policy.delay(attempt):.0f}s"
+        )
+        time.sleep(policy.delay(attempt))
+
+    logger.info(result.stdout)
+    logger.error(result.stderr)
+    return False, result
+
+
+def start_rmapi_command(args: List[str], **kwargs) -> subprocess.Popen:
+    """Start an rmapi command without waiting for it, for long-running transfers.
+
+    It runs in a session of its own, so `kill_process_group` can stop it.
+    """
+    return subprocess.Popen(
+        [get_rmapi_location()] + args, start_new_session=True, **_with_config(kwargs)
     )
-    success = result.returncode == 0
-    if not success:
-        logger.info(result.stdout)
-        logger.error(result.stderr)
-    return success, result
 
 
 def check_rmapi():
@@ -78,12 +324,42 @@ def get_files(folder: str) -> None | List[str]:
     return None
 
 
+def parse_find_output(output: str) -> List[tuple[str, bool]]:
+    """Parse `rmapi find` output into `(path, is_folder)` pairs."""
+    entries = []
+    for line in output.split("\n"):
+        if line.startswith("[d]") or line.startswith("[f]"):
+            path = line[len("[d]") :].strip()
+            if path:
+                entries.append((path, line.startswith("[d]")))
+    return entries
+
+
+def find(folder: str) -> None | List[tuple[str, bool]]:
+    """Recursively list everything below a folder in a single rmapi call."""
+    success, result = run_rmapi_command(["find", folder])
+    if success:
+        return parse_find_output(result.stdout)
+    return None
+
+
 def download_file(file_path, working_dir):
     # Downloads a file (consisting of a zip file) to a specified directory
     success, _ = run_rmapi_command(["get", file_path], cwd=working_dir)
     return success
 
 
+def start_folder_download(folder, working_dir, log_file) -> subprocess.Popen:
+    # Recursively downloads a folder into working_dir with one `rmapi mget`
+    return start_rmapi_command(
+        ["mget", folder],
+        cwd=working_dir,
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+
+
 def upload_file(file_path, target_folder):
     # Upload a file to its destination folder
     success, result = run_rmapi_command(["put", file_path, target_folder])
@@ -108,6 +384,40 @@ def upload_file(file_path, target_folder):
     return success
 
 
+def parse_mput_output(output: str, filenames: List[str]) -> Dict[str, bool]:
+    """Work out which files `rmapi mput` uploaded from its `uploading: [name]... complete` lines."""
+    results = {filename: False for filename in filenames}
+    for line in output.split("\n"):
+        if "complete" not in line:
+            continue
+        for filename in filenames:
+            if f"[{filename}]" in line:
+                results[filename] = True
+    return results
+
+
+def upload_files(local_dir, target_folder) -> Dict[str, bool]:
+    """Upload every file in `local_dir` to `target_folder` with a single `rmapi mput`.
+
+    Files that mput did not report as uploaded (e.g. because they already exist
+    on the tablet) are retried one by one with `upload_file`.
+    """
+    filenames = sorted(p.name for p in Path(local_dir).iterdir() if p.is_file())
+    if not filenames:
+        return {}
+
+    _, result = run_rmapi_command(["mput", target_folder], cwd=local_dir)
+    results = parse_mput_output(result.stdout + result.stderr, filenames)
+
+    for filename, uploaded in results.items():
+        if not uploaded:
+            logger.info(f"mput did not upload {filename}, retrying on its own...")
+            results[filename] = upload_file(
+                str(Path(local_dir) / filename), target_folder
+            )
+    return results
+
+
 def delete_file(path):
     success, _ = run_rmapi_command(["rm", path])
     return success
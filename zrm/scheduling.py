@@ -0,0 +1,72 @@
+# scheduling.py
+from dataclasses import dataclass
+from typing import Iterable, Optional, Protocol, Tuple
+
+# Orders for work that is not urgent
+SMALLEST_FIRST = "size"
+OLDEST_FIRST = "age"
+AS_LISTED = "listed"
+ORDERS = (SMALLEST_FIRST, OLDEST_FIRST, AS_LISTED)
+
+URGENT_TAG = "to_sync_urgent"
+LARGE_FILE_BYTES = 32 * 2**20
+
+# Transfer batches, in the order they are sent
+URGENT_WAVE = 0
+NORMAL_WAVE = 1
+LARGE_WAVE = 2
+
+
+class ScheduledWork(Protocol):
+    urgent: bool
+    # Bytes to transfer, None when Zotero does not report a size
+    size: Optional[int]
+    # When the Zotero entry was added, as an ISO 8601 timestamp
+    added: str
+
+
+@dataclass(frozen=True)
+class SchedulePolicy:
+    """The order in which sync work is done.
+
+    Work on items tagged with one of `urgent_tags` goes first. The rest
+    follows smallest first (`size`), oldest first (`age`), or in the order
+    Zotero and rmapi list it (`listed`). Smallest first is shortest job
+    first: with several workers it gets the most documents onto the tablet
+    soonest. Transfers above `large_file_bytes` go in a batch of their own
+    after everything else, so one large textbook does not hold back the
+    papers behind it.
+    """
+
+    urgent_tags: Tuple[str, ...] = (URGENT_TAG,)
+    order: str = SMALLEST_FIRST
+    large_file_bytes: int = LARGE_FILE_BYTES
+
+    def __post_init__(self):
+        if self.order not in ORDERS:
+            raise ValueError(
+                f"Unknown sync order {self.order}, expected one of {', '.join(ORDERS)}"
+            )
+
+    def is_urgent(self, tags: Iterable[str]) -> bool:
+        return any(tag in self.urgent_tags for tag in tags)
+
+    def key(self, work: ScheduledWork) -> Tuple:
+        """Sort key putting the work to do first at the front."""
+        if self.order == SMALLEST_FIRST:
+            # Work of unknown size goes after everything of known size
+            rest: Tuple = (work.size is None, work.size or 0)
+        elif self.order == OLDEST_FIRST:
+            # ISO 8601 timestamps sort by time
+            rest = (not work.added, work.added)
+        else:
+            rest = ()
+        return (not work.urgent,) + rest
+
+    def wave(self, work: ScheduledWork) -> int:
+        """The transfer batch the work belongs to."""
+        if work.urgent:
+            return URGENT_WAVE
+        if work.size is not None and work.size > self.large_file_bytes:
+            return LARGE_WAVE
+        return NORMAL_WAVE
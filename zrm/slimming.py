@@ -0,0 +1,197 @@
+# slimming.py
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Callable, Optional
+
+import pymupdf
+
+from zrm import profiling
+
+logger = logging.getLogger("zotero_rM_bridge.slimming")
+
+# Screen resolution of the reMarkable 2 (the Paper Pro's is 229)
+TABLET_DPI = 226
+# Images are only re-encoded when they are noticeably sharper than the screen
+DPI_THRESHOLD = int(TABLET_DPI * 1.25)
+JPEG_QUALITY = 85
+# Smaller savings are not worth replacing the original for
+MIN_SAVING = 0.1
+
+
+def _image_rewrite_options() -> pymupdf.mupdf.PdfImageRewriterOptions:
+    """Downsample colour and grey images above the threshold, keeping their compression.
+
+    Lossless images stay lossless, so line art does not pick up JPEG
+    artifacts, and black and white scans are left alone as they are already
+    stored compactly.
+    """
+    options = pymupdf.mupdf.PdfImageRewriterOptions()
+    for kind in ("color_lossless", "color_lossy", "gray_lossless", "gray_lossy"):
+        setattr(
+            options,
+            f"{kind}_image_subsample_method",
+            pymupdf.mupdf.FZ_SUBSAMPLE_AVERAGE,
+        )
+        setattr(options, f"{kind}_image_subsample_threshold", DPI_THRESHOLD)
+        setattr(options, f"{kind}_image_subsample_to", TABLET_DPI)
+        setattr(
+            options,
+            f"{kind}_image_recompress_method",
+            pymupdf.mupdf.FZ_RECOMPRESS_SAME,
+        )
+        setattr(options, f"{kind}_image_recompress_quality", str(JPEG_QUALITY))
+    return options
+
+
+def slim_pdf_file(source: str, target: str) -> bool:
+    """Write a smaller copy of the PDF at `source` to `target`.
+
+    Images above the tablet's resolution are downsampled to it, unused
+    objects are dropped and streams are compressed. Returns False, and writes
+    nothing, when that does not save at least `MIN_SAVING`. Runs in a worker
+    process, so it only takes and returns plain values.
+    """
+    with pymupdf.open(source) as doc:
+        doc.rewrite_images(options=_image_rewrite_options())
+        doc.save(
+            target,
+            garbage=3,
+            clean=True,
+            deflate=True,
+            deflate_images=True,
+            deflate_fonts=True,
+            use_objstms=1,
+        )
+    if os.path.getsize(target) > os.path.getsize(source) * (1 - MIN_SAVING):
+        os.remove(target)
+        return False
+    return True
+
+
+def slimmed_path(cache_dir: Path, md5: str) -> Path:
+    """Where the slimmed copy of the PDF with this md5 is cached"""
+    return Path(cache_dir) / f"{md5}.pdf"
+
+
+def _file_md5(f) -> str:
+    return hashlib.file_digest(f, "md5").hexdigest()
+
+
+def restore_original(
+    rmn_path: Path,
+    cache_dir: Path,
+    original_md5: Optional[str],
+    load_original: Callable[[], Optional[bytes]],
+) -> bool:
+    """Put the original PDF back into a downloaded document that holds its slimmed copy.
+
+    Slimming leaves the page geometry alone, so annotations made on the
+    slimmed copy render onto the original in the same places. Only a document
+    whose PDF is exactly the cached copy of `original_md5` is changed, and
+    only with a file that still has that md5. Returns whether the PDF was
+    replaced.
+    """
+    if not original_md5:
+        return False
+    slimmed = slimmed_path(cache_dir, original_md5)
+    if not slimmed.is_file():
+        return False
+    with zipfile.ZipFile(rmn_path) as zf:
+        pdfs = [
+            info
+            for info in zf.infolist()
+            if info.filename.endswith(".pdf") and "/" not in info.filename.strip("/")
+        ]
+        if len(pdfs) != 1 or pdfs[0].file_size != slimmed.stat().st_size:
+            return False
+        with zf.open(pdfs[0]) as f, open(slimmed, "rb") as cached:
+            if _file_md5(f) != _file_md5(cached):
+                return False
+
+        original = load_original()
+        if original is None or hashlib.md5(original).hexdigest() != original_md5:
+            return False
+        # Written next to the document and moved in place, like the cache entries
+        rewritten = rmn_path.with_name(f"{rmn_path.name}.original")
+        with zipfile.ZipFile(rewritten, "w", zipfile.ZIP_DEFLATED) as out:
+            for info in zf.infolist():
+                if info is pdfs[0]:
+                    out.writestr(info, original)
+                    continue
+                with zf.open(info) as source, out.open(info, "w") as target:
+                    shutil.copyfileobj(source, target)
+    os.replace(rewritten, rmn_path)
+    return True
+
+
+class PdfSlimmer:
+    """Makes PDFs smaller before they are uploaded to the tablet.
+
+    Results are cached in `cache_dir` by the md5 of the original file, so a
+    PDF is only processed once however often it is pushed. PDFs that cannot
+    be made smaller are remembered as well and uploaded unchanged.
+    Processing happens on `executor`, normally a process pool shared by all
+    profiles. Pulls put the originals back through `restore_original`.
+    """
+
+    def __init__(self, cache_dir: Path, executor: Executor):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.executor = executor
+
+    def _slimmed_path(self, md5: str) -> Path:
+        return slimmed_path(self.cache_dir, md5)
+
+    def _unchanged_path(self, md5: str) -> Path:
+        return self.cache_dir / f"{md5}.unchanged"
+
+    def cached(self, md5: Optional[str]) -> Optional[bytes]:
+        """The slimmed version of the PDF with this md5, if it was made before."""
+        if md5 and self._slimmed_path(md5).is_file():
+            return self._slimmed_path(md5).read_bytes()
+        return None
+
+    def slim(self, content: bytes, name: str = "") -> bytes:
+        """A smaller version of `content`, or `content` itself if it cannot be slimmed."""
+        md5 = hashlib.md5(content).hexdigest()
+        cached = self.cached(md5)
+        if cached is not None:
+            return cached
+        if self._unchanged_path(md5).exists():
+            return content
+
+        slimmed = self._slimmed_path(md5)
+        fd, source = tempfile.mkstemp(suffix=".pdf", dir=self.cache_dir)
+        # Written next to the cache entry and moved in place, so an
+        # interrupted run never leaves a partial file behind
+        target = f"{source}.slim"
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            smaller = self.executor.submit(
+                profiling.wrap_for_process(slim_pdf_file), source, target
+            ).result()
+            if not smaller:
+                self._unchanged_path(md5).touch()
+                return content
+            os.replace(target, slimmed)
+        except Exception as e:
+            logger.warning(f"Could not slim {name or md5}, uploading it unchanged: {e}")
+            return content
+        finally:
+            for path in (source, target):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        result = slimmed.read_bytes()
+        logger.info(
+            f"Slimmed {name or md5} from {len(content) / 2**20:.1f} MiB "
+            f"to {len(result) / 2**20:.1f} MiB"
+        )
+        return result
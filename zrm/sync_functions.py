@@ -1,21 +1,26 @@
 # sync_functions.py
 import logging
-import os
 import zipfile
 import tempfile
 import hashlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple
 
 from pyzotero.zotero import Zotero
 
 import zrm.rmapi_shim as rmapi
-import remarks
+from zrm import profiling
 from pathlib import Path
 from shutil import rmtree, copy
 from time import sleep
 from datetime import datetime
 
 from zrm.adapters.ReMarkableAPI import ReMarkableAPI
+from zrm.adapters.TreeNode import TreeNode
 from zrm.adapters.ZoteroAPI import ZoteroAPI
+from zrm.admission import ByteBudget, Payload, in_memory_size
+from zrm.slimming import PdfSlimmer
 
 logger = logging.getLogger("zotero_rM_bridge.sync_functions")
 
@@ -161,55 +166,137 @@ def zotero_upload_webdav(pdf_name, zot, webdav):
     return None
 
 
-def sync_to_rm_filetree(
-    handle: str, zotero_tree: ZoteroAPI, rm_tree: ReMarkableAPI, folders
-):
-    """Sync an entry's PDF attachments from Zotero to reMarkable"""
+def list_pdf_attachments(handle: str, zotero_tree: ZoteroAPI) -> List[TreeNode] | None:
+    """The PDF attachments of an entry, or None when the entry does not exist"""
     if not zotero_tree.item_exists(handle):
         logger.warning(f"No attachments found for item at {handle}")
-        return
+        return None
 
     attachments = zotero_tree.list_children(handle)
-    attachments = [
-        attachment for attachment in attachments if attachment.name.endswith(".pdf")
-    ]
+    return [attachment for attachment in attachments if attachment.name.endswith(".pdf")]
+
+
+def upload_attachments_to_rm(
+    attachments: List[TreeNode],
+    zotero_tree: ZoteroAPI,
+    rm_tree: ReMarkableAPI,
+    remote_folder: str,
+    workers: int = 1,
+    budget: Optional[ByteBudget] = None,
+    slimmer: Optional[PdfSlimmer] = None,
+) -> Dict[str, bool]:
+    """Download attachments from Zotero and upload them to one reMarkable folder in a batch.
+
+    With several workers the Zotero downloads run concurrently while the
+    batch is being staged. A download is read into memory whole, so it only
+    starts once `budget` admits the file's size, and large files are spilled
+    to disk until they are staged. With a `slimmer`, PDFs are made smaller
+    before they are uploaded. Returns whether each attachment handle made it
+    to the tablet.
+    """
     logger.info(f"Syncing {len(attachments)} attachments to reMarkable")
+    budget = budget or ByteBudget()
 
-    all_attachments_synced = True
+    def admission(attachment: TreeNode) -> int:
+        """What to reserve for downloading an attachment: its size, if Zotero reports one."""
+        return zotero_tree.attachment_size(attachment.handle) or budget.payload_estimate
 
-    for attachment in attachments:
+    def download(attachment: TreeNode, admitted: int) -> Tuple[Payload | None, int]:
+        """Download an admitted attachment, returning it and the bytes it keeps reserved."""
         logger.info(f"Processing `{attachment}`")
-
         try:
-            content = zotero_tree.get_file_content(attachment.handle)
+            content = None
+            if slimmer:
+                # Zotero knows the md5 of stored files, so a PDF that was
+                # slimmed before does not need to be downloaded again
+                content = slimmer.cached(attachment.load_metadata().get("md5"))
             if content is None:
-                raise RuntimeError(
-                    f"Could not get file content for attachment {attachment.handle}"
-                )
-            else:
-                if rm_tree.upload_file(
-                    os.path.join("Zotero", folders["unread"], attachment.name), content
-                ):
-                    logger.info(f"Uploaded {attachment} to reMarkable.")
-                else:
-                    all_attachments_synced = False
-                    logger.error(f"Failed to upload {attachment} to reMarkable.")
+                content = zotero_tree.get_file_content(attachment.handle)
+                if content is None:
+                    raise RuntimeError(
+                        f"Could not get file content for attachment {attachment.handle}"
+                    )
+                if slimmer:
+                    content = slimmer.slim(content, attachment.name)
         except Exception as e:
-            all_attachments_synced = False
             logger.error(f"Error processing {attachment}: {str(e)}")
-
-    if all_attachments_synced:
-        zotero_tree.add_tags(handle, ["synced"])
-        zotero_tree.remove_tags(handle, ["to_sync"])
-
-
-def attach_pdf_to_zotero_document(rendered_remarks_pdf: Path, zotero_tree: ZoteroAPI):
-    """Attach annotated PDF back to Zotero using filetree interface."""
-    document_name = rendered_remarks_pdf.stem.removesuffix(" _remarks")
-    logger.info(f'Have an annotated PDF "{document_name}" to upload')
-
-    for entry in zotero_tree.find_nodes_with_tag("synced"):
-        attachments = zotero_tree.list_children(entry.handle)
+            budget.release(admitted)
+            return None, 0
+        payload = budget.spill(content)
+        reserved = in_memory_size(payload)
+        budget.resize(admitted, reserved)
+        return payload, reserved
+
+    downloaded: Dict[str, bool] = {}
+    pending: Deque[Tuple[TreeNode, Future]] = deque()
+
+    def hand_off_oldest():
+        # Payloads are handed to the upload stage in order, and their bytes are
+        # released once the upload stage has staged them and asks for the next
+        attachment, future = pending.popleft()
+        payload, reserved = future.result()
+        downloaded[attachment.handle] = payload is not None
+        try:
+            if payload is not None:
+                yield attachment.name, payload
+        finally:
+            budget.release(reserved)
+            if payload is not None and not isinstance(payload, bytes):
+                payload.close()
+
+    def attachment_contents():
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for attachment in attachments:
+                while len(pending) >= workers:
+                    yield from hand_off_oldest()
+                admitted = admission(attachment)
+                while not budget.try_acquire(admitted):
+                    if not pending:
+                        # Only other stages hold the budget, wait for them
+                        budget.acquire(admitted)
+                        break
+                    yield from hand_off_oldest()
+                future = executor.submit(profiling.wrap(download), attachment, admitted)
+                pending.append((attachment, future))
+            while pending:
+                yield from hand_off_oldest()
+
+    uploaded = rm_tree.upload_files(remote_folder, attachment_contents())
+
+    results = {}
+    for attachment in attachments:
+        if not downloaded.get(attachment.handle):
+            results[attachment.handle] = False
+        elif uploaded.get(attachment.name):
+            logger.info(f"Uploaded {attachment} to reMarkable.")
+            results[attachment.handle] = True
+        else:
+            logger.error(f"Failed to upload {attachment} to reMarkable.")
+            results[attachment.handle] = False
+    return results
+
+
+def find_zotero_document(
+    document_name: str,
+    zotero_tree: ZoteroAPI,
+    synced_entries: List[TreeNode] | None = None,
+    children: Dict[str, List[TreeNode]] | None = None,
+) -> Tuple[TreeNode, TreeNode, TreeNode | None] | None:
+    """Find the synced entry a reMarkable document belongs to.
+
+    Returns the entry with its PDF attachment and, if present, its markdown
+    attachment. Pass the same `children` dict when matching several documents
+    so every entry's attachments are only listed once.
+    """
+    if synced_entries is None:
+        synced_entries = zotero_tree.find_nodes_with_tag("synced")
+    if children is None:
+        children = {}
+
+    for entry in synced_entries:
+        if entry.handle not in children:
+            children[entry.handle] = zotero_tree.list_children(entry.handle)
+        attachments = children[entry.handle]
         md_attachment = next(
             (
                 att
@@ -228,53 +315,94 @@ def attach_pdf_to_zotero_document(rendered_remarks_pdf: Path, zotero_tree: Zoter
             ),
             None,
         )
-
         if pdf_attachment:
-            with open(rendered_remarks_pdf, "rb") as f:
-                pdf_content = f.read()
-
-            new_attachment = zotero_tree.update_file_content(
-                entry.handle, pdf_attachment.handle, pdf_content
-            )
-            if new_attachment:
-                zotero_tree.add_tags(new_attachment, ["annotated"])
-                logger.info(
-                    f"'{rendered_remarks_pdf}' PDF successfully attached to Zotero entry '{document_name}'."
-                )
-            else:
-                logger.warning(f"Failed to create attachment for item at {entry}")
-
-            md_path = rendered_remarks_pdf.with_name(f"{document_name} _obsidian.md")
-            with open(md_path, "rb") as f:
-                md_content = f.read()
-            if md_attachment:
-                new_attachment = zotero_tree.update_file_content(
-                    entry.handle, md_attachment.handle, md_content
-                )
-                if new_attachment:
-                    zotero_tree.add_tags(new_attachment, ["annotated"])
-                    logger.info(
-                        f"{md_attachment.name} MD successfully attached to Zotero entry '{document_name}'"
-                    )
-                else:
-                    logger.warning(
-                        f"Was unable to attach {md_attachment.name} MD to Zotero entry '{document_name}#{entry.handle}'"
-                    )
-            else:
-                new_attachment = zotero_tree.create_file(
-                    entry.handle, document_name + ".md", md_content
-                )
-                if new_attachment:
-                    zotero_tree.add_tags(new_attachment, ["annotated"])
-                    logger.info(
-                        f"{document_name} MD successfully attached to Zotero entry '{document_name}'"
-                    )
-                else:
-                    logger.warning(
-                        f"Was unable to attach {document_name} MD to Zotero entry '{document_name}#{entry.handle}'"
-                    )
-            return
+            return entry, pdf_attachment, md_attachment
+    return None
+
 
-    logger.warning(
-        f"There's an annotated PDF '{document_name}' to upload, but we're unable to find the appropriate item in Zotero"
+def _upload_rendered_file(
+    entry: TreeNode,
+    attachment: TreeNode | None,
+    filename: str,
+    content: bytes,
+    zotero_tree: ZoteroAPI,
+) -> str | None:
+    """Put a rendered file into Zotero and tag it as annotated, returning its attachment key.
+
+    Replaces the file of `attachment`, or creates a new attachment named
+    `filename` when there is none. Nothing is uploaded when Zotero already
+    holds the same content.
+    """
+    if attachment is None:
+        handle = zotero_tree.create_file(entry.handle, filename, content)
+    elif attachment.load_metadata().get("md5") == hashlib.md5(content).hexdigest():
+        logger.info(f"{attachment.name} is unchanged in Zotero, not uploading it again")
+        handle = attachment.handle
+    else:
+        handle = zotero_tree.update_file_content(
+            entry.handle, attachment.handle, content
+        )
+    if handle:
+        zotero_tree.add_tags(handle, ["annotated"])
+    return handle
+
+
+def attach_rendered_document(
+    rendered_remarks_pdf: Path,
+    entry: TreeNode,
+    pdf_attachment: TreeNode,
+    md_attachment: TreeNode | None,
+    zotero_tree: ZoteroAPI,
+    rendered_markdown: Path | None = None,
+) -> str | None:
+    """Replace an entry's PDF with the annotated one and attach the rendered markdown.
+
+    The PDF and the markdown are uploaded at the same time, and files that
+    Zotero already holds unchanged are skipped. Returns the key of the
+    annotated PDF attachment.
+    """
+    document_name = rendered_remarks_pdf.stem.removesuffix(" _remarks")
+    md_path = rendered_markdown or rendered_remarks_pdf.with_name(
+        f"{document_name} _obsidian.md"
     )
+    with open(rendered_remarks_pdf, "rb") as f:
+        pdf_content = f.read()
+    with open(md_path, "rb") as f:
+        md_content = f.read()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pdf_upload = executor.submit(
+            profiling.wrap(_upload_rendered_file),
+            entry,
+            pdf_attachment,
+            pdf_attachment.name,
+            pdf_content,
+            zotero_tree,
+        )
+        md_upload = executor.submit(
+            profiling.wrap(_upload_rendered_file),
+            entry,
+            md_attachment,
+            document_name + ".md",
+            md_content,
+            zotero_tree,
+        )
+
+    new_pdf_attachment = pdf_upload.result()
+    if new_pdf_attachment:
+        logger.info(
+            f"'{rendered_remarks_pdf}' PDF successfully attached to Zotero entry '{document_name}'."
+        )
+    else:
+        logger.warning(f"Failed to create attachment for item at {entry}")
+
+    md_name = md_attachment.name if md_attachment else document_name
+    if md_upload.result():
+        logger.info(
+            f"{md_name} MD successfully attached to Zotero entry '{document_name}'"
+        )
+    else:
+        logger.warning(
+            f"Was unable to attach {md_name} MD to Zotero entry '{document_name}#{entry.handle}'"
+        )
+    return new_pdf_attachment
@@ -0,0 +1,115 @@
+# sync_journal.py
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Dict, List
+
+logger = logging.getLogger("zotero_rM_bridge.sync_journal")
+
+FINISHED = "finished"
+
+
+class SyncJournal:
+    """Append-only write-ahead log of the steps each document's sync went through.
+
+    Every step is written and fsynced before the next side effect happens, so
+    a run that crashes can pick up each document from its last completed
+    step. Intermediate files (downloads, renders) live in a per-document work
+    directory next to the journal so they survive the crash too.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.work_dir = self.path.parent / "work"
+        self._lock = threading.Lock()
+        self._steps: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._load()
+        self._compact()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from a crash mid-write
+                    logger.warning(f"Ignoring unreadable journal line: {line!r}")
+                    continue
+                if entry["step"] == FINISHED:
+                    self._steps.pop(entry["document"], None)
+                else:
+                    self._steps.setdefault(entry["document"], {})[entry["step"]] = entry[
+                        "data"
+                    ]
+        if self._steps:
+            logger.info(f"Resuming {len(self._steps)} unfinished documents from the journal")
+
+    def _compact(self):
+        """Rewrite the journal with only the unfinished documents."""
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for document, steps in self._steps.items():
+                for step, data in steps.items():
+                    f.write(json.dumps({"document": document, "step": step, "data": data}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def record(self, document: str, step: str, **data):
+        """Durably record that `document` completed `step`."""
+        with self._lock:
+            self._file.write(
+                json.dumps({"document": document, "step": step, "data": data}) + "\n"
+            )
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._steps.setdefault(document, {})[step] = data
+
+    def completed(self, document: str, step: str) -> bool:
+        with self._lock:
+            return step in self._steps.get(document, {})
+
+    def data(self, document: str, step: str) -> Dict[str, Any]:
+        with self._lock:
+            return self._steps.get(document, {}).get(step, {})
+
+    def steps(self, document: str) -> Dict[str, Dict[str, Any]]:
+        """Every step `document` completed, with the data recorded for it."""
+        with self._lock:
+            return dict(self._steps.get(document, {}))
+
+    def documents(self, prefix: str = "") -> List[str]:
+        """The unfinished documents whose name starts with `prefix`."""
+        with self._lock:
+            return [document for document in self._steps if document.startswith(prefix)]
+
+    def finish(self, document: str):
+        """Mark a document as fully synced and remove its intermediate files."""
+        self.forget(document)
+
+    def forget(self, document: str):
+        """Drop everything recorded for a document, e.g. when its steps no longer apply."""
+        self.record(document, FINISHED)
+        with self._lock:
+            self._steps.pop(document, None)
+        shutil.rmtree(self._work_dir_path(document), ignore_errors=True)
+
+    def work_dir_for(self, document: str) -> Path:
+        path = self._work_dir_path(document)
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def _work_dir_path(self, document: str) -> Path:
+        return self.work_dir / hashlib.sha1(document.encode()).hexdigest()
+
+    def close(self):
+        self._file.close()
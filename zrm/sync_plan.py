@@ -0,0 +1,701 @@
+# sync_plan.py
+import itertools
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from zrm import profiling
+from zrm.adapters.ReMarkableAPI import ReMarkableAPI
+from zrm.adapters.TreeNode import TreeNode
+from zrm.adapters.ZoteroAPI import ZoteroAPI
+from zrm.admission import ByteBudget
+from zrm.fingerprints import FingerprintStore, annotation_fingerprint
+from zrm.render import InProcessRenderer, RenderBackend, RenderedDocument
+from zrm.scheduling import SchedulePolicy
+from zrm.slimming import PdfSlimmer, restore_original
+from zrm.sync_journal import SyncJournal
+from zrm.sync_functions import (
+    attach_rendered_document,
+    find_zotero_document,
+    list_pdf_attachments,
+    upload_attachments_to_rm,
+)
+
+logger = logging.getLogger("zotero_rM_bridge.sync_plan")
+
+# Adapter calls each planned action costs when executed. Each is at least one
+# Zotero request or rmapi process; items the plan already listed are cached,
+# so tag changes and replacements do not read their item again.
+REQUESTS_PER_UPLOAD = 2  # attachment size, file download
+REQUESTS_PER_BATCH_TRANSFER = 1  # one rmapi mput/mget per folder
+REQUESTS_PER_TAG_CHANGE = 2  # add tags, remove tags
+REQUESTS_PER_TAG_PREFETCH = 1  # reading the tagged items back in batches
+REQUESTS_PER_REPLACEMENT = 1  # update the attachment's file
+REQUESTS_PER_CREATION = 1  # create an attachment
+REQUESTS_PER_ANNOTATED_TAG = 1  # add the annotated tag
+REQUESTS_PER_DELETE = 1  # rmapi rm
+
+
+@dataclass
+class PlannedUpload:
+    item_handle: str
+    attachment: TreeNode
+    remote_folder: str
+    # What the scheduler orders uploads by
+    urgent: bool = False
+    size: Optional[int] = None
+    added: str = ""
+
+
+@dataclass
+class PlannedSkip:
+    target: str
+    reason: str
+
+
+@dataclass
+class PlannedRender:
+    rm_name: str
+    rm_path: str
+    entry: TreeNode
+    pdf_attachment: TreeNode
+    md_attachment: Optional[TreeNode] = None
+    # What the scheduler orders renders by. The size is the Zotero PDF's,
+    # which the annotated document roughly matches
+    urgent: bool = False
+    size: Optional[int] = None
+    added: str = ""
+
+
+@dataclass
+class PlannedReplacement:
+    rm_name: str
+    parent_handle: str
+    filename: str
+    # None when the attachment does not exist yet and has to be created
+    attachment_handle: Optional[str] = None
+
+
+@dataclass
+class PlannedTagChange:
+    handle: str
+    add: List[str] = field(default_factory=list)
+    remove: List[str] = field(default_factory=list)
+
+
+@dataclass
+class SyncPlan:
+    """Everything a sync run is going to do, computed before anything is changed"""
+
+    uploads: List[PlannedUpload] = field(default_factory=list)
+    skips: List[PlannedSkip] = field(default_factory=list)
+    renders: List[PlannedRender] = field(default_factory=list)
+    replacements: List[PlannedReplacement] = field(default_factory=list)
+    tag_changes: List[PlannedTagChange] = field(default_factory=list)
+    deletes: List[str] = field(default_factory=list)
+    # Everything in the read folder when a pull was planned, None for pushes
+    read_documents: Optional[List[str]] = None
+    # Every item tagged for pushing when a push was planned, None for pulls
+    pushed_items: Optional[List[str]] = None
+
+    def is_empty(self) -> bool:
+        return not (self.uploads or self.renders or self.tag_changes or self.deletes)
+
+    def estimated_requests(self) -> int:
+        """Estimate how many Zotero and rmapi adapter calls executing this plan costs"""
+        batches = len({upload.remote_folder for upload in self.uploads})
+        if self.renders:
+            batches += 1
+        return (
+            batches * REQUESTS_PER_BATCH_TRANSFER
+            + len(self.uploads) * REQUESTS_PER_UPLOAD
+            + len(self.tag_changes) * REQUESTS_PER_TAG_CHANGE
+            + (REQUESTS_PER_TAG_PREFETCH if self.tag_changes else 0)
+            + sum(
+                REQUESTS_PER_REPLACEMENT
+                if replacement.attachment_handle
+                else REQUESTS_PER_CREATION
+                for replacement in self.replacements
+            )
+            + len(self.replacements) * REQUESTS_PER_ANNOTATED_TAG
+            + len(self.deletes) * REQUESTS_PER_DELETE
+        )
+
+    def describe(self) -> str:
+        lines = ["Sync plan:"]
+        for upload in self.uploads:
+            lines.append(
+                f"  upload  {upload.attachment.name} -> {upload.remote_folder} (item {upload.item_handle})"
+            )
+        for skip in self.skips:
+            lines.append(f"  skip    {skip.target}: {skip.reason}")
+        for render in self.renders:
+            lines.append(
+                f"  render  {render.rm_path} -> item {render.entry.handle}"
+            )
+        for replacement in self.replacements:
+            action = "replace" if replacement.attachment_handle else "create "
+            lines.append(
+                f"  {action} {replacement.filename} on item {replacement.parent_handle}"
+            )
+        for change in self.tag_changes:
+            tags = [f"+{tag}" for tag in change.add] + [f"-{tag}" for tag in change.remove]
+            lines.append(f"  tag     {change.handle} {' '.join(tags)}")
+        for delete in self.deletes:
+            lines.append(f"  delete  {delete}")
+        if self.is_empty():
+            lines.append("  nothing to do")
+        lines.append(f"Estimated requests: {self.estimated_requests()}")
+        return "\n".join(lines)
+
+
+def plan_push(
+    zotero: ZoteroAPI, folders, schedule: Optional[SchedulePolicy] = None
+) -> SyncPlan:
+    """Plan uploading every `to_sync` (or urgent) entry's PDFs to the unread folder, most urgent first"""
+    schedule = schedule or SchedulePolicy()
+    plan = SyncPlan()
+    remote_folder = os.path.join("Zotero", folders["unread"])
+
+    items = {
+        item.handle: item
+        for tag in ("to_sync",) + schedule.urgent_tags
+        for item in zotero.find_nodes_with_tag(tag)
+    }
+    plan.pushed_items = list(items)
+    for item in items.values():
+        attachments = list_pdf_attachments(item.handle, zotero)
+        if attachments is None:
+            plan.skips.append(PlannedSkip(item.handle, "item does not exist"))
+            continue
+        urgent = schedule.is_urgent(item.tags)
+        for attachment in attachments:
+            plan.uploads.append(
+                PlannedUpload(
+                    item.handle,
+                    attachment,
+                    remote_folder,
+                    urgent=urgent,
+                    size=zotero.attachment_size(attachment.handle),
+                    added=item.load_metadata().get("dateAdded", ""),
+                )
+            )
+        remove = ["to_sync"] + [tag for tag in item.tags if tag in schedule.urgent_tags]
+        plan.tag_changes.append(
+            PlannedTagChange(item.handle, add=["synced"], remove=remove)
+        )
+    plan.uploads.sort(key=schedule.key)
+    return plan
+
+
+def plan_pull(
+    zotero: ZoteroAPI,
+    rm: ReMarkableAPI,
+    read_folder: str,
+    schedule: Optional[SchedulePolicy] = None,
+) -> SyncPlan:
+    """Plan rendering the read folder and attaching the results to their Zotero entries"""
+    schedule = schedule or SchedulePolicy()
+    plan = SyncPlan()
+    rm_folder_path = os.path.join("Zotero", read_folder)
+
+    if not rm.is_folder(rm_folder_path):
+        logger.info(f"Read folder {rm_folder_path} does not exist on reMarkable")
+        return plan
+
+    files_list = rm.list_children(rm_folder_path)
+    plan.read_documents = [
+        os.path.join(rm_folder_path, rm_filename) for rm_filename in files_list
+    ]
+    if not files_list:
+        logger.info("No files to sync from reMarkable")
+        return plan
+
+    synced_entries = zotero.find_nodes_with_tag("synced")
+    children: Dict[str, List[TreeNode]] = {}
+    for rm_filename in files_list:
+        rm_file_path = os.path.join(rm_folder_path, rm_filename)
+        document_name = rm_filename.removesuffix(".pdf")
+        match = find_zotero_document(document_name, zotero, synced_entries, children)
+        if match is None:
+            plan.skips.append(
+                PlannedSkip(rm_file_path, "no synced Zotero item has a matching PDF")
+            )
+            continue
+
+        entry, pdf_attachment, md_attachment = match
+        plan.renders.append(
+            PlannedRender(
+                rm_filename,
+                rm_file_path,
+                entry,
+                pdf_attachment,
+                md_attachment,
+                urgent=schedule.is_urgent(entry.tags),
+                size=zotero.attachment_size(pdf_attachment.handle),
+                added=entry.load_metadata().get("dateAdded", ""),
+            )
+        )
+        plan.replacements.append(
+            PlannedReplacement(
+                rm_filename, entry.handle, pdf_attachment.name, pdf_attachment.handle
+            )
+        )
+        plan.replacements.append(
+            PlannedReplacement(
+                rm_filename,
+                entry.handle,
+                md_attachment.name if md_attachment else document_name + ".md",
+                md_attachment.handle if md_attachment else None,
+            )
+        )
+        plan.deletes.append(rm_file_path)
+    plan.renders.sort(key=schedule.key)
+    return plan
+
+
+@dataclass
+class SyncOptions:
+    """How a plan is executed, and the state it can reuse from earlier runs"""
+
+    workers: int = 4
+    # Records completed steps so an interrupted run resumes where it stopped
+    journal: Optional[SyncJournal] = None
+    renderer: RenderBackend = field(default_factory=InProcessRenderer)
+    # Skips rendering documents whose annotations were already pushed to Zotero
+    fingerprints: Optional[FingerprintStore] = None
+    # Bounds the payload bytes held in memory by downloads, renders and attachments
+    budget: ByteBudget = field(default_factory=ByteBudget)
+    # Makes PDFs smaller before they are pushed to the tablet
+    slimmer: Optional[PdfSlimmer] = None
+    # Where slimmed copies are cached; pulls render onto the originals instead
+    slimmed_dir: Optional[Path] = None
+    # Which documents are transferred and rendered first
+    schedule: SchedulePolicy = field(default_factory=SchedulePolicy)
+
+
+def execute_plan(
+    plan: SyncPlan,
+    zotero: ZoteroAPI,
+    rm: ReMarkableAPI,
+    options: Optional[SyncOptions] = None,
+) -> bool:
+    """Carry out a sync plan, batching transfers and running independent requests in parallel.
+
+    Returns whether everything in the plan was done. What failed is logged,
+    and is planned again by the next run.
+    """
+    options = options or SyncOptions()
+    pushed = _execute_uploads(plan, zotero, rm, options)
+    pulled = _execute_renders(plan, zotero, rm, options)
+    return pushed and pulled
+
+
+def _push_document(item_handle: str) -> str:
+    return f"push:{item_handle}"
+
+
+def _pull_document(rm_path: str) -> str:
+    return f"pull:{rm_path}"
+
+
+def _execute_uploads(
+    plan: SyncPlan, zotero: ZoteroAPI, rm: ReMarkableAPI, options: SyncOptions
+) -> bool:
+    journal = options.journal
+    if journal and plan.pushed_items is not None:
+        _forget_unplanned_items(plan.pushed_items, journal)
+    if not plan.uploads and not plan.tag_changes:
+        return True
+
+    uploaded: Dict[str, bool] = {}
+    remaining = []
+    for upload in plan.uploads:
+        step = f"uploaded:{upload.attachment.handle}"
+        if (
+            journal
+            and journal.completed(_push_document(upload.item_handle), step)
+            # It may have been deleted from the tablet since
+            and rm.file_or_folder_exists(
+                os.path.join(upload.remote_folder, upload.attachment.name)
+            )
+        ):
+            logger.info(f"{upload.attachment} was uploaded by an earlier run, skipping")
+            uploaded[upload.attachment.handle] = True
+        else:
+            remaining.append(upload)
+
+    # One batch per folder and wave, urgent documents first and large ones last.
+    # The sort is stable, so each batch keeps the plan's order
+    batches: Dict[Tuple[int, str], List[PlannedUpload]] = {}
+    for upload in sorted(remaining, key=options.schedule.wave):
+        wave = options.schedule.wave(upload)
+        batches.setdefault((wave, upload.remote_folder), []).append(upload)
+
+    for (_, remote_folder), folder_uploads in batches.items():
+        results = upload_attachments_to_rm(
+            [upload.attachment for upload in folder_uploads],
+            zotero,
+            rm,
+            remote_folder,
+            options.workers,
+            options.budget,
+            options.slimmer,
+        )
+        uploaded.update(results)
+        if journal:
+            for upload in folder_uploads:
+                if results.get(upload.attachment.handle):
+                    journal.record(
+                        _push_document(upload.item_handle),
+                        f"uploaded:{upload.attachment.handle}",
+                    )
+
+    changes = [
+        change
+        for change in plan.tag_changes
+        if all(
+            uploaded.get(upload.attachment.handle)
+            for upload in plan.uploads
+            if upload.item_handle == change.handle
+        )
+    ]
+    failed = 0
+    with ThreadPoolExecutor(max_workers=options.workers) as executor:
+        added = {
+            executor.submit(profiling.wrap(_add_tags), change, zotero): change
+            for change in changes
+        }
+        wait(added)
+        tagged = []
+        for future, change in added.items():
+            if future.exception():
+                logger.error(
+                    f"Could not add {', '.join(change.add)} to {change.handle}: {future.exception()}"
+                )
+                failed += 1
+            else:
+                tagged.append(change)
+        # Adding tags changed the items' versions, so the removals would each
+        # read their item again; read them back in batches instead
+        zotero.prefetch(change.handle for change in tagged if change.remove)
+        removed = {
+            executor.submit(profiling.wrap(_remove_tags), change, zotero, journal): change
+            for change in tagged
+        }
+        wait(removed)
+    for future, change in removed.items():
+        if future.exception():
+            logger.error(
+                f"Could not remove {', '.join(change.remove)} from {change.handle}: {future.exception()}"
+            )
+            failed += 1
+    if failed:
+        logger.warning(f"{failed} items were not tagged as synced")
+    return not failed and all(
+        uploaded.get(upload.attachment.handle) for upload in plan.uploads
+    )
+
+
+def _forget_unplanned_items(pushed_items: List[str], journal: SyncJournal):
+    """Drop the journal entries of items that are no longer tagged for pushing."""
+    planned = {_push_document(handle) for handle in pushed_items}
+    for document in journal.documents("push:"):
+        if document not in planned:
+            logger.info(f"{document} is no longer tagged for pushing, forgetting it")
+            journal.forget(document)
+
+
+def _add_tags(change: PlannedTagChange, zotero: ZoteroAPI):
+    if change.add and not zotero.add_tags(change.handle, change.add):
+        raise RuntimeError("the item no longer exists")
+
+
+def _remove_tags(
+    change: PlannedTagChange, zotero: ZoteroAPI, journal: Optional[SyncJournal]
+):
+    if change.remove and not zotero.remove_tags(change.handle, change.remove):
+        raise RuntimeError("the item no longer exists")
+    if journal:
+        journal.finish(_push_document(change.handle))
+
+
+def _execute_renders(
+    plan: SyncPlan, zotero: ZoteroAPI, rm: ReMarkableAPI, options: SyncOptions
+) -> bool:
+    """Render, attach and delete every planned document, returning whether all of them made it"""
+    journal = options.journal
+    if journal and plan.read_documents is not None:
+        _forget_gone_documents(plan.read_documents, journal)
+    if not plan.renders:
+        return True
+    failed = 0
+
+    rm_folder_path = os.path.dirname(plan.renders[0].rm_path)
+    # Documents an earlier run started on are downloaded as well: only the
+    # current document tells whether its journal steps still apply
+    to_download = {render.rm_name: render for render in plan.renders}
+    logger.info(f"There are {len(to_download)} files to download from the reMarkable")
+
+    with ThreadPoolExecutor(max_workers=options.workers) as executor:
+        pending: List[Future] = []
+        downloads = _downloads_by_priority(rm, rm_folder_path, to_download, options)
+        delivered = 0
+        for render, rmn_path, fingerprint in tqdm(downloads, total=len(to_download)):
+            delivered += 1
+            future = _resume_or_render(
+                render, rmn_path, fingerprint, zotero, rm, options, executor
+            )
+            if future:
+                pending.append(future)
+            else:
+                failed += 1
+        # Documents that could not be downloaded were logged by the adapter
+        failed += len(to_download) - delivered
+
+        failed += sum(not future.result() for future in pending)
+    if failed:
+        logger.warning(f"{failed} documents were not synced back to Zotero")
+    return not failed
+
+
+def _forget_gone_documents(read_documents: List[str], journal: SyncJournal):
+    """Drop the journal entries of documents that are no longer in the read folder."""
+    present = {_pull_document(rm_path) for rm_path in read_documents}
+    for document in journal.documents("pull:"):
+        if document not in present:
+            logger.info(f"{document} is no longer on the reMarkable, forgetting it")
+            journal.forget(document)
+
+
+def _forget_stale_steps(document: str, fingerprint: Optional[str], journal: SyncJournal):
+    """Drop the steps an earlier run recorded for a document that was annotated since."""
+    steps = journal.steps(document)
+    if any(data.get("fingerprint") != fingerprint for data in steps.values()):
+        logger.info(f"{document} changed since an earlier run started on it, starting over")
+        journal.forget(document)
+
+
+def _resume_or_render(
+    render: PlannedRender,
+    rmn_path: Path,
+    fingerprint: Optional[str],
+    zotero: ZoteroAPI,
+    rm: ReMarkableAPI,
+    options: SyncOptions,
+    executor: ThreadPoolExecutor,
+) -> Optional[Future]:
+    """Continue a document from the last step an earlier run completed on it, or start it afresh"""
+    journal = options.journal
+    document = _pull_document(render.rm_path)
+    if journal and journal.completed(document, "attached"):
+        logger.info(f"{render.rm_name} was attached by an earlier run")
+        return executor.submit(profiling.wrap(_delete_from_rm), render, rm, journal)
+
+    data = journal.data(document, "rendered") if journal else {}
+    if Path(data.get("pdf", "")).is_file():
+        logger.info(f"{render.rm_name} was rendered by an earlier run")
+        rendered = RenderedDocument(
+            data["name"], Path(data["pdf"]), Path(data["markdown"])
+        )
+        return executor.submit(
+            profiling.wrap(_attach_and_clean_up),
+            render,
+            rendered,
+            fingerprint,
+            zotero,
+            rm,
+            options,
+        )
+    return _render_in_background(
+        render, rmn_path, fingerprint, zotero, rm, options, executor
+    )
+
+
+def _downloads_by_priority(
+    rm: ReMarkableAPI,
+    folder: str,
+    to_download: Dict[str, PlannedRender],
+    options: SyncOptions,
+) -> Iterator[Tuple[PlannedRender, Path, Optional[str]]]:
+    """Download documents in the background and hand them out most important first.
+
+    rmapi decides the order documents arrive in, but rendering is the slow
+    step, so of the documents waiting to be rendered the one the schedule
+    ranks first goes next. Each document comes with its annotation
+    fingerprint, and journal steps recorded for other annotations are
+    dropped before the document is moved into its work directory.
+    """
+    journal = options.journal
+    ready: queue.PriorityQueue = queue.PriorityQueue()
+    arrival = itertools.count()
+    errors: List[Exception] = []
+
+    def download():
+        try:
+            for rm_filename, downloaded_path in rm.download_files(
+                folder, list(to_download)
+            ):
+                render = to_download[rm_filename]
+                try:
+                    fingerprint = annotation_fingerprint(downloaded_path)
+                except Exception as e:
+                    # Rendering will fail on it too, and report it
+                    logger.warning(f"Could not fingerprint {rm_filename}: {e}")
+                    fingerprint = None
+                if journal:
+                    _forget_stale_steps(
+                        _pull_document(render.rm_path), fingerprint, journal
+                    )
+                rmn_path = _work_dir(render, journal) / "process_me.rmn"
+                shutil.move(downloaded_path, rmn_path)
+                priority = options.schedule.key(render)
+                ready.put(
+                    (False, priority, next(arrival), render, (rmn_path, fingerprint))
+                )
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # Ranks after every document, so it is only taken once all are handed out
+            ready.put((True, (), next(arrival), None, None))
+
+    downloader = threading.Thread(
+        target=profiling.wrap(download), name="pull-download", daemon=True
+    )
+    downloader.start()
+    while True:
+        finished, _, _, render, document = ready.get()
+        if finished:
+            break
+        yield (render, *document)
+    downloader.join()
+    if errors:
+        raise errors[0]
+
+
+def _work_dir(render: PlannedRender, journal: Optional[SyncJournal]) -> Path:
+    if journal:
+        return journal.work_dir_for(_pull_document(render.rm_path))
+    return Path(tempfile.mkdtemp())
+
+
+def _render_in_background(
+    render: PlannedRender,
+    rmn_path: Path,
+    fingerprint: Optional[str],
+    zotero: ZoteroAPI,
+    rm: ReMarkableAPI,
+    options: SyncOptions,
+    executor: ThreadPoolExecutor,
+) -> Optional[Future]:
+    """Render a document, then upload it to Zotero in the background while the next one renders"""
+    journal = options.journal
+    try:
+        if options.fingerprints and fingerprint:
+            if options.fingerprints.get(render.pdf_attachment.handle) == fingerprint:
+                logger.info(
+                    f"Annotations on {render.rm_name} have not changed since they were last synced, skipping render"
+                )
+                if not journal:
+                    shutil.rmtree(rmn_path.parent, ignore_errors=True)
+                return executor.submit(
+                    profiling.wrap(_delete_from_rm), render, rm, journal
+                )
+
+        with options.budget.reserve(max(rmn_path.stat().st_size, render.size or 0)):
+            if options.slimmed_dir and restore_original(
+                rmn_path,
+                options.slimmed_dir,
+                render.pdf_attachment.load_metadata().get("md5"),
+                lambda: zotero.get_file_content(render.pdf_attachment.handle),
+            ):
+                logger.info(f"Rendering {render.rm_name} onto its original PDF")
+            with profiling.phase("render"):
+                rendered = options.renderer.render(rmn_path, rmn_path.parent)
+    except Exception as e:
+        logger.error(f"Could not render {render.rm_path}: {e}")
+        if not journal:
+            shutil.rmtree(rmn_path.parent, ignore_errors=True)
+        return None
+    if journal:
+        journal.record(
+            _pull_document(render.rm_path),
+            "rendered",
+            name=rendered.name,
+            pdf=str(rendered.pdf),
+            markdown=str(rendered.markdown),
+            fingerprint=fingerprint,
+        )
+    return executor.submit(
+        profiling.wrap(_attach_and_clean_up),
+        render,
+        rendered,
+        fingerprint,
+        zotero,
+        rm,
+        options,
+    )
+
+
+def _attach_and_clean_up(
+    render: PlannedRender,
+    rendered: RenderedDocument,
+    fingerprint: Optional[str],
+    zotero: ZoteroAPI,
+    rm: ReMarkableAPI,
+    options: SyncOptions,
+) -> bool:
+    journal = options.journal
+    try:
+        logger.info(f'Have an annotated PDF "{rendered.name}" to upload')
+        # The rendered files are read into memory to be uploaded
+        size = sum(
+            path.stat().st_size
+            for path in (rendered.pdf, rendered.markdown)
+            if path.is_file()
+        )
+        with options.budget.reserve(size):
+            new_pdf_handle = attach_rendered_document(
+                rendered.pdf,
+                render.entry,
+                render.pdf_attachment,
+                render.md_attachment,
+                zotero,
+                rendered.markdown,
+            )
+        if options.fingerprints and fingerprint and new_pdf_handle:
+            options.fingerprints.set(
+                new_pdf_handle, fingerprint, replaces=render.pdf_attachment.handle
+            )
+        if journal:
+            journal.record(
+                _pull_document(render.rm_path), "attached", fingerprint=fingerprint
+            )
+        return _delete_from_rm(render, rm, journal)
+    except Exception as e:
+        logger.error(f"Could not sync {render.rm_path} back to Zotero: {e}")
+        return False
+    finally:
+        if not journal:
+            shutil.rmtree(rendered.pdf.parent, ignore_errors=True)
+
+
+def _delete_from_rm(
+    render: PlannedRender, rm: ReMarkableAPI, journal: Optional[SyncJournal]
+) -> bool:
+    if rm.delete_file_or_folder(render.rm_path):
+        logger.info(f"Deleted {render.rm_name} from reMarkable after successful sync")
+        if journal:
+            journal.finish(_pull_document(render.rm_path))
+        return True
+    logger.warning(f"Failed to delete {render.rm_name} from reMarkable")
+    return False
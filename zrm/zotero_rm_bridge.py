@@ -1,18 +1,30 @@
 #!/usr/bin/python3
-import os
 import sys
 import getopt
-import tempfile
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional
 
-from remarks import remarks
-from tqdm import tqdm
+import httpx
 import logging.config
 
-from zrm.config_functions import write_config, load_config
+from zrm import profiling, rmapi_shim
+from zrm.config_functions import Profile, write_config, load_all_profiles
 from zrm.adapters.ReMarkableAPI import ReMarkableAPI
 from zrm.adapters.ZoteroAPI import ZoteroAPI
-from zrm.sync_functions import sync_to_rm_filetree, attach_pdf_to_zotero_document
+from zrm.admission import ByteBudget
+from zrm.fingerprints import FingerprintStore
+from zrm.render import (
+    InProcessRenderer,
+    RemarksServerRenderer,
+    RenderBackend,
+    RenderPool,
+)
+from zrm.slimming import PdfSlimmer
+from zrm.sync_journal import SyncJournal
+from zrm.sync_plan import SyncOptions, plan_push, plan_pull, execute_plan
+from zrm.zotero_stream import StreamListener, remember_written_versions
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -21,107 +33,304 @@ logging.basicConfig(
 )
 
 
-def zotToRm(zotero: ZoteroAPI, rm: ReMarkableAPI, folders):
-    """Push files from Zotero to reMarkable."""
+def zotToRm(
+    zotero: ZoteroAPI,
+    rm: ReMarkableAPI,
+    folders,
+    dry_run: bool = False,
+    options: Optional[SyncOptions] = None,
+) -> bool:
+    """Push files from Zotero to reMarkable, returning whether all of them made it."""
     logger.info("Syncing from Zotero to reMarkable")
 
-    sync_items = zotero.find_nodes_with_tag("to_sync")
+    plan = plan_push(zotero, folders, options.schedule if options else None)
 
-    if sync_items:
-        logger.info(f"Found {len(sync_items)} items to sync...")
-        for item in tqdm(sync_items):
-            sync_to_rm_filetree(item.handle, zotero, rm, folders)
-    else:
+    if dry_run:
+        print(plan.describe())
+    elif plan.is_empty():
         logger.info("Nothing to sync from Zotero")
+    else:
+        logger.info(f"Found {len(plan.tag_changes)} items to sync...")
+        return execute_plan(plan, zotero, rm, options)
+    return True
 
 
-def rmToZot(zotero: ZoteroAPI, rm: ReMarkableAPI, read_folder: str):
-    """Pull files from reMarkable to Zotero."""
+def rmToZot(
+    zotero: ZoteroAPI,
+    rm: ReMarkableAPI,
+    read_folder: str,
+    dry_run: bool = False,
+    options: Optional[SyncOptions] = None,
+) -> bool:
+    """Pull files from reMarkable to Zotero, returning whether all of them made it."""
     logger.info("Syncing from reMarkable to Zotero")
-    rm_folder_path = os.path.join("Zotero", read_folder)
-    if rm.is_folder(rm_folder_path):
-        files_list = rm.list_children(rm_folder_path)
 
-        if files_list:
-            logger.info(
-                f"There are {len(files_list)} files to download from the reMarkable"
+    if rm.unchanged_since_last_pull():
+        logger.info("Nothing changed on the reMarkable since the last pull")
+        return True
+
+    plan = plan_pull(zotero, rm, read_folder, options.schedule if options else None)
+    for skip in plan.skips:
+        logger.warning(f"Not syncing {skip.target} back to Zotero: {skip.reason}")
+
+    if dry_run:
+        print(plan.describe())
+        return True
+    if not execute_plan(plan, zotero, rm, options):
+        return False
+    if not plan.skips:
+        # Only a pull that left nothing behind may be skipped next time, or
+        # a document that failed would wait for an unrelated change
+        rm.remember_pull()
+    return True
+
+
+def push_and_pull(
+    zotero: ZoteroAPI,
+    rm: ReMarkableAPI,
+    folders,
+    options: Optional[SyncOptions] = None,
+) -> bool:
+    """Push and pull at the same time, returning whether both synced everything.
+
+    The two directions work on different reMarkable folders and different
+    Zotero tags, and the adapters serialise the rare changes to the same
+    item, so the run takes as long as the slower direction instead of both.
+    """
+
+    def push() -> bool:
+        with profiling.phase("push"):
+            return zotToRm(zotero, rm, folders, options=options)
+
+    def pull() -> bool:
+        with profiling.phase("pull"):
+            return rmToZot(zotero, rm, folders["read"], options=options)
+
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="sync") as executor:
+        futures = [executor.submit(push), executor.submit(pull)]
+    return all([future.result() for future in futures])
+
+
+MODES = ("push", "pull", "both")
+
+
+def sync_profile(
+    profile: Profile,
+    modes: List[str],
+    dry_run: bool,
+    renderer: RenderBackend,
+    transport: Optional[httpx.BaseTransport] = None,
+    budget: Optional[ByteBudget] = None,
+    slim_pool: Optional[Executor] = None,
+) -> bool:
+    """Run the sync modes for one profile, returning whether everything was synced.
+
+    The profile's caches and state are kept in its own directory.
+    """
+    if transport:
+        # Share the connection pool with other profiles; the headers carry this profile's API key
+        profile.zot.client = httpx.Client(
+            transport=transport,
+            headers=profile.zot.default_headers(),
+            follow_redirects=True,
+            # Lets --listen tell the changes this sync makes from the user's
+            event_hooks={
+                "response": [remember_written_versions(profile.written_versions)]
+            },
+        )
+
+    rm_tree = ReMarkableAPI(
+        profile.rmapi_config,
+        profile.rmapi_policy,
+        root_state_path=profile.state_dir / "remarkable_root.json",
+    )
+    if set(modes) == {"pull"} and rm_tree.unchanged_since_last_pull():
+        # Skips the Zotero and rmapi requests of setting up, so polling is cheap
+        logger.info(f"Nothing changed on {profile.name}'s reMarkable since the last pull")
+        return True
+
+    zotero_tree = ZoteroAPI(
+        profile.zot, cache_path=profile.state_dir / "zotero_items.json"
+    )
+    zotero_tree.refresh_versions()
+    rm_tree.snapshot("Zotero")
+    logger.info(f"Filetree adapters for {profile.name} initialized successfully")
+
+    # Known on every run, so a pull without --slim-pdfs still finds earlier copies
+    slimmed_dir = profile.state_dir / "slimmed"
+    journal = SyncJournal(profile.state_dir / "journal.jsonl")
+    options = SyncOptions(
+        journal=journal,
+        fingerprints=FingerprintStore(profile.state_dir / "fingerprints.json"),
+        renderer=renderer,
+        budget=budget or ByteBudget(),
+        schedule=profile.schedule,
+        slimmer=PdfSlimmer(slimmed_dir, slim_pool) if slim_pool else None,
+        slimmed_dir=slimmed_dir,
+    )
+    synced = True
+    try:
+        for mode in modes:
+            if mode == "both" and not dry_run:
+                synced &= push_and_pull(zotero_tree, rm_tree, profile.folders, options)
+                continue
+            # A dry run goes one direction at a time, so the plans print in order
+            if mode in ("push", "both"):
+                with profiling.phase("push"):
+                    synced &= zotToRm(
+                        zotero_tree, rm_tree, profile.folders, dry_run, options
+                    )
+            if mode in ("pull", "both"):
+                with profiling.phase("pull"):
+                    synced &= rmToZot(
+                        zotero_tree, rm_tree, profile.folders["read"], dry_run, options
+                    )
+    finally:
+        journal.close()
+        zotero_tree.save_cache()
+    return synced
+
+
+def run_profiles(
+    profiles: List[Profile],
+    modes: List[str],
+    dry_run: bool = False,
+    renderer: Optional[RenderBackend] = None,
+    budget: Optional[ByteBudget] = None,
+    slim_pdfs: bool = False,
+) -> Dict[str, bool]:
+    """Sync several profiles concurrently and return whether each one succeeded.
+
+    The profiles share HTTP connections, the render backend, the memory
+    budget and the processes slimming PDFs, but a profile that fails is only
+    logged, so it does not stop the others. The results are keyed by profile
+    name, so the names must be unique.
+    """
+    names = [profile.name for profile in profiles]
+    if len(set(names)) < len(names):
+        raise ValueError(f"Profile names are not unique: {', '.join(names)}")
+    # A listener runs this again and again, and each run logs its own calls
+    rmapi_shim.stats.reset()
+    renderer = RenderPool(renderer or InProcessRenderer())
+    transport = httpx.HTTPTransport()
+    budget = budget or ByteBudget()
+    slim_pool = None
+    if slim_pdfs:
+        # Forking while the sync threads run can copy held locks into the child
+        slim_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+
+    def run(profile: Profile) -> bool:
+        try:
+            synced = sync_profile(
+                profile, modes, dry_run, renderer, transport, budget, slim_pool
             )
-            for rm_filename in tqdm(files_list):
-                rm_file_path = os.path.join(rm_folder_path, rm_filename)
-                content = rm.get_file_content(rm_file_path)
-                with tempfile.TemporaryDirectory() as temp_path:
-                    rmn_path = os.path.join(temp_path, "process_me.rmn")
-                    with open(rmn_path, "wb") as f:
-                        f.write(content)
-
-                    remarks.run_remarks(Path(rmn_path), Path(temp_path))
-                    rendered_pdf = [
-                        file
-                        for file in os.listdir(temp_path)
-                        if file.endswith(" _remarks.pdf")
-                    ]
-                    if rendered_pdf[0]:
-                        attach_pdf_to_zotero_document(
-                            Path(temp_path) / (rendered_pdf[0]), zotero
-                        )
-                        if rm.delete_file_or_folder(rm_file_path):
-                            logger.info(
-                                f"Deleted {rm_filename} from reMarkable after successful sync"
-                            )
-                        else:
-                            logger.warning(
-                                f"Failed to delete {rm_filename} from reMarkable"
-                            )
-                    else:
-                        logging.error("Was unable to find the processed pdf")
-        else:
-            logger.info("No files to sync from reMarkable")
-    else:
-        logger.info(f"Read folder {rm_folder_path} does not exist on reMarkable")
+            if not synced:
+                logger.error(f"Some documents of profile {profile.name} were not synced")
+            return synced
+        except Exception as e:
+            logger.exception(f"Syncing profile {profile.name} failed: {e}")
+            return False
+
+    with ThreadPoolExecutor(
+        max_workers=len(profiles), thread_name_prefix="profile"
+    ) as executor:
+        results = dict(zip((p.name for p in profiles), executor.map(run, profiles)))
+    transport.close()
+    if slim_pool:
+        slim_pool.shutdown()
+    if budget.peak:
+        logger.info(f"At most {budget.peak / 2**20:.1f} MiB of payloads were in memory")
+    for line in rmapi_shim.stats.summary():
+        logger.info(line)
+    return results
+
+
+def listen_and_push(
+    profiles: List[Profile],
+    renderer: Optional[RenderBackend] = None,
+    budget: Optional[ByteBudget] = None,
+    slim_pdfs: bool = False,
+):
+    """Push a profile's newly tagged papers whenever Zotero reports a change to its library."""
+    listener = StreamListener(
+        profiles,
+        lambda changed: run_profiles(
+            changed, ["push"], renderer=renderer, budget=budget, slim_pdfs=slim_pdfs
+        ),
+    )
+    logger.info("Listening for changes in Zotero, press Ctrl+C to stop")
+    try:
+        listener.run()
+    except KeyboardInterrupt:
+        listener.stop()
 
 
 def main():
     argv = sys.argv[1:]
-    config_path = Path.cwd() / "config.yml"
-    if not config_path.exists():
-        write_config(config_path)
-
-    zot, webdav, folders = load_config(config_path)
-    read_folder = folders["read"]
 
-    # Initialize filetree adapters
     try:
-        zotero_tree = ZoteroAPI(zot)
-        rm_tree = ReMarkableAPI()
-        logger.info("Filetree adapters initialized successfully")
-    except Exception as e:
-        logger.error(f"Failed to initialize filetree adapters: {e}")
+        opts, args = getopt.getopt(
+            argv,
+            "m:",
+            [
+                "dry-run",
+                "render-server=",
+                "config=",
+                "max-inflight-mb=",
+                "profile",
+                "profile-sampling",
+                "slim-pdfs",
+                "listen",
+            ],
+        )
+    except getopt.GetoptError:
+        logger.error("No argument recognized")
         sys.exit()
 
+    dry_run = any(opt == "--dry-run" for opt, _ in opts)
+    slim_pdfs = any(opt == "--slim-pdfs" for opt, _ in opts)
+    listen = any(opt == "--listen" for opt, _ in opts)
+    render_servers = [arg for opt, arg in opts if opt == "--render-server"]
+    config_paths = [Path(arg) for opt, arg in opts if opt == "--config"]
+    modes = [arg for opt, arg in opts if opt == "-m"] or ["both"]
+    if any(mode not in MODES for mode in modes):
+        logger.error("Invalid argument")
+        sys.exit()
+    max_inflight = [arg for opt, arg in opts if opt == "--max-inflight-mb"]
     try:
-        opts, args = getopt.getopt(argv, "m:")
-    except getopt.GetoptError:
-        logger.error("No argument recognized")
+        budget = ByteBudget(int(float(max_inflight[-1]) * 2**20) if max_inflight else None)
+    except ValueError:
+        logger.error("--max-inflight-mb takes a number of megabytes")
         sys.exit()
 
-    if not opts:
-        opts = [["-m", "both"]]
+    if not config_paths:
+        config_paths = [Path.cwd() / "config.yml"]
+        if not config_paths[0].exists():
+            write_config(config_paths[0])
 
     try:
-        for opt, arg in opts:
-            if opt == "-m":
-                if arg == "push":
-                    zotToRm(zotero_tree, rm_tree, folders)
-                elif arg == "pull":
-                    rmToZot(zotero_tree, rm_tree, read_folder)
-                elif arg == "both":
-                    zotToRm(zotero_tree, rm_tree, folders)
-                    rmToZot(zotero_tree, rm_tree, read_folder)
-                else:
-                    logger.error("Invalid argument")
-                    sys.exit()
+        profiles = load_all_profiles(config_paths)
     except Exception as e:
-        logger.exception(e)
+        logger.error(f"Failed to load config: {e}")
+        sys.exit()
+
+    if any(opt == "--profile-sampling" for opt, _ in opts):
+        profiling.start(profiling.SAMPLING, Path.cwd())
+    elif any(opt == "--profile" for opt, _ in opts):
+        profiling.start(profiling.DETERMINISTIC, Path.cwd())
+
+    renderer = RemarksServerRenderer(render_servers) if render_servers else None
+    try:
+        results = run_profiles(profiles, modes, dry_run, renderer, budget, slim_pdfs)
+    finally:
+        profiling.stop()
+    if not all(results.values()):
+        failed = [name for name, success in results.items() if not success]
+        logger.error(f"Sync failed for: {', '.join(failed)}")
+        if not listen:
+            sys.exit(1)
+    if listen and not dry_run:
+        listen_and_push(profiles, renderer, budget, slim_pdfs)
 
 
 if __name__ == "__main__":
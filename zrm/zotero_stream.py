@@ -0,0 +1,374 @@
+# zotero_stream.py
+import base64
+import hashlib
+import http.client
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import ssl
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import httpx
+
+from zrm.config_functions import Profile
+
+logger = logging.getLogger("zotero_rM_bridge.zotero_stream")
+
+STREAM_URL = "wss://stream.zotero.org"
+# Changes arriving within this many seconds of each other are synced together
+DEBOUNCE_SECONDS = 5.0
+# A library that keeps changing is still synced this often
+MAX_DELAY_SECONDS = 30.0
+# How long to wait before reconnecting, until the server says otherwise
+RETRY_SECONDS = 10.0
+CONNECT_TIMEOUT = 30.0
+# Appended to the handshake key to compute the accept key (RFC 6455, section 1.3)
+_ACCEPT_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+_TEXT = 0x1
+_CLOSE = 0x8
+_PING = 0x9
+_PONG = 0xA
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+class WebSocket:
+    """A minimal WebSocket client (RFC 6455) for text messages, using only the standard library."""
+
+    def __init__(self, url: str, timeout: float = CONNECT_TIMEOUT):
+        parsed = urlparse(url)
+        secure = parsed.scheme == "wss"
+        port = parsed.port or (443 if secure else 80)
+        sock = socket.create_connection((parsed.hostname, port), timeout=timeout)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(
+                sock, server_hostname=parsed.hostname
+            )
+        # Events can be hours apart, so only the OS notices a dead connection
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._sock = sock
+        self._send_lock = threading.Lock()
+        self._buffer = b""
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = (
+            f"GET {parsed.path or '/'} HTTP/1.1\r\n"
+            f"Host: {parsed.netloc}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        )
+        sock.sendall(request.encode())
+        while b"\r\n\r\n" not in self._buffer:
+            self._fill()
+        head, self._buffer = self._buffer.split(b"\r\n\r\n", 1)
+        status_line, _, header_lines = head.partition(b"\r\n")
+        problem = _handshake_problem(
+            status_line.decode("latin-1"),
+            http.client.parse_headers(io.BytesIO(header_lines + b"\r\n\r\n")),
+            key,
+        )
+        if problem:
+            sock.close()
+            raise ConnectionError(f"WebSocket handshake with {url} failed: {problem}")
+        sock.settimeout(None)
+
+    def _fill(self):
+        data = self._sock.recv(65536)
+        if not data:
+            raise WebSocketClosed("connection closed by the server")
+        self._buffer += data
+
+    def _read(self, n: int) -> bytes:
+        while len(self._buffer) < n:
+            self._fill()
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def _send_frame(self, opcode: int, payload: bytes):
+        # Frames from a client are always masked
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 2**16:
+            header += bytes([0x80 | 126]) + struct.pack("!H", length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack("!Q", length)
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        with self._send_lock:
+            self._sock.sendall(header + mask + masked)
+
+    def send(self, message: str):
+        self._send_frame(_TEXT, message.encode())
+
+    def receive(self) -> str:
+        """The next text message, answering pings while waiting for it."""
+        message = b""
+        while True:
+            first, second = self._read(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self._read(8))[0]
+            mask = self._read(4) if second & 0x80 else b""
+            payload = self._read(length)
+            if mask:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+            if opcode == _PING:
+                self._send_frame(_PONG, payload)
+            elif opcode == _CLOSE:
+                raise WebSocketClosed("connection closed by the server")
+            elif opcode != _PONG:
+                # Text and continuation frames, until the final one
+                message += payload
+                if first & 0x80:
+                    return message.decode()
+
+    def close(self):
+        try:
+            self._send_frame(_CLOSE, b"")
+        except OSError:
+            pass
+        try:
+            # Wakes up a thread blocked in receive
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+
+def _handshake_problem(status_line: str, headers, key: str) -> Optional[str]:
+    """What is wrong with the server's answer to an opening handshake, if anything"""
+    parts = status_line.split(" ", 2)
+    if len(parts) < 2 or parts[1] != "101":
+        return status_line
+    if (headers.get("Upgrade") or "").lower() != "websocket":
+        return "the server did not switch to the WebSocket protocol"
+    connection = (headers.get("Connection") or "").lower()
+    if "upgrade" not in (token.strip() for token in connection.split(",")):
+        return "the server did not upgrade the connection"
+    expected = base64.b64encode(
+        hashlib.sha1((key + _ACCEPT_GUID).encode()).digest()
+    ).decode()
+    if headers.get("Sec-WebSocket-Accept") != expected:
+        return "the server's Sec-WebSocket-Accept does not match the key"
+    return None
+
+
+def library_topic(profile: Profile) -> str:
+    """The streaming API topic of a profile's library, e.g. `/users/123`."""
+    return f"/{profile.zot.library_type}/{profile.zot.library_id}"
+
+
+def remember_written_versions(written: Set[int]) -> Callable[[httpx.Response], None]:
+    """An httpx response hook that adds the library versions writes produce to `written`.
+
+    Zotero answers every write that changed the library with the library's
+    new version, which the streaming API then reports for the change. Other
+    requests answer with the current version, which may be someone else's.
+    """
+
+    def remember(response: httpx.Response):
+        request = response.request
+        wrote = response.status_code == 204 or (
+            request.method == "POST"
+            and response.status_code == 200
+            and request.url.path.endswith("/items")
+        )
+        version = response.headers.get("Last-Modified-Version", "")
+        if request.method in ("POST", "PUT", "PATCH", "DELETE") and wrote:
+            if version.isdigit():
+                written.add(int(version))
+
+    return remember
+
+
+class StreamListener:
+    """Syncs a profile as soon as the Zotero streaming API reports a change to its library.
+
+    Every profile's library is subscribed to on one connection. A burst of
+    changes, like tagging several papers, is synced in one go once no
+    change arrived for `debounce` seconds, or at the latest `max_delay`
+    seconds after the first one. After a lost connection every profile is
+    synced, as changes made meanwhile were not reported. Changes that only
+    report library versions in a profile's `written_versions`, made by this
+    process's own syncs, are not synced again.
+    """
+
+    def __init__(
+        self,
+        profiles: List[Profile],
+        # Whatever it returns, like run_profiles' results, is not used
+        on_change: Callable[[List[Profile]], object],
+        url: str = STREAM_URL,
+        debounce: float = DEBOUNCE_SECONDS,
+        max_delay: float = MAX_DELAY_SECONDS,
+    ):
+        self.profiles = profiles
+        self.on_change = on_change
+        self.url = url
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._topics: Dict[str, List[Profile]] = {}
+        for profile in profiles:
+            self._topics.setdefault(library_topic(profile), []).append(profile)
+        # (topic, library version) of each change, None for all after a reconnect
+        self._changes: queue.Queue = queue.Queue()
+        self._socket: Optional[WebSocket] = None
+        self._stop = threading.Event()
+
+    def _subscribe(self, ws: WebSocket) -> float:
+        """Subscribe to every profile's library, returning the server's retry delay."""
+        retry = RETRY_SECONDS
+        connected = json.loads(ws.receive())
+        if connected.get("event") == "connected" and "retry" in connected:
+            retry = connected["retry"] / 1000
+        ws.send(
+            json.dumps(
+                {
+                    "action": "createSubscriptions",
+                    "subscriptions": [
+                        {"apiKey": profiles[0].zot.api_key, "topics": [topic]}
+                        for topic, profiles in self._topics.items()
+                    ],
+                }
+            )
+        )
+        return retry
+
+    def _read_events(self):
+        retry = RETRY_SECONDS
+        first_connection = True
+        while not self._stop.is_set():
+            try:
+                ws = WebSocket(self.url)
+                self._socket = ws
+                if self._stop.is_set():
+                    # stop() ran while connecting and missed this socket
+                    ws.close()
+                    return
+                retry = self._subscribe(ws)
+                if not first_connection:
+                    logger.info("Reconnected to the Zotero streaming API")
+                    self._changes.put(None)
+                first_connection = False
+                while True:
+                    message = ws.receive()
+                    try:
+                        self._handle_event(json.loads(message))
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        logger.warning(
+                            f"Ignoring a malformed Zotero streaming API event "
+                            f"{message[:200]!r}: {e!r}"
+                        )
+            except (OSError, WebSocketClosed, ValueError) as e:
+                if self._stop.is_set():
+                    return
+                logger.warning(
+                    f"Lost the Zotero streaming API ({e}), reconnecting in {retry:.0f}s"
+                )
+                first_connection = False
+                self._stop.wait(retry)
+
+    def _handle_event(self, event: Dict):
+        if event.get("event") == "subscriptionsCreated":
+            for error in event.get("errors", []):
+                logger.error(f"Could not subscribe to Zotero changes: {error}")
+        elif event.get("event") == "topicUpdated":
+            topic = event["topic"]
+            if not isinstance(topic, str):
+                raise TypeError(f"topic {topic!r} is not a string")
+            self._changes.put((topic, event.get("version")))
+
+    def _changed_by_others(
+        self, changed: Dict[int, Profile], versions: Dict[str, Set]
+    ) -> List[Profile]:
+        """The changed profiles, without those only changed by this process's writes"""
+        to_sync = []
+        for profile in changed.values():
+            reported = versions.get(library_topic(profile), set())
+            written = profile.written_versions
+            if reported and reported <= written:
+                logger.debug(f"Ignoring the changes {profile.name}'s own sync made")
+            else:
+                to_sync.append(profile)
+            # Versions are only reported once, and later changes have higher ones
+            newest = max((v for v in reported if isinstance(v, int)), default=None)
+            if newest is not None:
+                written.difference_update([v for v in list(written) if v <= newest])
+        return to_sync
+
+    def stop(self):
+        self._stop.set()
+        if self._socket:
+            self._socket.close()
+
+    def run(self):
+        """Listen and sync until `stop` is called."""
+        reader = threading.Thread(
+            target=self._read_events, name="zotero-stream", daemon=True
+        )
+        reader.start()
+        # Keyed by id, as profiles are not hashable
+        changed: Dict[int, Profile] = {}
+        # The library versions reported for each changed topic, None after a reconnect
+        versions: Dict[str, Set] = {}
+        first_change = last_change = 0.0
+        try:
+            while not self._stop.is_set():
+                if changed:
+                    now = time.monotonic()
+                    due = min(last_change + self.debounce, first_change + self.max_delay)
+                    if now >= due:
+                        # Checked only now, so the responses to our own writes are in
+                        to_sync = self._changed_by_others(changed, versions)
+                        changed.clear()
+                        versions.clear()
+                        if to_sync:
+                            names = ", ".join(profile.name for profile in to_sync)
+                            logger.info(f"Zotero changes for {names}, syncing")
+                            self.on_change(to_sync)
+                        continue
+                    timeout = due - now
+                else:
+                    timeout = None
+                try:
+                    change: Optional[Tuple[str, Optional[int]]] = self._changes.get(
+                        timeout=min(timeout or 1.0, 1.0)
+                    )
+                except queue.Empty:
+                    continue
+
+                now = time.monotonic()
+                if not changed:
+                    first_change = now
+                last_change = now
+                if change is None:
+                    affected = self.profiles
+                    for topic in self._topics:
+                        versions.setdefault(topic, set()).add(None)
+                else:
+                    topic, version = change
+                    affected = self._topics.get(topic, [])
+                    versions.setdefault(topic, set()).add(version)
+                for profile in affected:
+                    changed[id(profile)] = profile
+        finally:
+            self.stop()
+            reader.join()